@@ -1,2 +1,3 @@
 from .opendap import OpendapExtractor
 from .motu import CopernicusMotuExtractor
+from .batch import BatchExtractor, ExtractionSpec, BatchResult
@@ -1,5 +1,7 @@
 # Standard
 import sys
+import asyncio
+import threading
 from pathlib import Path
 from collections.abc import Callable
 # Third party
@@ -8,10 +10,10 @@ import requests
 # Own
 from siaextractlib.processing import wrangling
 from siaextractlib.utils.auth import SimpleAuth
-from siaextractlib.utils.metadata import RequestSize, SizeUnit, FileDetails, ExtractionDetails
+from siaextractlib.utils.metadata import RequestSize, SizeUnit, FileDetails, ExtractionDetails, ExtractionProgress
 from siaextractlib.utils.exceptions import ExtractionException
 from siaextractlib.extractors.interfaces import ExtractorInterface
-from siaextractlib.processing.parallelism import AsyncRunner, AsyncRunnerManager
+from siaextractlib.processing.parallelism import AsyncRunner, AsyncRunnerManager, Scheduler, Job, CancelToken
 
 
 class BaseExtractor(ExtractorInterface):
@@ -22,13 +24,21 @@ class BaseExtractor(ExtractorInterface):
   def __init__(
     self,
     log_stream = sys.stderr,
-    verbose: bool = False
+    verbose: bool = False,
+    scheduler: Scheduler = None
   ) -> None:
     self.log_stream = log_stream
     self.verbose = verbose
+    self.scheduler = scheduler
+    # Token of the current (or next) extraction and progress of the current
+    # (or last) one.
+    self.cancel_token = CancelToken()
+    self.progress: ExtractionProgress = None
+    # Held while an extraction runs (see "begin_extraction()").
+    self.__running = threading.Lock()
     # self.__async_extract = AsyncRunner(sync_fn=self.sync_extract)
     self.async_runner_manager = AsyncRunnerManager()
-    self.async_runner_manager.add_runner('extract', AsyncRunner(sync_fn=self.sync_extract))
+    self.async_runner_manager.add_runner('extract', AsyncRunner(sync_fn=self.sync_extract, scheduler=scheduler))
   
 
   def log(self, *args, **kwargs):
@@ -41,18 +51,83 @@ class BaseExtractor(ExtractorInterface):
       print(*args, **kwargs, file=self.log_stream)
   
 
-  def extract(self, filepath: Path | str, success_callback: Callable[[ExtractionDetails], None], failure_callback: Callable[[Exception], None]) -> None:
+  def extract(self, filepath: Path | str, success_callback: Callable[[ExtractionDetails], None], failure_callback: Callable[[Exception], None], **kwargs) -> Job:
     """
-    Asynchronous call of "sync_extract(...)" method.
+    Asynchronous call of "sync_extract(...)" method, as a job of the scheduler.
+    Calls made while a previous extraction is running are queued.
+    **kwargs are forwarded to "sync_extract(...)" method (e.g. `resume=True`).
+    The job gets a cancel token (`cancel_token` if it is given) now, so
+    cancelling the returned job stops the extraction even when it is
+    running. ".cancel()" stops it while it is queued too.
     """
+    cancel_token = kwargs.get('cancel_token')
+    if cancel_token is None:
+      cancel_token = CancelToken()
     kwargs = {
-      'filepath': filepath
+      **kwargs,
+      'filepath': filepath,
+      'cancel_token': cancel_token
     }
     runner = self.async_runner_manager.get_runner('extract')
     runner.success_callback = success_callback
     runner.failure_callback = failure_callback
     runner.sync_fn_kwargs = kwargs
-    runner.run()
+    return runner.run(cancel_token=cancel_token)
+
+
+  def cancel(self) -> None:
+    """
+    Asks the running extraction to stop. It stops at the next safe point
+    (see "sync_extract(...)" of the extractor). If no extraction is running,
+    the next one is cancelled as soon as it starts.
+    """
+    self.cancel_token.cancel()
+
+
+  def take_cancel_token(self, cancel_token: CancelToken = None) -> CancelToken:
+    """
+    Sets the token of the extraction starting now: `cancel_token` if it is
+    given, or self.cancel_token. If self.cancel_token was cancelled before
+    the extraction started (".cancel()" while it was queued), `cancel_token`
+    is cancelled too, so the cancellation is not lost.
+    """
+    if cancel_token is not None:
+      if self.cancel_token.is_cancelled():
+        cancel_token.cancel()
+      self.cancel_token = cancel_token
+    return self.cancel_token
+
+
+  def begin_extraction(self) -> None:
+    """
+    Marks an extraction as running until "end_extraction()". The state of
+    an extraction (its cancel token, progress, telemetry...) is kept by the
+    extractor, so an ExtractionException is raised if another one is
+    running.
+    """
+    if not self.__running.acquire(blocking=False):
+      raise ExtractionException(messages=[
+        'Another extraction of this extractor is running. An extractor runs one extraction at a time.',
+        'Use an extractor per concurrent extraction, or "extract(...)", which queues them.'
+      ])
+
+
+  def end_extraction(self) -> None:
+    """
+    Marks the running extraction as ended and gives ".cancel()" a new token
+    for the next one.
+    """
+    self.cancel_token = CancelToken()
+    self.__running.release()
+
+
+  async def aextract(self, filepath: Path | str, **kwargs) -> ExtractionDetails:
+    """
+    Coroutine version of "sync_extract(...)". It runs on a thread of the
+    default executor of the running event loop.
+    **kwargs are forwarded to "sync_extract(...)" method.
+    """
+    return await asyncio.to_thread(self.sync_extract, filepath=filepath, **kwargs)
 
 
   def wait(self, process_name: str, seconds: float = None) -> None:
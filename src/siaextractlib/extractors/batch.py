@@ -0,0 +1,268 @@
+# Standard
+import sys
+import time
+import asyncio
+import threading
+from pathlib import Path
+from collections.abc import Iterator, AsyncIterator
+from concurrent.futures import FIRST_COMPLETED, wait as wait_futures
+# Own
+from siaextractlib.utils.auth import SimpleAuth
+from siaextractlib.utils.metadata import ExtractionDetails
+from siaextractlib.utils.cache import MetadataCache, BlockCache
+from siaextractlib.utils.staging import StagingArea
+from siaextractlib.utils.http import SessionPool, get_default_pool
+from siaextractlib.utils.exceptions import ExtractionCancelledException
+from siaextractlib.processing.parallelism import Scheduler, Job, CancelToken, ConcurrencyLimiter, get_default_scheduler, wait_jobs
+from siaextractlib.extractors.opendap import OpendapExtractor
+
+
+class ExtractionSpec:
+  """
+  An extraction of a batch: the dataset, what to extract from it and the
+  output file. `options` are passed to its OpendapExtractor (e.g.
+  `req_max_size`) and `extract_options` to its "sync_extract(...)" (e.g.
+  `append=True`).
+  """
+  def __init__(
+    self,
+    opendap_url: str,
+    filepath: Path | str,
+    requested_vars: list[str] = None,
+    dim_constraints: dict[str, slice | list] = None,
+    auth: SimpleAuth = None,
+    name: str = None,
+    options: dict[str, any] = None,
+    extract_options: dict[str, any] = None
+  ):
+    self.opendap_url = opendap_url
+    self.filepath = filepath
+    self.requested_vars = requested_vars
+    self.dim_constraints = dim_constraints
+    self.auth = auth
+    self.name = name if name is not None else Path(filepath).name
+    self.options = options if options is not None else {}
+    self.extract_options = extract_options if extract_options is not None else {}
+
+
+  def __str__(self):
+    return f'Extraction spec {self.name}: url={self.opendap_url}; filepath={self.filepath}; requested_vars={self.requested_vars}; dim_constraints={self.dim_constraints}.'
+
+
+class BatchResult:
+  """
+  Outcome of an ExtractionSpec: the details of its extraction, or the error
+  that stopped it, and its wall time in seconds (connection included).
+  """
+  def __init__(
+    self,
+    spec: ExtractionSpec,
+    details: ExtractionDetails = None,
+    error: BaseException = None,
+    seconds: float = 0.0
+  ):
+    self.spec = spec
+    self.details = details
+    self.error = error
+    self.seconds = seconds
+
+
+  def __str__(self):
+    outcome = f'error={self.error.__class__.__name__}: {self.error}' if self.error is not None else f'complete={self.details.complete}'
+    return f'Batch result {self.spec.name}: {outcome}; seconds={self.seconds:.3f}.'
+
+
+  def ok(self) -> bool:
+    return self.error is None and self.details is not None and self.details.complete
+
+
+class BatchExtractor:
+  """
+  Runs the extractions of many ExtractionSpecs at once, at most `max_jobs`
+  at a time (connections included), as jobs of `scheduler` (the
+  process-wide one by default). Their extractors share the HTTP
+  sessions of `session_pool` (the process-wide pool by default), the caches
+  and the staging area given, and a ConcurrencyLimiter: the blocks of every
+  extraction are downloaded at most `max_concurrent` at once in total and
+  at most `max_per_host` at once from the same host.
+  `extractor_options` are the options of every OpendapExtractor, updated
+  with the options of each spec. Every extractor downloads up to
+  `max_per_host` blocks at once by default (its `max_workers`).
+  Derive it to build other extractors (see "new_extractor(...)").
+  """
+  def __init__(
+    self,
+    specs: list[ExtractionSpec],
+    max_jobs: int = 4,
+    max_concurrent: int = 16,
+    max_per_host: int = 4,
+    session_pool: SessionPool = None,
+    metadata_cache: MetadataCache = None,
+    block_cache: BlockCache = None,
+    staging_area: StagingArea = None,
+    scheduler: Scheduler = None,
+    log_stream = sys.stderr,
+    verbose: bool = False,
+    **extractor_options
+  ) -> None:
+    self.specs = list(specs)
+    self.max_jobs = max_jobs
+    self.scheduler = scheduler
+    self.concurrency_limiter = ConcurrencyLimiter(max_concurrent=max_concurrent, max_per_host=max_per_host)
+    self.session_pool = session_pool if session_pool is not None else get_default_pool()
+    self.metadata_cache = metadata_cache
+    self.block_cache = block_cache
+    self.staging_area = staging_area
+    self.log_stream = log_stream
+    self.verbose = verbose
+    self.extractor_options = { 'max_workers': max_per_host or 4, **extractor_options }
+    self.__cancel_tokens: list[CancelToken] = []
+    self.__lock = threading.Lock()
+
+
+  def log(self, *args, **kwargs):
+    if self.verbose:
+      print(*args, **kwargs, file=self.log_stream)
+
+
+  def new_extractor(self, spec: ExtractionSpec) -> OpendapExtractor:
+    """
+    Builds the extractor of `spec`, sharing the resources of the batch.
+    """
+    return OpendapExtractor(
+      opendap_url=spec.opendap_url,
+      auth=spec.auth,
+      dim_constraints=spec.dim_constraints,
+      requested_vars=spec.requested_vars,
+      log_stream=self.log_stream,
+      verbose=self.verbose,
+      metadata_cache=self.metadata_cache,
+      block_cache=self.block_cache,
+      staging_area=self.staging_area,
+      session_pool=self.session_pool,
+      concurrency_limiter=self.concurrency_limiter,
+      scheduler=self.scheduler,
+      **{ **self.extractor_options, **spec.options })
+
+
+  def run_spec(self, spec: ExtractionSpec, cancel_token: CancelToken) -> BatchResult:
+    """
+    Connects to the dataset of `spec` and extracts it. Errors are returned
+    in the result, so they do not stop the rest of the batch.
+    """
+    start = time.monotonic()
+    extractor = None
+    try:
+      cancel_token.raise_if_cancelled(f'The batch was cancelled before the extraction {spec.name} started.')
+      self.log(f'Starting the extraction {spec.name}.')
+      extractor = self.new_extractor(spec)
+      extractor.sync_connect()
+      details = extractor.sync_extract(spec.filepath, cancel_token=cancel_token, **spec.extract_options)
+      return BatchResult(spec, details=details, seconds=time.monotonic() - start)
+    except Exception as err:
+      self.log(f'The extraction {spec.name} failed: {err.__class__.__name__}: {err}')
+      return BatchResult(spec, error=err, seconds=time.monotonic() - start)
+    finally:
+      if extractor is not None:
+        extractor.close()
+
+
+  def new_cancel_tokens(self) -> list[CancelToken]:
+    # One per extraction: an extraction cancels its own token when it fails.
+    tokens = [ CancelToken() for _ in self.specs ]
+    with self.__lock:
+      self.__cancel_tokens = tokens
+    return tokens
+
+
+  def submit_spec(self, spec: ExtractionSpec, cancel_token: CancelToken) -> Job:
+    """
+    Submits the extraction of `spec` to the scheduler. The job can be
+    cancelled as the jobs of "OpendapExtractor.extract(...)" are.
+    """
+    scheduler = self.scheduler if self.scheduler is not None else get_default_scheduler()
+    return scheduler.submit(
+      self.run_spec,
+      fn_kwargs={ 'spec': spec, 'cancel_token': cancel_token },
+      name=spec.name,
+      cancel_token=cancel_token)
+
+
+  def get_result(self, spec: ExtractionSpec, job: Job) -> BatchResult:
+    """
+    Returns the result of the finished `job` of `spec`.
+    """
+    if job.future.cancelled():
+      error = ExtractionCancelledException(messages=f'The extraction {spec.name} was cancelled before it started.')
+      return BatchResult(spec, error=error)
+    return job.result()
+
+
+  def cancel(self):
+    """
+    Cancels the extractions of the running batch. Each of them stops as
+    "OpendapExtractor.sync_extract(...)" does when cancelled, so it can be
+    resumed later.
+    """
+    with self.__lock:
+      tokens = list(self.__cancel_tokens)
+    for token in tokens:
+      token.cancel()
+
+
+  def sync_extract(self) -> Iterator[BatchResult]:
+    """
+    Runs the batch, yielding the result of every extraction as it finishes.
+    Closing the iterator before the end cancels the extractions left.
+    """
+    tokens = self.new_cancel_tokens()
+    self.log(f'Starting a batch of {len(self.specs)} extractions: max_jobs={self.max_jobs}. {self.concurrency_limiter}')
+    # Extractions are submitted as the running ones finish, so the batch
+    # does not take more than self.max_jobs workers of the scheduler.
+    pending = list(zip(self.specs, tokens))
+    running: dict[Job, ExtractionSpec] = {}
+    n_done = 0
+    try:
+      while pending or running:
+        while pending and len(running) < self.max_jobs:
+          spec, token = pending.pop(0)
+          running[self.submit_spec(spec, token)] = spec
+        wait_futures([ job.future for job in running ], return_when=FIRST_COMPLETED)
+        for job in [ job for job in running if job.done() ]:
+          result = self.get_result(running.pop(job), job)
+          n_done += 1
+          self.log(f'Extraction {n_done}/{len(self.specs)} finished. {result}')
+          yield result
+    finally:
+      for job in running:
+        job.cancel()
+      wait_jobs(list(running))
+
+
+  async def aextract(self) -> AsyncIterator[BatchResult]:
+    """
+    Coroutine version of "sync_extract(...)": an asynchronous iterator of
+    the results.
+    """
+    tokens = self.new_cancel_tokens()
+    pending = list(zip(self.specs, tokens))
+    running: dict[asyncio.Future, tuple[Job, ExtractionSpec]] = {}
+    n_done = 0
+    try:
+      while pending or running:
+        while pending and len(running) < self.max_jobs:
+          spec, token = pending.pop(0)
+          job = self.submit_spec(spec, token)
+          running[asyncio.wrap_future(job.future)] = (job, spec)
+        done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+          job, spec = running.pop(future)
+          result = self.get_result(spec, job)
+          n_done += 1
+          self.log(f'Extraction {n_done}/{len(self.specs)} finished. {result}')
+          yield result
+    finally:
+      jobs = [ job for job, _ in running.values() ]
+      for job in jobs:
+        job.cancel()
+      await asyncio.to_thread(wait_jobs, jobs)
@@ -1,22 +1,79 @@
 # Standard
+import os
 import sys
 import time
+import asyncio
+import functools
+import threading
+import uuid
+import shutil
+import contextlib
+import tempfile
 import traceback
 from pathlib import Path
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 # Third party
 import requests
 import numpy as np
 import xarray as xr
 # Own
-from siaextractlib.processing import wrangling
+from siaextractlib.processing import wrangling, planning
+from siaextractlib.processing.adaptive import Backoff, AdaptiveSizeController
+from siaextractlib.processing.planning import Block
+from siaextractlib.processing.writers import NetcdfBlockWriter, MemoryBlockWriter, ZarrBlockWriter, OutputEncoding
 from siaextractlib.utils.auth import SimpleAuth
-from siaextractlib.utils.metadata import RequestSize, SizeUnit, FileDetails, ExtractionDetails
-from siaextractlib.utils.exceptions import ExtractionException
+from siaextractlib.utils.metadata import RequestSize, SizeUnit, FileDetails, ExtractionDetails, ExtractionProgress
+from siaextractlib.utils.exceptions import ExtractionException, ExtractionCancelledException
+from siaextractlib.utils.manifest import BlockManifest, BlockRecord, BlockStatus
+from siaextractlib.utils.cache import MetadataCache, BlockCache
+from siaextractlib.utils.staging import StagingArea, StagingJob
+from siaextractlib.utils.locks import NETCDF_LOCK
+from siaextractlib.utils.http import SessionPool, SessionApplication, get_default_pool
+from siaextractlib.utils.telemetry import MetricsHook, ExtractionTelemetry, BlockTelemetry
 from siaextractlib.extractors.interfaces import ExtractorInterface
-from siaextractlib.processing.parallelism import AsyncRunner, AsyncRunnerManager
+from siaextractlib.processing.parallelism import AsyncRunner, AsyncRunnerManager, Scheduler, Job, CancelToken, ConcurrencyLimiter
 from siaextractlib.extractors.base_extractor import BaseExtractor
 
+class ExtractionRun:
+  """
+  State of an extraction between its preparation and its end: the planned
+  blocks, the manifest, the keys of the blocks already in the output file,
+  the writer of the output file (a NetcdfBlockWriter or a direct writer,
+  see processing.writers) and the staging job of its tmp files, if any.
+  """
+  def __init__(
+    self,
+    filepath: Path,
+    download_dir: Path,
+    subset: xr.Dataset,
+    blocks: list[Block],
+    manifest: BlockManifest,
+    merged_keys: set[str],
+    writer: NetcdfBlockWriter | ZarrBlockWriter,
+    staging_job: StagingJob = None,
+    cache_keys: dict[int, str] = None
+  ):
+    self.filepath = filepath
+    self.download_dir = download_dir
+    self.subset = subset
+    self.blocks = blocks
+    self.n_blocks = len(blocks)
+    self.manifest = manifest
+    self.merged_keys = merged_keys
+    self.writer = writer
+    self.staging_job = staging_job
+    # Keys of the blocks in the block cache, by block number.
+    self.cache_keys = cache_keys if cache_keys is not None else {}
+
+
+  def get_pending_blocks(self) -> list[Block]:
+    """
+    Returns the blocks not written into the output file yet.
+    """
+    return [ b for b in self.blocks if b.get_key() not in self.merged_keys ]
+
+
 # Needs Pydap >= 3.3.0
 # https://github.com/pydap/pydap
 class OpendapExtractor(BaseExtractor):
@@ -29,22 +86,65 @@ class OpendapExtractor(BaseExtractor):
     log_stream = sys.stderr,
     max_attempts: int = 5,
     req_max_size: int = 64, # MB
+    max_block_size: float = None, # MB
+    min_block_size: float = None, # MB
+    backoff_base: float = 1.0, # seconds
+    backoff_max: float = 60.0, # seconds
+    max_workers: int = 1,
+    metadata_cache: MetadataCache = None,
+    session_pool: SessionPool = None,
+    scheduler: Scheduler = None,
+    metrics_hook: MetricsHook = None,
+    output_encoding: OutputEncoding = None,
+    output_format: str = None,
+    staging_area: StagingArea = None,
+    block_cache: BlockCache = None,
+    concurrency_limiter: ConcurrencyLimiter = None,
     verbose: bool = False
   ) -> None:
-    super().__init__(log_stream=log_stream, verbose=verbose)
+    super().__init__(log_stream=log_stream, verbose=verbose, scheduler=scheduler)
     self.opendap_url = opendap_url
     self.auth = auth
     self.dim_constraints = dim_constraints
     self.requested_vars = requested_vars
     self.dataset = None
+    self.coordinate_index: wrangling.CoordinateIndex = None
+    self.size_estimator: wrangling.SizeEstimator = None
     self.filepath = None
     self.session = None
     self.time_dim_name = 'time'
+    # Last time step of the file appended to, if any (see get_append_subset).
+    self.append_after = None
     self.max_attempts = max_attempts
     self.tmp_files: list[FileDetails] = []
     self.req_max_size = req_max_size
+    self.max_block_size = max_block_size
+    self.min_block_size = min_block_size
+    self.backoff = Backoff(base=backoff_base, cap=backoff_max)
+    self.size_controller: AdaptiveSizeController = None
+    self.max_workers = max_workers
+    self.metadata_cache = metadata_cache
+    self.session_pool = session_pool
+    self.chunk_report: planning.ChunkReport = None
+    self.metrics_hook = metrics_hook
+    self.output_encoding = output_encoding if output_encoding is not None else OutputEncoding()
+    # 'netcdf' or 'zarr'. By default, given by the extension of the output path.
+    self.output_format = output_format
+    # Where the tmp files of the blocks go. Next to the output file by default.
+    self.staging_area = staging_area
+    # Blocks extracted before are read from it instead of downloaded.
+    self.block_cache = block_cache
+    # Shared with other extractors to limit their downloads at once.
+    self.concurrency_limiter = concurrency_limiter
+    self.telemetry = ExtractionTelemetry(metrics_hook=metrics_hook)
+    # Seconds spent by the last connection, added to the next extraction.
+    self.connect_seconds = 0.0
+    self.connect_kwargs = {}
+    self.__worker_local = threading.local()
+    self.__worker_datasets: list[xr.Dataset] = []
+    self.__worker_lock = threading.Lock()
     # self.__async_connect = AsyncRunner(sync_fn=self.sync_connect)
-    self.async_runner_manager.add_runner('connect', AsyncRunner(sync_fn=self.sync_connect))
+    self.async_runner_manager.add_runner('connect', AsyncRunner(sync_fn=self.sync_connect, scheduler=scheduler))
   
 
   def verify_safety_for_processing(self):
@@ -52,6 +152,13 @@ class OpendapExtractor(BaseExtractor):
       raise ExtractionException(messages='No dataset has been opened. Execute ".connect(...)" first.')
   
 
+  def check_cancelled(self):
+    """
+    Raises an ExtractionCancelledException if the extraction was cancelled.
+    """
+    self.cancel_token.raise_if_cancelled('The extraction was cancelled.')
+
+
   def forget_tmp_files(self):
     """
     Clean the in-between file list without unlink them.
@@ -74,15 +181,15 @@ class OpendapExtractor(BaseExtractor):
     self.log('Unlinking done.')
     
 
-  def connect(self, success_callback: Callable[..., None], failure_callback: Callable[[BaseException], None], **kwargs):
+  def connect(self, success_callback: Callable[..., None], failure_callback: Callable[[BaseException], None], **kwargs) -> Job:
     """
-    Asynchronous call of "sync_connect(...)" method.
+    Asynchronous call of "sync_connect(...)" method, as a job of the scheduler.
     """
     runner = self.async_runner_manager.get_runner('connect')
     runner.success_callback = success_callback
     runner.failure_callback = failure_callback
     runner.sync_fn_kwargs = kwargs
-    runner.run()
+    return runner.run()
 
 
   def sync_connect(self, **kwargs):
@@ -92,14 +199,14 @@ class OpendapExtractor(BaseExtractor):
     """
     self.log('Trying to open the remote dataset.')
     self.close()
+    start = time.monotonic()
     try:
-      self.session = requests.Session()
-      if self.auth:
-        self.session.auth = (self.auth.user, self.auth.passwd)
-      opendap_conn = xr.backends.PydapDataStore.open(
-        self.opendap_url,
-        session=self.session)
-      self.dataset = wrangling.open_dataset(opendap_conn, log_stream=self.log_stream, **kwargs)
+      self.session = self.get_session()
+      self.connect_kwargs = kwargs
+      self.dataset = self.open_remote_dataset(self.session, **kwargs)
+      self.coordinate_index = wrangling.CoordinateIndex(self.dataset)
+      self.size_estimator = wrangling.SizeEstimator(self.dataset, index=self.coordinate_index)
+      self.connect_seconds = time.monotonic() - start
       self.log('Dataset opened.')
       return self
     except BaseException as err:
@@ -107,50 +214,548 @@ class OpendapExtractor(BaseExtractor):
       raise err.with_traceback(err.__traceback__)
   
 
+  async def aconnect(self, **kwargs):
+    """
+    Coroutine version of "sync_connect(...)". Pydap is blocking, so the
+    dataset is opened on a thread of the default executor of the running
+    event loop.
+    **kwargs are forwarded to `xr.open_dataset` method.
+    """
+    return await asyncio.to_thread(self.sync_connect, **kwargs)
+
+
+  def get_session(self) -> requests.Session:
+    """
+    Returns the HTTP session of the host of the dataset with the credentials
+    of the extractor. It is taken from self.session_pool (the process-wide
+    pool by default), so it is shared with other extractors and its
+    connections are reused.
+    """
+    session_pool = self.session_pool if self.session_pool is not None else get_default_pool()
+    return session_pool.get_session(self.opendap_url, self.auth)
+
+
+  def open_store(self, session: requests.Session):
+    """
+    Opens the Pydap connection with the remote dataset. Every request of the
+    connection is sent through `session` (see SessionApplication).
+    """
+    return xr.backends.PydapDataStore.open(
+      self.opendap_url,
+      application=SessionApplication(self.opendap_url, session),
+      session=session)
+
+
+  def open_remote_dataset(self, session: requests.Session, **kwargs) -> xr.Dataset:
+    """
+    Opens the remote dataset through a Pydap connection that uses `session`.
+    **kwargs are forwarded to `xr.open_dataset` method.
+    If there is a metadata cache, the dimension coordinates are taken from it
+    when possible instead of being downloaded.
+    """
+    opendap_conn = self.open_store(session)
+    if self.metadata_cache is None:
+      return wrangling.open_dataset(opendap_conn, log_stream=self.log_stream, **kwargs)
+    url = str(self.opendap_url)
+    cache_key = url if not kwargs else f'{url}#{sorted(kwargs.items())}'
+    coords = self.metadata_cache.get(url, session=session, key=cache_key)
+    if coords is not None:
+      self.log('Using the cached coordinates of the dataset.')
+      drop_variables = kwargs.pop('drop_variables', [])
+      if type(drop_variables) is str:
+        drop_variables = [ drop_variables ]
+      drop_variables = list(drop_variables) + list(coords.variables)
+      dataset = wrangling.open_dataset(opendap_conn, log_stream=self.log_stream, drop_variables=drop_variables, **kwargs)
+      return dataset.assign_coords(coords.coords)
+    dataset = wrangling.open_dataset(opendap_conn, log_stream=self.log_stream, **kwargs)
+    self.metadata_cache.set(url, dataset, session=session, key=cache_key)
+    return dataset
+
+
+  def get_worker_dataset(self) -> xr.Dataset:
+    """
+    Returns the dataset the current thread must read from. With a single
+    worker it is the dataset opened by ".sync_connect(...)". Otherwise every
+    worker thread opens its own Pydap connection on its first block. The
+    connections share the pooled HTTP session.
+    """
+    if self.max_workers <= 1:
+      return self.dataset
+    dataset = getattr(self.__worker_local, 'dataset', None)
+    if dataset is None:
+      dataset = self.open_remote_dataset(self.get_session(), **self.connect_kwargs)
+      self.__worker_local.dataset = dataset
+      with self.__worker_lock:
+        self.__worker_datasets.append(dataset)
+    return dataset
+
+
+  def close_worker_datasets(self):
+    """
+    Closes the datasets opened by the worker threads. They are closed
+    explicitly rather than left to the garbage collector, which may close
+    them on any thread while other threads use the netCDF library.
+    """
+    with self.__worker_lock:
+      for dataset in self.__worker_datasets:
+        dataset.close()
+      self.__worker_datasets = []
+    self.__worker_local = threading.local()
+
+
   def close(self):
     """
-    Closes the connection with the remote dataset.
+    Closes the connection with the remote dataset. The HTTP session is left
+    open in its pool for other connections to the same host.
     """
     if self.session is not None:
-      self.session.close()
       self.session = None
+      if self.dataset is not None:
+        self.dataset.close()
       self.dataset = None
+      self.coordinate_index = None
+      self.size_estimator = None
 
 
   def fetch(self, subset: xr.Dataset, path: Path | str) -> FileDetails:
     """
     Executes the actual download process and writes the data
-    into an actual file in disk.
+    into an actual file in disk, stored as self.output_encoding says.
     """
     self.log('Extracting chunk of data. This can take a while.')
-    subset.to_netcdf(path)
+    # Downloaded before writing, so the NetCDF file is written holding
+    # NETCDF_LOCK while other blocks are still being downloaded.
+    subset = subset.load()
+    encoding = self.output_encoding.get_encoding(subset, time_dim=self.time_dim_name)
+    with NETCDF_LOCK:
+      subset.to_netcdf(path, encoding=encoding)
     subset.close()
     file_details = FileDetails(description='dataset', path=path)
     self.log(f'Extracted chunk: {file_details}')
     return file_details
 
 
+  def download_slot(self):
+    """
+    Returns the context manager that holds a slot of
+    self.concurrency_limiter, if any, while a block (or part) is downloaded.
+    """
+    if self.concurrency_limiter is None:
+      return contextlib.nullcontext()
+    return self.concurrency_limiter.slot(self.opendap_url, cancel_token=self.cancel_token)
+
+
+  def get_worker_subset(self) -> xr.Dataset:
+    """
+    Returns the requested subset of the dataset of the current thread.
+    It is computed once per thread and extraction. Every worker dataset
+    opens the same remote dataset, so the coordinate index is shared.
+    """
+    subset = getattr(self.__worker_local, 'subset', None)
+    if subset is None:
+      dataset = self.get_worker_dataset()
+      subset = wrangling.slice_dice(dataset, self.dim_constraints, self.requested_vars, squeeze=False, index=self.coordinate_index)
+      if self.append_after is not None:
+        subset = wrangling.select_times_after(subset, self.time_dim_name, self.append_after)
+      self.__worker_local.subset = subset
+    return subset
+
+
+  def fetch_part(self, subset: xr.Dataset) -> xr.Dataset:
+    """
+    Downloads a part of a block into memory.
+    """
+    return subset.load()
+
+
+  def split_block_subset(self, block_subset: xr.Dataset, part: Block, max_bytes: float) -> list[Block]:
+    """
+    Splits the `part` of a block (`block_subset`) in parts of at most
+    `max_bytes` bytes, aligned with the storage chunks.
+    """
+    return planning.split_block(
+      block_subset,
+      part,
+      max_bytes,
+      order=planning.get_storage_order(block_subset),
+      chunks=planning.get_chunk_sizes(block_subset),
+      offsets=planning.get_index_offsets(self.get_worker_dataset(), block_subset))
+
+
+  def extract_block(
+    self,
+    block: Block,
+    n_blocks: int,
+    download_dir: Path,
+    manifest: BlockManifest = None,
+    output_writer: ZarrBlockWriter | MemoryBlockWriter = None,
+    staging_job: StagingJob = None,
+    cache_key: str = None
+  ) -> FileDetails | None:
+    """
+    Downloads the `block` of the requested subset into a tmp file or, if a
+    direct `output_writer` is given, into memory and then straight into
+    its region of the output (no tmp file is created, the returned details
+    have no path).
+    Retries up to self.max_attempts times, waiting between attempts as
+    self.backoff says, and returns None if the block could not be extracted.
+    Runs on a worker thread.
+    Blocks bigger than the size of self.size_controller are downloaded in
+    parts of that size, assembled in the tmp file (or in memory) as they
+    arrive. When a download fails, the size is halved and the failed part
+    split again.
+    If a manifest is given, blocks it records as completed are not
+    downloaded again and the result of the download is recorded on it.
+    If the extraction is cancelled (see self.cancel_token), the block stops
+    before its next attempt or part, or once its download ends: its tmp file
+    is removed and None is returned. It stays pending in the manifest.
+    What the block took is recorded in self.telemetry.
+    If a `staging_job` is given, the tmp file is created in it, once there
+    is room for the block in its staging area.
+    If a `cache_key` is given, the block is read from self.block_cache if it
+    is there, and stored in it once downloaded otherwise.
+    Every download holds a slot of self.concurrency_limiter, if any.
+    """
+    block_key = block.get_key()
+    block_telemetry = BlockTelemetry(number=block.number, key=block_key, nbytes=block.nbytes)
+    started = time.monotonic()
+    if manifest is not None:
+      file_details = manifest.get_completed_file(block_key)
+      if file_details is not None:
+        self.log(f'Block {block.number + 1}/{n_blocks} already extracted in a previous run: {file_details}')
+        block_telemetry.outcome = 'reused'
+        self.telemetry.record_block(block_telemetry)
+        self.telemetry.add_tmp_bytes(Path(file_details.path).stat().st_size)
+        if self.progress is not None:
+          self.progress.add_block(block.nbytes)
+        return file_details
+    tmp_path = None
+    if output_writer is None and staging_job is not None:
+      tmp_path = staging_job.new_path(prefix=f'tmp_dataset_{block.number}')
+    elif output_writer is None:
+      tmp_path = Path(download_dir, f'tmp_dataset_{block.number}_{uuid.uuid4().hex}.nc')
+    time_min, time_max = None, None
+    block_subset = None
+    block_data: xr.Dataset = None
+    parts: list[Block] = None
+    writer: NetcdfBlockWriter | MemoryBlockWriter = None
+    block_attempt = 1
+    cancelled = False
+    cached = None
+    try:
+      if staging_job is not None and tmp_path is not None:
+        staging_job.reserve(tmp_path, block.nbytes, order=block.number, cancel_token=self.cancel_token)
+      if cache_key is not None:
+        cached = self.read_cached_block(cache_key, tmp_path)
+      if cached is not None:
+        self.log(f'Block {block.number + 1}/{n_blocks} read from the block cache: {cache_key}')
+        block_telemetry.outcome = 'cached'
+        if output_writer is not None:
+          block_data, time_min, time_max = cached
+        else:
+          file_details, time_min, time_max = cached
+      while cached is None and block_attempt <= self.max_attempts:
+        delay = self.backoff.get_delay(block_attempt)
+        if delay:
+          self.log(f'Waiting {delay:.2f}s before the next attempt.')
+          self.cancel_token.sleep(delay)
+        self.check_cancelled()
+        block_telemetry.attempts += 1
+        self.log(f'Extracting block: number={block.number + 1}/{n_blocks}; slices={block_key}; size={block.nbytes / 1e6}MB; attempt={block_attempt}/{self.max_attempts}.')
+        try:
+          if block_subset is None:
+            block_subset = self.get_worker_subset().isel(block.slices)
+            time_min, time_max = wrangling.get_time_bound_from_ds(dataset=block_subset)
+          size = self.size_controller.get_size()
+          if parts is None and block.nbytes <= size:
+            with self.download_slot():
+              start = time.monotonic()
+              if output_writer is not None:
+                block_data = self.fetch_part(block_subset)
+              else:
+                file_details = self.fetch(block_subset, tmp_path)
+            block_telemetry.fetch_seconds += time.monotonic() - start
+            self.size_controller.record_success(block.nbytes, time.monotonic() - start)
+            if self.progress is not None:
+              self.progress.add_downloaded(block.nbytes)
+            break
+          if parts is None:
+            parts = self.split_block_subset(block_subset, Block(number=0, slices={}), size)
+            if output_writer is not None:
+              writer = MemoryBlockWriter(block_subset)
+            else:
+              writer = NetcdfBlockWriter(tmp_path, template=block_subset, output_encoding=self.output_encoding, time_dim=self.time_dim_name)
+            writer.create()
+          while parts:
+            self.check_cancelled()
+            part = parts[0]
+            self.log(f'Extracting part of block {block.number + 1}/{n_blocks}: slices={part.get_key()}; size={part.nbytes / 1e6}MB; parts left={len(parts)}.')
+            with self.download_slot():
+              start = time.monotonic()
+              part_subset = self.fetch_part(block_subset.isel(part.slices))
+            block_telemetry.fetch_seconds += time.monotonic() - start
+            self.size_controller.record_success(part.nbytes, time.monotonic() - start)
+            if self.progress is not None:
+              self.progress.add_downloaded(part.nbytes)
+            writer.write(part, part_subset)
+            parts.pop(0)
+          writer.close()
+          if output_writer is not None:
+            block_data = writer.get_dataset()
+          else:
+            file_details = FileDetails(description='dataset', path=tmp_path)
+            self.log(f'Extracted chunk: {file_details}')
+          break
+        except ExtractionCancelledException:
+          raise
+        except Exception as err:
+          self.log('An error has occurred while fetching block:')
+          traceback.print_exception(err, file=self.log_stream)
+          block_telemetry.retry_reasons.append(f'{err.__class__.__name__}: {err}')
+          self.size_controller.record_failure(parts[0].nbytes if parts else block.nbytes)
+          if parts:
+            parts[0:1] = self.split_block_subset(block_subset, parts[0], self.size_controller.get_size())
+          self.log(f'Retrying. Adaptive block size: {self.size_controller}')
+          block_attempt += 1
+      # A download that ends after a cancellation is not kept.
+      self.check_cancelled()
+    except ExtractionCancelledException:
+      self.log(f'Extraction cancelled. Block {block.number + 1}/{n_blocks} stopped.')
+      cancelled = True
+    finally:
+      if writer is not None:
+        writer.close()
+    block_telemetry.wall_seconds = time.monotonic() - started
+    if cancelled:
+      if tmp_path is not None and tmp_path.exists():
+        tmp_path.unlink()
+      if staging_job is not None and tmp_path is not None:
+        staging_job.release(tmp_path)
+      block_telemetry.outcome = 'cancelled'
+      self.telemetry.record_block(block_telemetry)
+      return None
+    if block_attempt > self.max_attempts:
+      if tmp_path is not None and tmp_path.exists():
+        tmp_path.unlink()
+      if staging_job is not None and tmp_path is not None:
+        staging_job.release(tmp_path)
+      block_telemetry.outcome = 'failed'
+      self.telemetry.record_block(block_telemetry)
+      if manifest is not None:
+        manifest.set_record(BlockRecord(
+          number=block.number,
+          key=block_key,
+          time_min=None if time_min is None else str(time_min),
+          time_max=None if time_max is None else str(time_max),
+          status=BlockStatus.FAILED))
+      return None
+    if cache_key is not None and cached is None:
+      self.cache_block(cache_key, tmp_path, block_data)
+    if output_writer is not None:
+      return self.write_block(output_writer, block, block_data, block_telemetry, manifest, time_min, time_max)
+    if manifest is not None:
+      manifest.set_record(BlockRecord(
+        number=block.number,
+        key=block_key,
+        time_min=None if time_min is None else str(time_min),
+        time_max=None if time_max is None else str(time_max),
+        path=Path(file_details.path).absolute(),
+        size=Path(file_details.path).stat().st_size,
+        status=BlockStatus.COMPLETED))
+    self.telemetry.record_block(block_telemetry)
+    self.telemetry.add_tmp_bytes(Path(file_details.path).stat().st_size)
+    if self.progress is not None:
+      self.progress.add_block(block.nbytes)
+    return file_details
+
+
+  def get_block_cache_keys(self, subset: xr.Dataset, blocks: list[Block]) -> dict[int, str]:
+    """
+    Returns the keys of the `blocks` of `subset` in self.block_cache, by
+    block number. Blocks whose position in the dataset cannot be known
+    (e.g. its indexes have duplicates) are not cached.
+    """
+    if self.block_cache is None:
+      return {}
+    try:
+      positions = planning.get_index_positions(self.dataset, subset)
+    except Exception as err:
+      self.log(f'The blocks cannot be cached: {err.__class__.__name__}: {err}')
+      return {}
+    version = self.block_cache.get_version(self.opendap_url, session=self.session)
+    self.log(f'Dataset version: {version}. {self.block_cache}')
+    variables = list(subset.data_vars)
+    encoding = self.output_encoding.to_dict()
+    keys = {}
+    for block in blocks:
+      ranges = planning.get_block_ranges(block, positions)
+      if ranges is not None:
+        keys[block.number] = self.block_cache.get_key(
+          self.opendap_url,
+          variables,
+          ranges,
+          version=version,
+          decode_options=self.connect_kwargs,
+          encoding=encoding)
+    return keys
+
+
+  def read_cached_block(self, cache_key: str, tmp_path: Path = None) -> tuple[xr.Dataset | FileDetails, np.datetime64, np.datetime64] | None:
+    """
+    Reads the block of `cache_key` from self.block_cache: into memory if
+    there is no `tmp_path`, or linked (or copied) to `tmp_path`. Returns the
+    data or the details of the tmp file, and the time bounds of the block,
+    or None if the block is not cached or cannot be read.
+    """
+    cached_path = self.block_cache.get(cache_key)
+    if cached_path is None:
+      return None
+    try:
+      if tmp_path is None:
+        with NETCDF_LOCK, xr.open_dataset(cached_path) as cached:
+          block_data = cached.load()
+        # Written as the output says, not as the cached file was.
+        for variable in block_data.variables.values():
+          variable.encoding = {}
+        return (block_data, ) + wrangling.get_time_bound_from_ds(dataset=block_data)
+      try:
+        os.link(cached_path, tmp_path)
+      except OSError:
+        shutil.copyfile(cached_path, tmp_path)
+      with NETCDF_LOCK, xr.open_dataset(tmp_path) as cached:
+        time_bounds = wrangling.get_time_bound_from_ds(dataset=cached)
+      return (FileDetails(description='dataset', path=tmp_path), ) + time_bounds
+    except OSError as err:
+      self.log(f'The cached block {cache_key} cannot be read: {err}')
+      if tmp_path is not None:
+        tmp_path.unlink(missing_ok=True)
+      return None
+
+
+  def cache_block(self, cache_key: str, tmp_path: Path = None, block_data: xr.Dataset = None):
+    """
+    Stores a downloaded block in self.block_cache: its tmp file or, if it
+    has none, its data, stored as its tmp file would be. The extraction
+    goes on if it cannot be stored.
+    """
+    try:
+      if tmp_path is not None:
+        self.block_cache.put(cache_key, tmp_path)
+      else:
+        encoding = self.output_encoding.get_encoding(block_data, time_dim=self.time_dim_name)
+        self.block_cache.put_dataset(cache_key, block_data, encoding=encoding)
+    except OSError as err:
+      self.log(f'The block {cache_key} cannot be cached: {err}')
+
+
+  def write_block(
+    self,
+    output_writer: ZarrBlockWriter | MemoryBlockWriter,
+    block: Block,
+    block_data: xr.Dataset,
+    block_telemetry: BlockTelemetry,
+    manifest: BlockManifest = None,
+    time_min = None,
+    time_max = None
+  ) -> FileDetails:
+    """
+    Writes a downloaded block straight into its region of the output, on
+    the worker thread, and records it as merged.
+    """
+    start = time.monotonic()
+    output_writer.write(block, block_data)
+    seconds = time.monotonic() - start
+    if manifest is not None:
+      manifest.set_record(BlockRecord(
+        number=block.number,
+        key=block.get_key(),
+        time_min=None if time_min is None else str(time_min),
+        time_max=None if time_max is None else str(time_max),
+        path=None if getattr(output_writer, 'path', None) is None else Path(output_writer.path).absolute(),
+        status=BlockStatus.MERGED))
+    self.telemetry.record_block(block_telemetry)
+    self.telemetry.record_merge(block.number, seconds)
+    if self.progress is not None:
+      self.progress.add_block(block.nbytes)
+      self.progress.add_merged()
+    return FileDetails(description='block written into the output', path=None)
+
+
+  def get_request_signature(self) -> dict:
+    """
+    Returns a description of the current request used to verify that a
+    manifest belongs to it. It holds the block size and the encoding too:
+    blocks of another layout can not be merged with the current ones.
+    """
+    constraints = {}
+    if self.dim_constraints:
+      for dim_name, constraint in self.dim_constraints.items():
+        constraints[dim_name] = str(constraint)
+    return {
+      'opendap_url': str(self.opendap_url),
+      'requested_vars': None if self.requested_vars is None else [ str(v) for v in self.requested_vars ],
+      'dim_constraints': constraints,
+      'max_block_size': self.get_max_block_size(),
+      'output_encoding': self.output_encoding.to_dict()
+    }
+
+
+  def get_max_block_size(self) -> float:
+    """
+    Returns the size (MB) the blocks are planned with: the largest one the
+    adaptive controller can reach.
+    """
+    return float(max(self.max_block_size or self.req_max_size, self.req_max_size))
+
+
   def get_size(self, unit: SizeUnit = SizeUnit.BYTE) -> RequestSize:
     """
     Returns the size of the dataset based on the current constraints.
+    The size is estimated from the metadata only, no data is downloaded.
+    """
+    self.verify_safety_for_processing()
+    nbytes = self.size_estimator.estimate(self.dim_constraints, self.requested_vars)
+    return self.to_request_size(nbytes, unit)
+
+
+  def get_sizes(self, constraint_sets: list[dict[str, slice | list]], unit: SizeUnit = SizeUnit.BYTE) -> list[RequestSize]:
+    """
+    Returns the size of the dataset for every set of constraints in
+    `constraint_sets`, with the current requested variables. The sizes are
+    estimated from the metadata in a single vectorised pass.
     """
     self.verify_safety_for_processing()
-    subset = wrangling.slice_dice(self.dataset, self.dim_constraints, self.requested_vars, squeeze=False)
+    sizes = self.size_estimator.estimate_many(constraint_sets, self.requested_vars)
+    return [ self.to_request_size(int(nbytes), unit) for nbytes in sizes ]
+
+
+  async def aget_size(self, unit: SizeUnit = SizeUnit.BYTE) -> RequestSize:
+    """
+    Coroutine version of "get_size(...)". The size is estimated from the
+    metadata in memory, so it does not block the event loop.
+    """
+    return self.get_size(unit)
+
+
+  def to_request_size(self, nbytes: int, unit: SizeUnit = SizeUnit.BYTE) -> RequestSize:
+    """
+    Converts a size in bytes into a RequestSize in the specified units.
+    """
     rsize = RequestSize()
     if unit == SizeUnit.KILO_BYTE:
       rsize.unit = SizeUnit.KILO_BYTE
-      rsize.size = subset.nbytes / 1e3
+      rsize.size = nbytes / 1e3
     elif unit == SizeUnit.MEGA_BYTE:
       rsize.unit = SizeUnit.MEGA_BYTE
-      rsize.size = subset.nbytes / 1e6
+      rsize.size = nbytes / 1e6
     elif unit == SizeUnit.GIGA_BYTE:
       rsize.unit = SizeUnit.GIGA_BYTE
-      rsize.size = subset.nbytes / 1e9
+      rsize.size = nbytes / 1e9
     elif unit == SizeUnit.BYTE:
       rsize.unit = SizeUnit.BYTE
-      rsize.size = subset.nbytes
+      rsize.size = nbytes
     else:
-      raise KeyError(message=f'Option "{unit}" not valid.')
+      raise KeyError(f'Option "{unit}" not valid.')
     return rsize
 
 
@@ -174,7 +779,7 @@ class OpendapExtractor(BaseExtractor):
   def sync_extract_straightforward(self, filepath: Path | str) -> ExtractionDetails:
     self.verify_safety_for_processing()
     self.log('Starting extraction process.')
-    subset = wrangling.slice_dice(self.dataset, self.dim_constraints, self.requested_vars, squeeze=False)
+    subset = wrangling.slice_dice(self.dataset, self.dim_constraints, self.requested_vars, squeeze=False, index=self.coordinate_index)
     file_details = self.fetch(subset, filepath)
     time_min, time_max = wrangling.get_time_bound_from_ds(dataset=subset)
     self.log('Extraction done.')
@@ -187,12 +792,402 @@ class OpendapExtractor(BaseExtractor):
   
 
   # Actually used.
-  def sync_extract(self, filepath: Path | str) -> ExtractionDetails:
+  def sync_extract(
+    self,
+    filepath: Path | str,
+    resume: bool = False,
+    cancel_token: CancelToken = None,
+    progress_callback: Callable[[ExtractionProgress], None] = None,
+    append: bool = False
+  ) -> ExtractionDetails:
+    """
+    Executes the extraction by splitting the request size in blocks of
+    self.max_block_size size (self.req_max_size by default), downloaded in
+    parts whose size adapts to the server (see extract_block).
+    Every block is written into the output file as soon as it (and the
+    blocks before it) has been downloaded. The time dimension is unlimited
+    in the file.
+    The state of the blocks is recorded in a manifest next to the output
+    file. If `resume` is True, the blocks completed by a previous run of the
+    same request are reused and only the missing ones are downloaded.
+    The extraction can be cancelled with `cancel_token` (or ".cancel()",
+    also before it starts). It stops before the next block, part or
+    attempt; the data being downloaded at that moment is discarded. No more
+    blocks are written into the output file. The blocks already extracted
+    are kept with the manifest, so the extraction can be resumed, and an
+    ExtractionCancelledException is raised.
+    Its progress is kept in self.progress, which can be polled, and is
+    passed to `progress_callback` on every update (from the worker threads).
+    Its performance data is kept in self.telemetry and in the returned
+    details (see ExtractionTelemetry).
+    An extractor runs one extraction at a time: an ExtractionException is
+    raised if another one is running (see "begin_extraction()").
+    If `append` is True and the output file exists, only the time steps
+    after its last one are extracted, and they are appended to it in place
+    (see "get_append_subset(...)").
+    """
+    self.begin_extraction()
+    try:
+      run = self.prepare_extraction(filepath, resume=resume, cancel_token=cancel_token, progress_callback=progress_callback, append=append)
+      results, block_count, extraction_completed = self.extract_blocks(run)
+      return self.finish_extraction(run, results, block_count, extraction_completed)
+    finally:
+      self.end_extraction()
+
+
+  def sync_extract_to_memory(
+    self,
+    memory_budget: float = 512, # MB
+    spill_dir: Path | str = None,
+    cancel_token: CancelToken = None,
+    progress_callback: Callable[[ExtractionProgress], None] = None
+  ) -> xr.Dataset:
+    """
+    Executes the extraction as "sync_extract(...)" does, but assembles the
+    blocks into an in-memory dataset, which is returned. Workers write their
+    blocks straight into it: no file is created, encoded, reopened or
+    removed.
+    If the requested subset is bigger than `memory_budget` MB, it is spilled
+    to a NetCDF file in `spill_dir` (the root of self.staging_area or the
+    tmp directory by default) instead, and the returned dataset is that
+    file opened lazily. The file is not removed (see the "source" of its
+    encoding).
+    Raises an ExtractionException if a block could not be extracted (the
+    data in memory is discarded) and an ExtractionCancelledException if it
+    is cancelled.
+    """
+    self.begin_extraction()
+    try:
+      run = self.prepare_extraction(None, cancel_token=cancel_token, progress_callback=progress_callback, memory_budget=memory_budget, spill_dir=spill_dir)
+      results, block_count, extraction_completed = self.extract_blocks(run)
+      details = self.finish_extraction(run, results, block_count, extraction_completed)
+      return self.get_extracted_dataset(run, details)
+    finally:
+      self.end_extraction()
+
+
+  def extract_blocks(self, run: ExtractionRun) -> tuple[list[FileDetails | None], int, bool]:
+    """
+    Extracts the pending blocks of `run` on self.max_workers threads and
+    writes them into its output in order. Returns the results of the blocks,
+    the number of blocks in the output and whether all of them are.
+    """
+    block_count = len(run.merged_keys)
+    extraction_completed = True
+    futures = {}
+    fetch_timer = self.start_fetch_timer()
+    executor = ThreadPoolExecutor(max_workers=self.max_workers)
+    try:
+      for block in run.get_pending_blocks():
+        future = executor.submit(
+          self.extract_block,
+          block=block,
+          n_blocks=run.n_blocks,
+          download_dir=run.download_dir,
+          manifest=run.manifest,
+          output_writer=run.writer if run.writer.direct else None,
+          staging_job=run.staging_job,
+          cache_key=run.cache_keys.get(block.number))
+        futures[block.number] = future
+      # Stop the pending blocks as soon as one fails.
+      def stop_on_failure(future):
+        if not future.cancelled() and future.exception() is None and future.result() is None:
+          for pending in futures.values():
+            pending.cancel()
+      for future in list(futures.values()):
+        future.add_done_callback(stop_on_failure)
+
+      for row in planning.get_rows(run.blocks):
+        if self.cancel_token.is_cancelled():
+          extraction_completed = False
+          self.log_stop()
+          break
+        row_files = []
+        for block in row:
+          if block.number not in futures:
+            continue
+          future = futures[block.number]
+          file_details = None if future.cancelled() else future.result()
+          if file_details is None:
+            extraction_completed = False
+            break
+          row_files.append((block, file_details))
+        if not extraction_completed:
+          self.log_stop()
+          break
+        for block, file_details in row_files:
+          if not run.writer.direct:
+            self.merge_block(run.writer, block, file_details, run.filepath, run.manifest, staging_job=run.staging_job)
+          block_count += 1
+    except BaseException:
+      # Stop the blocks running on the threads too (e.g. waiting for room
+      # in the staging area).
+      self.cancel_token.cancel()
+      raise
+    finally:
+      self.release_staging(run)
+      executor.shutdown()
+      self.close_staging(run)
+      self.stop_fetch_timer(fetch_timer)
+      with self.telemetry.time_phase('cleanup'):
+        run.writer.close()
+        self.close_worker_datasets()
+    results = [ f.result() for f in futures.values() if f.done() and not f.cancelled() ]
+    return results, block_count, extraction_completed
+
+
+  async def aextract(
+    self,
+    filepath: Path | str,
+    resume: bool = False,
+    cancel_token: CancelToken = None,
+    progress_callback: Callable[[ExtractionProgress], None] = None,
+    append: bool = False
+  ) -> ExtractionDetails:
+    """
+    Coroutine version of "sync_extract(...)". The blocks are extracted by
+    concurrent asyncio tasks, at most self.max_workers at once. Pydap is
+    blocking, so every task downloads its block on a thread of a pool of
+    self.max_workers threads. Blocks are written into the output file in
+    order, as in "sync_extract(...)".
+    Cancelling the coroutine cancels the extraction as `cancel_token` does.
+    """
+    self.begin_extraction()
+    try:
+      run = await asyncio.to_thread(self.prepare_extraction, filepath, resume=resume, cancel_token=cancel_token, progress_callback=progress_callback, append=append)
+      results, block_count, extraction_completed = await self.aextract_blocks(run)
+      return await asyncio.to_thread(self.finish_extraction, run, results, block_count, extraction_completed)
+    finally:
+      self.end_extraction()
+
+
+  async def aextract_to_memory(
+    self,
+    memory_budget: float = 512, # MB
+    spill_dir: Path | str = None,
+    cancel_token: CancelToken = None,
+    progress_callback: Callable[[ExtractionProgress], None] = None
+  ) -> xr.Dataset:
+    """
+    Coroutine version of "sync_extract_to_memory(...)", with the blocks
+    extracted as in "aextract(...)".
+    """
+    self.begin_extraction()
+    try:
+      run = await asyncio.to_thread(self.prepare_extraction, None, cancel_token=cancel_token, progress_callback=progress_callback, memory_budget=memory_budget, spill_dir=spill_dir)
+      results, block_count, extraction_completed = await self.aextract_blocks(run)
+      details = await asyncio.to_thread(self.finish_extraction, run, results, block_count, extraction_completed)
+      return await asyncio.to_thread(self.get_extracted_dataset, run, details)
+    finally:
+      self.end_extraction()
+
+
+  async def aextract_blocks(self, run: ExtractionRun) -> tuple[list[FileDetails | None], int, bool]:
+    """
+    Coroutine version of "extract_blocks(...)", with the blocks extracted by
+    concurrent asyncio tasks.
+    """
+    loop = asyncio.get_running_loop()
+    block_count = len(run.merged_keys)
+    extraction_completed = True
+    semaphore = asyncio.Semaphore(self.max_workers)
+    stop = asyncio.Event()
+    executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    async def extract(block: Block) -> FileDetails | None:
+      async with semaphore:
+        # Pending blocks are not extracted once a block fails.
+        if stop.is_set():
+          return None
+        file_details = await loop.run_in_executor(executor, functools.partial(
+          self.extract_block,
+          block=block,
+          n_blocks=run.n_blocks,
+          download_dir=run.download_dir,
+          manifest=run.manifest,
+          output_writer=run.writer if run.writer.direct else None,
+          staging_job=run.staging_job,
+          cache_key=run.cache_keys.get(block.number)))
+        if file_details is None:
+          stop.set()
+        return file_details
+
+    tasks = { block.number: asyncio.ensure_future(extract(block)) for block in run.get_pending_blocks() }
+    fetch_timer = self.start_fetch_timer()
+    try:
+      for row in planning.get_rows(run.blocks):
+        if self.cancel_token.is_cancelled():
+          extraction_completed = False
+          self.log_stop()
+          break
+        row_files = []
+        for block in row:
+          if block.number not in tasks:
+            continue
+          file_details = await tasks[block.number]
+          if file_details is None:
+            extraction_completed = False
+            break
+          row_files.append((block, file_details))
+        if not extraction_completed:
+          self.log_stop()
+          break
+        for block, file_details in row_files:
+          if not run.writer.direct:
+            await asyncio.to_thread(self.merge_block, run.writer, block, file_details, run.filepath, run.manifest, staging_job=run.staging_job)
+          block_count += 1
+    except BaseException:
+      # Stop the blocks running on the threads too.
+      self.cancel_token.cancel()
+      raise
+    finally:
+      stop.set()
+      self.release_staging(run)
+      # Let the blocks being downloaded finish. Cancelling the coroutine
+      # cancels the tasks, not their threads: wait for them too, as
+      # "extract_blocks(...)" does, before cleaning up.
+      await asyncio.gather(*tasks.values(), return_exceptions=True)
+      await asyncio.to_thread(executor.shutdown, True)
+      await asyncio.to_thread(self.close_staging, run)
+      self.stop_fetch_timer(fetch_timer)
+      with self.telemetry.time_phase('cleanup'):
+        run.writer.close()
+        self.close_worker_datasets()
+    results = [ t.result() for t in tasks.values() if not t.cancelled() and t.exception() is None ]
+    return results, block_count, extraction_completed
+
+
+  def release_staging(self, run: ExtractionRun):
     """
-    Executes the extraction by splitting the request size in blocks of self.req_max_size size.
-    Once all blocks has been downloaded, it merges them all in a new single file.
+    Releases the room reserved in the staging area by the blocks of `run`
+    once no more blocks are merged, so the blocks still running do not wait
+    for blocks that will not be merged.
+    """
+    if run.staging_job is not None:
+      run.staging_job.release_all()
+
+
+  def close_staging(self, run: ExtractionRun):
+    """
+    Closes the staging job of `run` once its blocks are done: it is removed
+    unless the manifest references blocks kept in it for a resume. Then
+    sweeps the staging area, e.g. the job this run resumed from.
+    """
+    if run.staging_job is not None:
+      run.staging_job.close()
+      self.staging_area.sweep()
+
+
+  def start_fetch_timer(self) -> tuple[float, float]:
+    """
+    Starts timing the block loop of an extraction.
+    """
+    return (time.monotonic(), self.telemetry.phases['merge'])
+
+
+  def stop_fetch_timer(self, fetch_timer: tuple[float, float]):
+    """
+    Adds the time of the block loop not spent merging to the fetch phase.
+    """
+    start, merge_seconds = fetch_timer
+    merged = self.telemetry.phases['merge'] - merge_seconds
+    self.telemetry.add_phase_time('fetch', max(0.0, time.monotonic() - start - merged))
+
+
+  def get_append_subset(self, subset: xr.Dataset, filepath: Path | str) -> tuple[xr.Dataset, dict[str, int] | None, object]:
+    """
+    Returns the time steps of the requested `subset` after the last one of
+    the existing output file `filepath`, their offsets in the file (see
+    NetcdfBlockWriter) and the last time step of the file. The whole subset
+    is returned, with no offsets, if the file does not exist yet.
+    Raises an ExtractionException if the subset cannot be appended to the
+    file: it is not a NetCDF file whose unlimited time dimension is the
+    one of the request, with the same variables and the same grid.
+    """
+    filepath = Path(filepath)
+    if not filepath.exists():
+      self.log(f'Nothing to append to, {filepath} does not exist. Extracting the whole request.')
+      return subset, None, None
+    time_dim = self.time_dim_name
+    if self.get_output_format(filepath) != 'netcdf':
+      raise ExtractionException(messages=f'Only NetCDF files can be appended to: {filepath}')
+    if time_dim is None:
+      raise ExtractionException(messages='The requested subset has no time dimension to append along.')
+    problems = []
+    with NETCDF_LOCK, wrangling.open_dataset(filepath, log_stream=self.log_stream) as existing:
+      if time_dim not in existing.encoding.get('unlimited_dims', set()):
+        problems.append(f'Its dimension "{time_dim}" is not unlimited.')
+      missing = [ v for v in subset.data_vars if v not in existing.data_vars ]
+      if missing:
+        problems.append(f'Variables not in the file: {missing}.')
+      for dim_name in subset.dims:
+        if dim_name == time_dim:
+          continue
+        if existing.sizes.get(dim_name) != subset.sizes[dim_name]:
+          problems.append(f'Its dimension "{dim_name}" has {existing.sizes.get(dim_name)} items, the request {subset.sizes[dim_name]}.')
+        elif dim_name in subset.indexes and dim_name in existing.indexes and not np.array_equal(existing.indexes[dim_name], subset.indexes[dim_name]):
+          problems.append(f'The coordinates of its dimension "{dim_name}" are not the requested ones.')
+      if not problems:
+        _, time_max = wrangling.get_time_bound_from_ds(dataset=existing)
+        n_times = int(existing.sizes[time_dim])
+    if problems:
+      raise ExtractionException(messages=[f'The request cannot be appended to {filepath}.'] + problems)
+    if time_max is not None:
+      subset = wrangling.select_times_after(subset, time_dim, time_max)
+    self.log(f'Appending {subset.sizes[time_dim]} time steps after {time_max} to {filepath} ({n_times} time steps).')
+    return subset, { time_dim: n_times }, time_max
+
+
+  def get_output_format(self, filepath: Path) -> str:
+    """
+    Returns self.output_format or, if it is not set, 'zarr' for paths with
+    the .zarr extension and 'netcdf' for the rest.
+    """
+    if self.output_format is not None:
+      if self.output_format not in ['netcdf', 'zarr']:
+        raise ExtractionException(messages=f'Unknown output format: {self.output_format}. Use "netcdf" or "zarr".')
+      return self.output_format
+    return 'zarr' if Path(filepath).suffix == '.zarr' else 'netcdf'
+
+
+  def log_stop(self):
+    if self.cancel_token.is_cancelled():
+      self.log('Extraction cancelled. Stopping extraction.')
+    else:
+      self.log('Maximum number of attempts was reached for a block extraction. Stopping extraction.')
+
+
+  def prepare_extraction(
+    self,
+    filepath: Path | str,
+    resume: bool = False,
+    cancel_token: CancelToken = None,
+    progress_callback: Callable[[ExtractionProgress], None] = None,
+    memory_budget: float = None, # MB
+    spill_dir: Path | str = None,
+    append: bool = False
+  ) -> ExtractionRun:
+    """
+    Plans the blocks of the extraction, sets up its manifest, its cancel
+    token and its progress, and creates (or opens, when resuming) the output
+    file.
+    If `filepath` is None, the output is a MemoryBlockWriter and there is no
+    manifest, unless the requested subset is bigger than `memory_budget` MB:
+    then it is spilled to a new file in `spill_dir` (the root of
+    self.staging_area or the tmp directory by default).
+    If self.staging_area is set, the tmp files of the blocks are created in
+    a new job of it instead of the directory of the output file.
+    If `append` is True, only the time steps after the last one of the
+    existing output file are planned, and the file is opened to append them.
     """
     self.verify_safety_for_processing()
+    self.take_cancel_token(cancel_token)
+    self.check_cancelled()
+    self.progress = None
+    self.telemetry = ExtractionTelemetry(metrics_hook=self.metrics_hook)
+    self.telemetry.add_phase_time('connect', self.connect_seconds)
+    self.connect_seconds = 0.0
+    plan_start = time.monotonic()
     self.log('starting extraction process.')
     req_max_size = self.req_max_size # MB
     # The use of the straightforward method was omitted due to
@@ -224,102 +1219,274 @@ class OpendapExtractor(BaseExtractor):
     # use days_ahead to move forward in the dataset
     # while (reference date) + days_ahead <= end date
 
-    # New way (actually implemented): Using blocks of times, since time dimension is an array.
+    # Second way: Using blocks of times, since time dimension is an array.
     # n_blocks = ceil(total_size / max_allowed). Use ceil to get an int as n_blocks
     # block_size = dataset.time.length / n_blocks
-    # start_index = 0
-    # end_index = 0
-    # done = False
-    # while Not done:
-    #  if time_index > dataset.time.length: time_index = dataset.time.length -1; done = True;
-    #  end_index = start_index + block_size
-    #  exec_straction(start_index, end_index);
-    #  start_index = end_index + 1
+    # It fails when a single time step is bigger than max_allowed or when
+    # there is no time dimension.
+
+    # New way (actually implemented): the subset is tiled across any of its
+    # dimensions (see processing.planning). The outermost dimensions in the
+    # storage order are cut first, the innermost ones are kept whole as long
+    # as the blocks fit in max_allowed.
     
     # Computing parameters.
-    subset = wrangling.slice_dice(self.dataset, self.dim_constraints, self.requested_vars, squeeze=False)
-    time_dim, self.time_dim_name = wrangling.get_time_dim(subset)
-    if time_dim is None:
-      raise ExtractionException(messages='No time dimension found in extraction process. Cannot proceed.')
-    time_arr = time_dim.values
-    request_size = self.get_size(SizeUnit.MEGA_BYTE).size
-    n_blocks = int(np.ceil(request_size / req_max_size))
-    dim_time_len = len(time_arr)
-    block_size = int(np.ceil(dim_time_len / n_blocks))
-    n_blocks = int(np.ceil(dim_time_len / block_size)) # Adjustment to reflect the actual number of blocks due to previous rounding.
-    start_index = 0
-    end_index = 0
-    self.log(f'Split parameters: request_size={request_size}; req_max_size={req_max_size}; n_blocks={n_blocks}; dim_time.length={dim_time_len}; block_size={block_size}.')
+    subset = wrangling.slice_dice(self.dataset, self.dim_constraints, self.requested_vars, squeeze=False, index=self.coordinate_index)
+    _, self.time_dim_name = wrangling.get_time_dim(subset)
+    append_offsets, self.append_after = None, None
+    if append:
+      subset, append_offsets, self.append_after = self.get_append_subset(subset, filepath)
+    request_size = subset.nbytes / 1e6
+    storage_order = planning.get_storage_order(subset)
+    dim_lens = { d: int(subset.sizes[d]) for d in storage_order }
+    chunks = planning.get_chunk_sizes(subset)
+    offsets = planning.get_index_offsets(self.dataset, subset)
+    # Blocks are planned with the largest size the adaptive controller can
+    # reach, and downloaded in parts of its current size.
+    max_block_size = self.get_max_block_size() # MB
+    min_block_size = min(self.min_block_size or req_max_size / 64, req_max_size) # MB
+    self.size_controller = AdaptiveSizeController(
+      size=req_max_size * 1e6,
+      min_size=min_block_size * 1e6,
+      max_size=max_block_size * 1e6)
+    blocks = planning.plan_blocks(subset, max_block_size * 1e6, order=storage_order, chunks=chunks, offsets=offsets)
+    if append_offsets is not None and subset.sizes[self.time_dim_name] == 0:
+      blocks = []
+    n_blocks = len(blocks)
+    block_shape = planning.get_block_shape(subset, max_block_size * 1e6, order=storage_order, chunks=chunks)
+    self.log(f'Split parameters: request_size={request_size}; req_max_size={req_max_size}; max_block_size={max_block_size}; n_blocks={n_blocks}; storage_order={storage_order}; block_shape={block_shape}; max_workers={self.max_workers}.')
+    self.chunk_report = planning.get_chunk_report(blocks, dim_lens, chunks, offsets)
+    self.log(f'Chunk report: {self.chunk_report}')
+    cache_keys = self.get_block_cache_keys(subset, blocks)
 
     # Loop setup.
+    if filepath is None:
+      if memory_budget is None or request_size <= memory_budget:
+        self.log(f'Assembling the extraction in memory: request_size={request_size}MB; memory_budget={memory_budget}MB.')
+        writer = MemoryBlockWriter(subset)
+        writer.create()
+        self.start_progress(blocks, set(), progress_callback)
+        self.__worker_local = threading.local()
+        self.telemetry.add_phase_time('plan', time.monotonic() - plan_start)
+        return ExtractionRun(
+          filepath=None,
+          download_dir=None,
+          subset=subset,
+          blocks=blocks,
+          manifest=None,
+          merged_keys=set(),
+          writer=writer,
+          cache_keys=cache_keys)
+      if spill_dir is None:
+        spill_dir = self.staging_area.root if self.staging_area is not None else tempfile.gettempdir()
+      filepath = Path(spill_dir, f'siaextractlib_spill_{uuid.uuid4().hex}.nc')
+      self.log(f'The request ({request_size}MB) exceeds the memory budget ({memory_budget}MB). Spilling it to {filepath}.')
     if type(filepath) is str:
       filepath = Path(filepath)
+    signature = self.get_request_signature()
+    if append_offsets is not None:
+      # Blocks are numbered from the end of the file: a manifest of another
+      # append does not apply.
+      signature['append_after'] = str(self.append_after)
+    manifest = BlockManifest(BlockManifest.path_for(filepath), signature=signature)
+    merged_keys = set()
+    loaded = resume and manifest.load()
+    if loaded and not manifest.matches_plan(set([ b.get_key() for b in blocks ])):
+      self.log(f'The previous run of this request was planned with other blocks: {manifest.path}.')
+      loaded = False
+    if loaded:
+      self.log(f'Resuming extraction from manifest: {manifest.path}')
+      if filepath.exists():
+        merged_keys = manifest.get_keys(BlockStatus.MERGED)
+    elif resume:
+      self.log(f'No manifest of a previous run found for this request: {manifest.path}. Starting from the first block.')
+      # The blocks of another layout can not be merged with these ones.
+      manifest.discard()
+    manifest.save()
+
+    # Blocks are written into the output file as soon as they and the blocks
+    # before them are extracted, so the file never has gaps and the blocks
+    # are not merged in a second pass. When the blocks are cut along several
+    # dimensions, they are written by complete rows of the outermost cut
+    # dimension. Blocks extracted after a failed one stay on disk, recorded
+    # in the manifest, to be reused when the extraction is resumed.
+    # Zarr stores are written by the workers instead, every block into its
+    # own chunks, so there is nothing to merge.
+    if self.get_output_format(filepath) == 'zarr':
+      writer = ZarrBlockWriter(
+        filepath,
+        template=subset,
+        blocks=blocks,
+        output_encoding=self.output_encoding,
+        time_dim=self.time_dim_name)
+    else:
+      writer = NetcdfBlockWriter(
+        filepath,
+        template=subset,
+        unlimited_dims=[self.time_dim_name] if self.time_dim_name else [],
+        output_encoding=self.output_encoding,
+        time_dim=self.time_dim_name,
+        offsets=append_offsets)
+    if merged_keys:
+      self.log(f'Blocks already merged into {filepath}: {len(merged_keys)}/{n_blocks}.')
+      writer.open()
+    elif append_offsets is not None:
+      writer.open()
+    else:
+      writer.create()
+    # The staging job is created last, so it is not left behind by a
+    # failed preparation.
+    staging_job = None
     download_dir = filepath.parent.absolute()
-    done = False
-    constraints = self.dim_constraints
-    block_count = 0
-    extraction_completed = True
-    while not done:
-      # Tmp file name
-      # datetime_str = datetime.now().strftime('%Y-%m-%d_%H:%M:%S.%f')
-      timestamp = time.time()
-      tmp_filename = f'tmp_dataset_{timestamp}.nc'
-      # Computing date range
-      end_index = start_index + (block_size - 1) # range is of size: block_size.
-      if end_index >= dim_time_len:
-        end_index = dim_time_len - 1
-        done = True # This is the last iteration
-        if start_index >= dim_time_len:
-          break # Dates out of range.
-      # Subsetting
-      constraints[self.time_dim_name] = slice(time_arr[start_index], time_arr[end_index])
-      subset = wrangling.slice_dice(self.dataset, constraints, self.requested_vars, squeeze=False)
-      file_details = None
-      block_attempt = 1
-      block_completed = False
-      while block_attempt <= self.max_attempts and not block_completed:
-        self.log(f'Extracting block: number={block_count + 1}/{n_blocks}; start_index={start_index}; end_index={end_index}; constraints={constraints}; attempt={block_attempt}/{self.max_attempts}.')
-        try:
-          file_details = self.fetch(subset, Path(download_dir, tmp_filename))
-          block_completed = True
-        except Exception as err:
-          self.log('An error has occurred while fetching block:')
-          traceback.print_exception(err, file=self.log_stream)
-          self.log('Retrying.')
-          block_attempt += 1
-      if block_completed:
-        self.tmp_files.append(file_details)
-        # Adjusting time index.
-        start_index = end_index + 1
-        # Other adjustments.
-        block_count += 1
-      else:
-        self.log('Maximum number of attempts was reached for a block extraction. Stopping extraction.')
-        self.log(f'Blocks extracted: {block_count}/{n_blocks}.')
-        done = True
-        extraction_completed = False
-    # Merging files.
-    self.log('Extraction done.')
-    if not len(self.tmp_files):
-      raise ExtractionException(messages='Maximum number of attempts was reached for the extraction of the first block. No data was extracted.')
-    self.log('Merging blocks.')
-    fielpaths = [ f.path for f in self.tmp_files ]
-    # dataset = xr.open_mfdataset(fielpaths, combine = 'by_coords')
-    dataset = wrangling.open_mfdataset(fielpaths, combine = 'by_coords', log_stream=self.log_stream)
-    dataset.to_netcdf(filepath)
-    time_min, time_max = wrangling.get_time_bound_from_ds(dataset=dataset)
-    dataset.close()
-    # Delete tmp files.
-    self.unlink_tmp_files()
-    # for f in self.tmp_files:
-    #   f.unlink()
-    # self.tmp_files = []
-    # Return data.
-    self.log('Extraction successfully completed.')
-    return ExtractionDetails(
-      description='dataset',
-      file=FileDetails(description='dataset', path=filepath),
-      complete=extraction_completed, time_min=time_min, time_max=time_max)
+    if self.staging_area is not None:
+      staging_job = self.staging_area.new_job(manifest_path=manifest.path)
+      download_dir = staging_job.path
+      self.log(f'Staging the tmp files of the blocks in {download_dir}. {self.staging_area}')
+    self.start_progress(blocks, merged_keys, progress_callback)
+    self.__worker_local = threading.local()
+    self.telemetry.add_phase_time('plan', time.monotonic() - plan_start)
+    return ExtractionRun(
+      filepath=filepath,
+      download_dir=download_dir,
+      subset=subset,
+      blocks=blocks,
+      manifest=manifest,
+      merged_keys=merged_keys,
+      writer=writer,
+      staging_job=staging_job,
+      cache_keys=cache_keys)
+
+
+  def start_progress(
+    self,
+    blocks: list[Block],
+    merged_keys: set[str],
+    progress_callback: Callable[[ExtractionProgress], None] = None
+  ):
+    """
+    Creates self.progress for `blocks`, counting the ones already merged.
+    """
+    self.progress = ExtractionProgress(
+      blocks_total=len(blocks),
+      bytes_total=sum([ b.nbytes for b in blocks ]),
+      callback=progress_callback)
+    merged_blocks = [ b for b in blocks if b.get_key() in merged_keys ]
+    self.progress.blocks_done = self.progress.blocks_merged = len(merged_blocks)
+    self.progress.bytes_done = sum([ b.nbytes for b in merged_blocks ])
+
+
+  def finish_extraction(
+    self,
+    run: ExtractionRun,
+    results: list[FileDetails | None],
+    block_count: int,
+    extraction_completed: bool
+  ) -> ExtractionDetails:
+    """
+    Keeps the blocks extracted but not merged (`results`) for a later resume,
+    removes the manifest of a completed extraction and describes the output
+    file. `block_count` is the number of blocks in the output file.
+    Raises an ExtractionCancelledException if the extraction was cancelled
+    before completing. Incomplete extractions in memory raise too.
+    """
+    try:
+      with self.telemetry.time_phase('cleanup'):
+        filepath, manifest = run.filepath, run.manifest
+        self.log('Extraction done.')
+        self.log(f'Adaptive block size: {self.size_controller}')
+        # Blocks extracted but not merged are kept for a later resume.
+        self.tmp_files = []
+        for file_details in results:
+          if file_details is not None and file_details.path is not None and Path(file_details.path).exists():
+            self.tmp_files.append(file_details)
+        cancelled = not extraction_completed and self.cancel_token.is_cancelled()
+        if not block_count and run.n_blocks:
+          run.writer.unlink()
+          if cancelled:
+            raise ExtractionCancelledException(messages='The extraction was cancelled before its first block was extracted. No data was extracted.')
+          raise ExtractionException(messages='Maximum number of attempts was reached for the extraction of the first block. No data was extracted.')
+        if manifest is None and not extraction_completed:
+          # Extractions in memory can not be resumed.
+          run.writer.unlink()
+          self.log(f'Blocks extracted: {block_count}/{run.n_blocks}. Discarding the data in memory.')
+          if cancelled:
+            raise ExtractionCancelledException(messages=f'The extraction was cancelled. Blocks extracted: {block_count}/{run.n_blocks}. The data in memory was discarded.')
+          raise ExtractionException(messages=f'Maximum number of attempts was reached for a block extraction. Blocks extracted: {block_count}/{run.n_blocks}. The data in memory was discarded.')
+        if cancelled:
+          self.log(f'Blocks merged: {block_count}/{run.n_blocks}.')
+          raise ExtractionCancelledException(messages=[
+            f'The extraction was cancelled. Blocks merged: {block_count}/{run.n_blocks}.',
+            f'Call it again with resume=True to resume it from its manifest: {manifest.path}'
+          ])
+        if extraction_completed:
+          if manifest is not None:
+            manifest.unlink()
+        else:
+          self.log(f'Blocks merged: {block_count}/{run.n_blocks}.')
+          self.log(f'Keeping extracted blocks and manifest to resume the extraction later: {manifest.path}')
+        with NETCDF_LOCK, run.writer.open_dataset(log_stream=self.log_stream) as dataset:
+          time_min, time_max = wrangling.get_time_bound_from_ds(dataset=dataset)
+        # Return data.
+        self.log('Extraction successfully completed.')
+        return ExtractionDetails(
+          description='dataset',
+          file=None if filepath is None else FileDetails(description='dataset', path=filepath),
+          complete=extraction_completed, time_min=time_min, time_max=time_max,
+          telemetry=self.telemetry)
+    finally:
+      self.telemetry.finish()
+      self.log(f'Telemetry: {self.telemetry}')
+
+
+  def get_extracted_dataset(self, run: ExtractionRun, details: ExtractionDetails) -> xr.Dataset:
+    """
+    Returns the dataset assembled by an extraction in memory, or its spill
+    file opened lazily.
+    """
+    if isinstance(run.writer, MemoryBlockWriter):
+      return run.writer.get_dataset()
+    if not details.complete:
+      raise ExtractionException(messages=[
+        f'Maximum number of attempts was reached for a block extraction. The spill file is incomplete: {details.file.path}',
+        f'It can be resumed with "sync_extract(...)" and resume=True.'
+      ])
+    self.log(f'Opening the spill file: {details.file.path}')
+    with NETCDF_LOCK:
+      return wrangling.open_dataset(details.file.path, log_stream=self.log_stream)
+
+
+  def merge_block(
+    self,
+    writer: NetcdfBlockWriter,
+    block: Block,
+    file_details: FileDetails,
+    filepath: Path,
+    manifest: BlockManifest,
+    staging_job: StagingJob = None
+  ):
+    """
+    Writes a extracted block into the output file and removes its tmp file.
+    """
+    self.log(f'Merging block {block.number + 1}: {file_details}')
+    start = time.monotonic()
+    with NETCDF_LOCK:
+      dataset = wrangling.open_dataset(file_details.path, log_stream=self.log_stream)
+      try:
+        writer.write(block, dataset)
+      finally:
+        dataset.close()
+    tmp_path = Path(file_details.path)
+    tmp_size = tmp_path.stat().st_size
+    file_details.unlink()
+    if staging_job is not None:
+      staging_job.release(tmp_path)
+    self.telemetry.add_tmp_bytes(-tmp_size)
+    seconds = time.monotonic() - start
+    self.telemetry.record_merge(block.number, seconds)
+    self.telemetry.add_phase_time('merge', seconds)
+    manifest.set_status(block.get_key(), BlockStatus.MERGED, path=filepath.absolute())
+    if self.progress is not None:
+      self.progress.add_merged()
 
 
   def __del__(self):
@@ -0,0 +1,100 @@
+# Standard
+import random
+import threading
+
+
+class Backoff:
+  """
+  Exponential backoff with full jitter. The delay before the attempt
+  number `attempt` is a random value between 0 and
+  `base * 2 ** (attempt - 2)`, capped at `cap` seconds, so the retries of
+  concurrent workers do not hit the server at the same time.
+  """
+  def __init__(
+    self,
+    base: float = 1.0, # seconds
+    cap: float = 60.0, # seconds
+    rng: random.Random = None
+  ):
+    self.base = base
+    self.cap = cap
+    self.rng = rng if rng is not None else random.Random()
+
+
+  def get_delay(self, attempt: int) -> float:
+    """
+    Returns the seconds to wait before the attempt number `attempt`.
+    The first attempt is not delayed.
+    """
+    if attempt <= 1 or self.base <= 0:
+      return 0.0
+    return self.rng.uniform(0, min(self.cap, self.base * 2 ** (attempt - 2)))
+
+
+class AdaptiveSizeController:
+  """
+  Keeps the size (in bytes) of the pieces a block is downloaded in. The
+  size is halved when a download fails and grows by `growth_factor` after
+  `growth_run` consecutive fast downloads (the ones that take at most
+  `target_seconds`), so it converges to what the server can sustain. The
+  size is kept between `min_size` and `max_size`.
+  It is shared by the worker threads of an extraction.
+  """
+  def __init__(
+    self,
+    size: float,
+    min_size: float,
+    max_size: float,
+    growth_factor: float = 1.25,
+    growth_run: int = 3,
+    target_seconds: float = 30.0
+  ):
+    self.min_size = min_size
+    self.max_size = max(max_size, min_size)
+    self.growth_factor = growth_factor
+    self.growth_run = growth_run
+    self.target_seconds = target_seconds
+    self.n_successes = 0
+    self.n_failures = 0
+    self.__size = min(max(size, self.min_size), self.max_size)
+    self.__run = 0
+    self.__lock = threading.Lock()
+
+
+  def __str__(self):
+    return f'size={self.get_size()}; min_size={self.min_size}; max_size={self.max_size}; successes={self.n_successes}; failures={self.n_failures}.'
+
+
+  def get_size(self) -> float:
+    with self.__lock:
+      return self.__size
+
+
+  def record_success(self, nbytes: float, seconds: float):
+    """
+    Records a download of `nbytes` bytes that took `seconds` seconds.
+    Only downloads of (about) the current size count towards growing it.
+    """
+    with self.__lock:
+      self.n_successes += 1
+      if seconds > self.target_seconds:
+        self.__run = 0
+        return
+      if nbytes * 2 < self.__size:
+        return
+      self.__run += 1
+      if self.__run >= self.growth_run:
+        self.__size = min(self.max_size, self.__size * self.growth_factor)
+        self.__run = 0
+
+
+  def record_failure(self, nbytes: float):
+    """
+    Records a failed download of `nbytes` bytes. The size becomes half of
+    the failed download, so concurrent failures of downloads of the same
+    size halve it only once.
+    """
+    with self.__lock:
+      self.n_failures += 1
+      self.__size = max(self.min_size, min(self.__size, nbytes / 2))
+      self.__run = 0
@@ -1,26 +1,419 @@
 # Standard
+import time
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 from collections.abc import Callable
-from threading import Thread
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
 # Own
-from siaextractlib.utils.exceptions import AsyncRunnerBusyException, DuplicatedAsyncRunnerException, AsyncRunnerMissingException
+from siaextractlib.utils.exceptions import DuplicatedAsyncRunnerException, AsyncRunnerMissingException, JobMissingException, ExtractionCancelledException
+
+
+class CancelToken:
+  """
+  Flag shared with a running process to ask it to stop. The process checks
+  it at safe points (e.g. between the blocks of an extraction).
+  """
+  def __init__(self) -> None:
+    self.__event = threading.Event()
+
+
+  def cancel(self) -> None:
+    self.__event.set()
+
+
+  def is_cancelled(self) -> bool:
+    return self.__event.is_set()
+
+
+  def sleep(self, seconds: float) -> bool:
+    """
+    Sleeps up to `seconds` seconds, waking up if the token is cancelled.
+    Returns True if it was cancelled.
+    """
+    return self.__event.wait(timeout=seconds)
+
+
+  def raise_if_cancelled(self, message: str = 'The process was cancelled.') -> None:
+    if self.is_cancelled():
+      raise ExtractionCancelledException(messages=message)
+
+
+class Job:
+  """
+  Handle of a function submitted to a Scheduler. The result (or the
+  exception) of the function is set in `future`. If the function is given
+  a `cancel_token`, the job can be cancelled while it runs too.
+  """
+  def __init__(
+    self,
+    job_id: int,
+    fn: Callable[..., any],
+    fn_kwargs: dict[str, any] = None,
+    name: str = None,
+    serial_key: any = None,
+    cancel_token: CancelToken = None
+  ) -> None:
+    self.id = job_id
+    self.fn = fn
+    self.fn_kwargs = fn_kwargs if fn_kwargs is not None else {}
+    self.name = name
+    self.serial_key = serial_key
+    self.cancel_token = cancel_token
+    self.future = Future()
+    # Set by the Scheduler that runs it.
+    self.scheduler: Scheduler = None
+    self.claimed = False
+
+
+  def __str__(self):
+    state = 'cancelled' if self.future.cancelled() else 'done' if self.future.done() else 'running' if self.future.running() else 'pending'
+    return f'Job {self.id} ({self.name}): {state}'
+
+
+  def done(self) -> bool:
+    return self.future.done()
+
+
+  def running(self) -> bool:
+    return self.future.running()
+
+
+  def cancel(self) -> bool:
+    """
+    Cancels the job if it has not started yet, or asks it to stop through
+    its cancel token if it is running. Returns True if it was cancelled.
+    """
+    if self.future.cancel():
+      return True
+    if self.cancel_token is not None and not self.future.done():
+      self.cancel_token.cancel()
+      return True
+    return False
+
+
+  def result(self, seconds: float = None) -> any:
+    """
+    Waits up to `seconds` seconds for the job and returns the result of
+    its function, or raises its exception.
+    """
+    self.wait(seconds=seconds)
+    return self.future.result(timeout=0 if seconds is not None else None)
+
+
+  def wait(self, seconds: float = None) -> None:
+    """
+    Waits up to `seconds` seconds for the job (see Scheduler.wait_job).
+    """
+    if self.scheduler is None:
+      wait_futures([self.future], timeout=seconds)
+    else:
+      self.scheduler.wait_job(self, seconds=seconds)
+
+
+class Scheduler:
+  """
+  Runs jobs on a bounded pool of `max_workers` threads, the concurrency
+  limit shared by every extractor that submits into it. Jobs wait in a
+  queue until a worker is free. Jobs with the same `serial_key` run one at
+  a time, in the order they were submitted, e.g. the jobs of an extractor,
+  whose state cannot be shared by two extractions at once.
+  A worker that waits for a job that has not started yet (e.g. a callback
+  that waits for another extraction) runs it itself, so the jobs waiting
+  for others do not take every worker and deadlock.
+  """
+  def __init__(self, max_workers: int = 8) -> None:
+    self.max_workers = max_workers
+    self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='siaextractlib')
+    self.__ids = itertools.count(1)
+    self.__jobs: dict[int, Job] = {}
+    self.__serial_queues: dict[any, deque[Job]] = {}
+    self.__lock = threading.Lock()
+    # Marks the threads running jobs of this scheduler.
+    self.__local = threading.local()
+
+
+  def submit(
+    self,
+    fn: Callable[..., any],
+    fn_kwargs: dict[str, any] = None,
+    name: str = None,
+    serial_key: any = None,
+    cancel_token: CancelToken = None
+  ) -> Job:
+    """
+    Queues `fn(**fn_kwargs)` and returns its Job. `cancel_token` is the
+    token checked by `fn`, if any, so the job can be cancelled while it runs.
+    """
+    with self.__lock:
+      job = Job(next(self.__ids), fn, fn_kwargs=fn_kwargs, name=name, serial_key=serial_key, cancel_token=cancel_token)
+      job.scheduler = self
+      self.__jobs[job.id] = job
+      if serial_key is not None:
+        queue = self.__serial_queues.setdefault(serial_key, deque())
+        queue.append(job)
+        if len(queue) > 1:
+          # It starts when the jobs before it finish.
+          return job
+      self.__executor.submit(self.__run, job)
+      return job
+
+
+  def __run(self, job: Job):
+    if self.__claim(job):
+      self.__execute(job)
+
+
+  def __claim(self, job: Job) -> bool:
+    """
+    Takes `job` to run it, if it can start now and no thread took it.
+    """
+    with self.__lock:
+      if job.claimed or job.id not in self.__jobs:
+        return False
+      if job.serial_key is not None and self.__serial_queues[job.serial_key][0] is not job:
+        # It starts when the jobs before it finish.
+        return False
+      job.claimed = True
+      return True
+
+
+  def __get_startable(self, job: Job) -> Job | None:
+    """
+    Claims and returns `job` or, if it waits in its serial queue, the first
+    job of the queue, if it has not started.
+    """
+    with self.__lock:
+      queue = self.__serial_queues.get(job.serial_key) if job.serial_key is not None else None
+      first = queue[0] if queue else job
+    return first if self.__claim(first) else None
+
+
+  def __execute(self, job: Job):
+    previous = getattr(self.__local, 'running', False)
+    self.__local.running = True
+    try:
+      self.__execute_job(job)
+    finally:
+      self.__local.running = previous
+
+
+  def __execute_job(self, job: Job):
+    if not job.future.set_running_or_notify_cancel():
+      self.__release(job)
+      return
+    # The job is released before its result is set, so it is not listed
+    # anymore once its result is available.
+    try:
+      result = job.fn(**job.fn_kwargs)
+    except BaseException as err:
+      self.__release(job)
+      job.future.set_exception(err)
+      return
+    self.__release(job)
+    job.future.set_result(result)
+
+
+  def __release(self, job: Job):
+    """
+    Forgets a finished job and starts the next one of its serial queue.
+    """
+    with self.__lock:
+      del self.__jobs[job.id]
+      if job.serial_key is None:
+        return
+      queue = self.__serial_queues[job.serial_key]
+      queue.popleft()
+      if queue:
+        self.__executor.submit(self.__run, queue[0])
+      else:
+        del self.__serial_queues[job.serial_key]
+
+
+  def wait_job(self, job: Job, seconds: float = None) -> None:
+    """
+    Waits up to `seconds` seconds for `job`. If the calling thread runs a
+    job of this scheduler, a `job` that has not started yet (or the jobs
+    before it in its serial queue) is run on it instead of waiting for a
+    free worker, since every worker may be waiting too.
+    """
+    deadline = None if seconds is None else time.monotonic() + seconds
+    while not job.done():
+      if getattr(self.__local, 'running', False):
+        # The job, or the one it waits for in its serial queue.
+        startable = self.__get_startable(job)
+        if startable is not None:
+          self.__execute(startable)
+          continue
+      timeout = 0.05 if deadline is None else min(0.05, deadline - time.monotonic())
+      if timeout <= 0:
+        return
+      wait_futures([job.future], timeout=timeout)
+
+
+  def get_job(self, job_id: int) -> Job:
+    """
+    Returns an unfinished job by its id.
+    """
+    with self.__lock:
+      if job_id not in self.__jobs:
+        raise JobMissingException(messages=f'Job {job_id} not found. It may have finished.')
+      return self.__jobs[job_id]
+
+
+  def get_jobs(self) -> list[Job]:
+    """
+    Returns the unfinished (pending or running) jobs.
+    """
+    with self.__lock:
+      return [ job for job in self.__jobs.values() if not job.future.cancelled() ]
+
+
+  def wait_all(self, seconds: float = None) -> None:
+    """
+    Waits until every job submitted so far finishes.
+    """
+    wait_jobs(self.get_jobs(), seconds=seconds)
+
+
+  def shutdown(self, wait: bool = True, cancel_pending: bool = False) -> None:
+    if cancel_pending:
+      for job in self.get_jobs():
+        job.cancel()
+    if wait:
+      self.wait_all()
+    self.__executor.shutdown(wait=wait)
+
+
+def wait_jobs(jobs: list[Job], seconds: float = None) -> None:
+  """
+  Waits up to `seconds` seconds in total until every job of `jobs` finishes.
+  """
+  deadline = None if seconds is None else time.monotonic() + seconds
+  for job in jobs:
+    job.wait(seconds=None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+
+# Scheduler used when none is given.
+_default_scheduler: Scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler() -> Scheduler:
+  """
+  Returns the process-wide Scheduler.
+  """
+  global _default_scheduler
+  with _default_scheduler_lock:
+    if _default_scheduler is None:
+      _default_scheduler = Scheduler()
+    return _default_scheduler
+
+
+def set_default_scheduler(scheduler: Scheduler) -> None:
+  """
+  Replaces the process-wide Scheduler, e.g. to change its concurrency limit.
+  Jobs already submitted to the previous one are not affected.
+  """
+  global _default_scheduler
+  with _default_scheduler_lock:
+    _default_scheduler = scheduler
+
+
+class ConcurrencyLimiter:
+  """
+  Limits the downloads running at once across the extractors that share
+  it: at most `max_concurrent` in total and at most `max_per_host` from the
+  same host (None for no limit). A download waits until both limits let
+  it through.
+  """
+  def __init__(self, max_concurrent: int = None, max_per_host: int = None) -> None:
+    self.max_concurrent = max_concurrent
+    self.max_per_host = max_per_host
+    self.running = 0
+    self.running_by_host: dict[str, int] = {}
+    self.__condition = threading.Condition()
+
+
+  def __str__(self):
+    return f'Concurrency limiter: max_concurrent={self.max_concurrent}; max_per_host={self.max_per_host}; running={self.running}.'
+
+
+  @staticmethod
+  def get_host(url: str) -> str:
+    return urlsplit(str(url)).netloc
+
+
+  def fits(self, host: str) -> bool:
+    if self.max_concurrent is not None and self.running >= self.max_concurrent:
+      return False
+    if self.max_per_host is not None and self.running_by_host.get(host, 0) >= self.max_per_host:
+      return False
+    return True
+
+
+  def acquire(self, url: str, cancel_token: CancelToken = None) -> None:
+    """
+    Waits until a download from `url` fits in the limits and counts it.
+    Raises an ExtractionCancelledException if `cancel_token` is cancelled
+    meanwhile.
+    """
+    host = self.get_host(url)
+    with self.__condition:
+      while not self.fits(host):
+        if cancel_token is not None:
+          cancel_token.raise_if_cancelled('The extraction was cancelled while waiting for a download slot.')
+        self.__condition.wait(timeout=0.1)
+      self.running += 1
+      self.running_by_host[host] = self.running_by_host.get(host, 0) + 1
+
+
+  def release(self, url: str) -> None:
+    host = self.get_host(url)
+    with self.__condition:
+      self.running -= 1
+      self.running_by_host[host] -= 1
+      if not self.running_by_host[host]:
+        del self.running_by_host[host]
+      self.__condition.notify_all()
+
+
+  @contextmanager
+  def slot(self, url: str, cancel_token: CancelToken = None):
+    """
+    Holds a download slot for `url` during the `with` statement.
+    """
+    self.acquire(url, cancel_token=cancel_token)
+    try:
+      yield
+    finally:
+      self.release(url)
 
 
 class AsyncRunner:
   """
-  Runs a synchronous function as an asynchronous one on another thread. Its return values are forwared to the callback.
+  Runs a synchronous function as an asynchronous one, as a job of a
+  Scheduler (the process-wide one by default). Its return values are forwared
+  to the callback. Calls made while a previous one is still running are
+  queued and run after it.
   """
   def __init__(
     self,
     sync_fn: Callable[..., None],
     sync_fn_kwargs: dict[str, any] = {},
     success_callback: Callable[..., None] = None,
-    failure_callback: Callable[[Exception], None] = None
+    failure_callback: Callable[[Exception], None] = None,
+    scheduler: Scheduler = None
   ) -> None:
     self.sync_fn = sync_fn
     self.success_callback = success_callback
     self.failure_callback = failure_callback
     self.sync_fn_kwargs = sync_fn_kwargs
-    self.__thread: Thread = None
+    self.scheduler = scheduler
+    self.__jobs: list[Job] = []
+    self.__lock = threading.Lock()
   
 
   def validate_safe_execution(self):
@@ -35,46 +428,77 @@ class AsyncRunner:
       raise TypeError('Parameter "failure_callback" must be callable and take as argument an instance of a subclass of BaseException')
     if type(self.sync_fn_kwargs) is not dict:
       raise TypeError('Parameter "sync_fn_kwargs" must be a dict[str, any].')
-    # Originally placed in "run" method.
-    if self.__thread is not None and self.__thread.is_alive():
-      raise AsyncRunnerBusyException('An asynchronous process is still running. Just one async process is allowed per instance.')
 
 
-  def wrapper_fn(self):
+  def wrapper_fn(
+    self,
+    sync_fn: Callable[..., None],
+    sync_fn_kwargs: dict[str, any],
+    success_callback: Callable[..., None],
+    failure_callback: Callable[[Exception], None]
+  ):
     """
     A wrapper that runs the synchronous function. Its return value is captured
     and casted to a tuple if needed in order to forward it to the callback
-    as *args.
+    as *args. It is also returned, so it is the result of the job. Errors
+    are forwarded to the failure callback and raised again.
     """
     try:
-      result = self.sync_fn(**self.sync_fn_kwargs)
+      result = sync_fn(**sync_fn_kwargs)
       if result is None:
-        self.success_callback()
-        return
-      if type(result) is not tuple:
-        result = tuple([result])
-      self.success_callback(*result)
+        success_callback()
+        return result
+      args = result if type(result) is tuple else tuple([result])
+      success_callback(*args)
+      return result
     except BaseException as e:
-      self.failure_callback(e)
+      failure_callback(e)
+      raise
 
   
-  def run(self) -> Thread:
+  def run(self, cancel_token: CancelToken = None) -> Job:
     """
-    Creates the thread and runs the wrapper function there.
+    Submits the wrapper function to the scheduler. The function, its
+    arguments and the callbacks are taken as they are now, so they can be
+    changed for the next call while this one is queued or running.
+    `cancel_token` is the token checked by the function, if any.
     """
     self.validate_safe_execution()
-    th = Thread(target=self.wrapper_fn)
-    th.start()
-    self.__thread = th
-    return th
+    scheduler = self.scheduler if self.scheduler is not None else get_default_scheduler()
+    job = scheduler.submit(
+      self.wrapper_fn,
+      fn_kwargs={
+        'sync_fn': self.sync_fn,
+        'sync_fn_kwargs': dict(self.sync_fn_kwargs),
+        'success_callback': self.success_callback,
+        'failure_callback': self.failure_callback
+      },
+      name=getattr(self.sync_fn, '__name__', None),
+      serial_key=self,
+      cancel_token=cancel_token)
+    with self.__lock:
+      self.__jobs = [ j for j in self.__jobs if not j.done() ] + [job]
+    return job
   
 
+  def get_jobs(self) -> list[Job]:
+    """
+    Returns the unfinished jobs of this runner.
+    """
+    with self.__lock:
+      self.__jobs = [ j for j in self.__jobs if not j.done() ]
+      return list(self.__jobs)
+
+
   def wait(self, seconds: float = None) -> None:
-    self.__thread.join(timeout=seconds)
+    """
+    Waits until every call made so far finishes.
+    """
+    wait_jobs(self.get_jobs(), seconds=seconds)
   
 
   def still_working(self) -> bool:
-    return self.__thread.is_alive()
+    return len(self.get_jobs()) > 0
 
 
 class AsyncRunnerManager:
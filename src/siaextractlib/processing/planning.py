@@ -0,0 +1,385 @@
+# Standard
+import itertools
+# Third party
+import numpy as np
+import xarray as xr
+
+
+class Block:
+  """
+  A piece of a request. `slices` maps the names of the cut dimensions to
+  integer index slices relative to the requested subset. Dimensions not
+  in `slices` are requested whole.
+  """
+  def __init__(
+    self,
+    number: int,
+    slices: dict[str, slice],
+    nbytes: int = None,
+    n_chunks: int = None
+  ):
+    self.number = number
+    self.slices = slices
+    self.nbytes = nbytes
+    self.n_chunks = n_chunks
+
+
+  def __str__(self):
+    return f'Block {self.number}: {self.get_key()} ({self.nbytes} bytes, {self.n_chunks} chunks)'
+
+
+  def get_key(self) -> str:
+    """
+    Returns a text representation of the slices that identifies the block
+    within its request.
+    """
+    if not self.slices:
+      return 'all'
+    return ','.join([ f'{d}={s.start}:{s.stop}' for d, s in self.slices.items() ])
+
+
+  def get_shape(self, dim_lens: dict[str, int]) -> dict[str, int]:
+    """
+    Returns the length of every dimension in the block.
+    """
+    shape = {}
+    for dim_name, dim_len in dim_lens.items():
+      if dim_name in self.slices:
+        s = self.slices[dim_name]
+        shape[dim_name] = s.stop - s.start
+      else:
+        shape[dim_name] = dim_len
+    return shape
+
+
+def get_storage_order(dataset: xr.Dataset) -> list[str]:
+  """
+  Returns the dimension names from the outermost to the innermost, as the
+  largest variable is laid out on the server (C order). Dimensions not
+  used by that variable are placed first.
+  """
+  largest = None
+  for var in dataset.data_vars.values():
+    if largest is None or var.size > largest.size:
+      largest = var
+  order = list(largest.dims) if largest is not None else []
+  outer = [ d for d in dataset.dims if d not in order ]
+  return outer + order
+
+
+def estimate_nbytes(dataset: xr.Dataset, shape: dict[str, int]) -> int:
+  """
+  Estimates the size in bytes of all the variables of `dataset` when its
+  dimensions have the lengths in `shape`.
+  """
+  nbytes = 0
+  for var in dataset.variables.values():
+    n_items = 1
+    for dim_name in var.dims:
+      n_items *= shape[dim_name]
+    nbytes += n_items * var.dtype.itemsize
+  return nbytes
+
+
+def get_chunk_sizes(dataset: xr.Dataset) -> dict[str, int]:
+  """
+  Returns the chunk length of every dimension of the largest variable as
+  it is stored on the server. THREDDS exposes it in the DAS as the
+  `_ChunkSizes` attribute. The encoding of local NetCDF files is used too.
+  Returns an empty dict if the storage is not chunked or it is unknown.
+  """
+  largest = None
+  for var in dataset.data_vars.values():
+    if largest is None or var.size > largest.size:
+      largest = var
+  if largest is None:
+    return {}
+  chunk_sizes = largest.attrs.get('_ChunkSizes', largest.encoding.get('chunksizes'))
+  if chunk_sizes is None:
+    return {}
+  chunk_sizes = np.atleast_1d(chunk_sizes).astype(int).tolist()
+  if len(chunk_sizes) != len(largest.dims):
+    return {}
+  return { d: c for d, c in zip(largest.dims, chunk_sizes) if c > 0 }
+
+
+def get_index_offsets(dataset: xr.Dataset, subset: xr.Dataset) -> dict[str, int]:
+  """
+  Returns the position in `dataset` of the first item of `subset` for every
+  indexed dimension of the subset, so the subset can be aligned with the
+  storage chunks of the dataset.
+  """
+  offsets = {}
+  for dim_name in subset.dims:
+    if dim_name not in dataset.indexes or dim_name not in subset.indexes or subset.sizes[dim_name] == 0:
+      continue
+    position = dataset.indexes[dim_name].get_indexer(subset.indexes[dim_name][:1])[0]
+    if position >= 0:
+      offsets[dim_name] = int(position)
+  return offsets
+
+
+def get_index_positions(dataset: xr.Dataset, subset: xr.Dataset) -> dict[str, np.ndarray]:
+  """
+  Returns the positions in `dataset` of the items of `subset` for every
+  dimension of the subset (-1 for items not found). Dimensions without an
+  index are assumed to be requested whole.
+  """
+  positions = {}
+  for dim_name in subset.dims:
+    if dim_name in dataset.indexes and dim_name in subset.indexes:
+      positions[dim_name] = dataset.indexes[dim_name].get_indexer(subset.indexes[dim_name])
+    else:
+      positions[dim_name] = np.arange(subset.sizes[dim_name])
+  return positions
+
+
+def get_block_ranges(block: Block, positions: dict[str, np.ndarray]) -> dict[str, list[list[int]]] | None:
+  """
+  Returns the positions in the dataset of the items of `block` for every
+  dimension (see "get_index_positions(...)"), as runs of contiguous
+  positions: [[start, stop], ...]. Returns None if any item was not found
+  in the dataset.
+  """
+  ranges = {}
+  for dim_name, dim_positions in positions.items():
+    dim_positions = dim_positions[block.slices.get(dim_name, slice(None))]
+    if (dim_positions < 0).any():
+      return None
+    if len(dim_positions) > 1 and (np.diff(dim_positions) < 0).all():
+      # Descending coordinates are subset in ascending order of their
+      # values (see wrangling.slice_dice).
+      dim_positions = dim_positions[::-1]
+    breaks = np.flatnonzero(np.diff(dim_positions) != 1) + 1
+    ranges[dim_name] = [ [int(run[0]), int(run[-1]) + 1] for run in np.split(dim_positions, breaks) if len(run) > 0 ]
+  return ranges
+
+
+def get_block_shape(
+  dataset: xr.Dataset,
+  max_bytes: float,
+  order: list[str] = None,
+  chunks: dict[str, int] = None
+) -> dict[str, int]:
+  """
+  Computes the block lengths for every dimension so a block does not
+  exceed `max_bytes`. The outermost dimensions are cut first and the
+  innermost ones are kept whole as long as possible, so every block reads
+  contiguous runs of the server storage. If the `chunks` of the storage
+  are given, the length of the cut dimension is a multiple of its chunk
+  length whenever a chunk fits in a block.
+  """
+  if order is None:
+    order = get_storage_order(dataset)
+  if chunks is None:
+    chunks = {}
+  dim_lens = { d: int(dataset.sizes[d]) for d in order }
+  shape = dict(dim_lens)
+  if estimate_nbytes(dataset, shape) <= max_bytes:
+    return shape
+  for dim_name in order:
+    shape[dim_name] = 0
+    fixed_bytes = estimate_nbytes(dataset, shape)
+    shape[dim_name] = 1
+    step_bytes = estimate_nbytes(dataset, shape) - fixed_bytes
+    max_len = int((max_bytes - fixed_bytes) // step_bytes) if step_bytes > 0 else dim_lens[dim_name]
+    if max_len >= 1:
+      max_len = min(max_len, dim_lens[dim_name])
+      chunk_len = chunks.get(dim_name, 1)
+      if 1 < chunk_len <= max_len:
+        shape[dim_name] = (max_len // chunk_len) * chunk_len
+      else:
+        # Balance the blocks along this dimension.
+        n_cuts = int(np.ceil(dim_lens[dim_name] / max_len))
+        shape[dim_name] = int(np.ceil(dim_lens[dim_name] / n_cuts))
+      return shape
+  # Not even a single item of every dimension fits. Nothing else to cut.
+  return shape
+
+
+def plan_blocks(
+  dataset: xr.Dataset,
+  max_bytes: float,
+  order: list[str] = None,
+  chunks: dict[str, int] = None,
+  offsets: dict[str, int] = None
+) -> list[Block]:
+  """
+  Tiles the subset `dataset` across any combination of its dimensions in
+  blocks of at most `max_bytes` bytes. The blocks are returned in storage
+  order. If the `chunks` of the storage and the `offsets` of the subset in
+  the remote dataset are given, block boundaries fall on chunk boundaries.
+  """
+  if order is None:
+    order = get_storage_order(dataset)
+  dim_lens = { d: int(dataset.sizes[d]) for d in order }
+  block_shape = get_block_shape(dataset, max_bytes, order=order, chunks=chunks)
+  return tile_blocks(dataset, dim_lens, block_shape, chunks=chunks, offsets=offsets)
+
+
+def split_block(
+  dataset: xr.Dataset,
+  block: Block,
+  max_bytes: float,
+  order: list[str] = None,
+  chunks: dict[str, int] = None,
+  offsets: dict[str, int] = None
+) -> list[Block]:
+  """
+  Tiles `block` of the subset `dataset` in blocks of at most `max_bytes`
+  bytes. The slices of the new blocks are relative to `dataset`, as the
+  ones of `block`, and keep the chunk alignment if `chunks` and `offsets`
+  are given.
+  """
+  if order is None:
+    order = get_storage_order(dataset)
+  if offsets is None:
+    offsets = {}
+  piece = dataset.isel(block.slices)
+  starts = { d: s.start for d, s in block.slices.items() }
+  piece_offsets = { d: offset + starts.get(d, 0) for d, offset in offsets.items() }
+  dim_lens = { d: int(dataset.sizes[d]) for d in order }
+  parts = []
+  for part in plan_blocks(piece, max_bytes, order=order, chunks=chunks, offsets=piece_offsets):
+    slices = dict(block.slices)
+    for dim_name, s in part.slices.items():
+      start = starts.get(dim_name, 0)
+      slices[dim_name] = slice(start + s.start, start + s.stop)
+    # Keep the slices in storage order.
+    slices = { d: slices[d] for d in order if d in slices }
+    parts.append(Block(
+      number=len(parts),
+      slices=slices,
+      nbytes=part.nbytes,
+      n_chunks=count_chunks(Block(number=0, slices=slices), dim_lens, chunks, offsets)))
+  return parts
+
+
+def get_cut_points(dim_len: int, step: int, offset: int = 0) -> list[int]:
+  """
+  Returns the start of every block along a dimension of `dim_len` items
+  that starts at `offset` in the remote dataset. Blocks end at multiples
+  of `step` in the remote dataset, so the first one may be shorter.
+  """
+  first = step - (offset % step)
+  return [0] + list(range(first, dim_len, step)) if first < dim_len else [0]
+
+
+def tile_blocks(
+  dataset: xr.Dataset,
+  dim_lens: dict[str, int],
+  block_shape: dict[str, int],
+  chunks: dict[str, int] = None,
+  offsets: dict[str, int] = None
+) -> list[Block]:
+  """
+  Generates the blocks of `block_shape` lengths that cover the dimensions
+  of `dim_lens`. The iteration follows the order of `dim_lens`. Cut
+  dimensions whose block length is a multiple of their chunk length are
+  aligned with the chunks using the `offsets` of the subset.
+  """
+  if chunks is None:
+    chunks = {}
+  if offsets is None:
+    offsets = {}
+  cut_dims = [ d for d in dim_lens if block_shape[d] < dim_lens[d] ]
+  ranges = []
+  for dim_name in cut_dims:
+    dim_len = dim_lens[dim_name]
+    step = block_shape[dim_name]
+    chunk_len = chunks.get(dim_name, 1)
+    offset = offsets.get(dim_name, 0) if chunk_len > 1 and step % chunk_len == 0 else 0
+    starts = get_cut_points(dim_len, step, offset)
+    ranges.append([ slice(start, stop) for start, stop in zip(starts, starts[1:] + [dim_len]) ])
+  blocks = []
+  for number, slices in enumerate(itertools.product(*ranges)):
+    block = Block(number=number, slices=dict(zip(cut_dims, slices)))
+    block.nbytes = estimate_nbytes(dataset, block.get_shape(dim_lens))
+    block.n_chunks = count_chunks(block, dim_lens, chunks, offsets)
+    blocks.append(block)
+  return blocks
+
+
+def count_chunks(
+  block: Block,
+  dim_lens: dict[str, int],
+  chunks: dict[str, int],
+  offsets: dict[str, int] = None
+) -> int:
+  """
+  Returns the number of storage chunks the block touches.
+  """
+  if offsets is None:
+    offsets = {}
+  n_chunks = 1
+  for dim_name, dim_len in dim_lens.items():
+    chunk_len = chunks.get(dim_name, 1) if chunks else 1
+    offset = offsets.get(dim_name, 0)
+    s = block.slices.get(dim_name, slice(0, dim_len))
+    if s.stop <= s.start:
+      return 0
+    first_chunk = (offset + s.start) // chunk_len
+    last_chunk = (offset + s.stop - 1) // chunk_len
+    n_chunks *= last_chunk - first_chunk + 1
+  return n_chunks
+
+
+class ChunkReport:
+  """
+  Summary of how the blocks of a plan overlap the storage chunks of the
+  remote dataset. Chunks touched by more than one block are read (and
+  decompressed) more than once by the server.
+  """
+  def __init__(
+    self,
+    chunks: dict[str, int],
+    chunks_per_block: list[int],
+    unique_chunks: int
+  ):
+    self.chunks = chunks
+    self.chunks_per_block = chunks_per_block
+    self.unique_chunks = unique_chunks
+
+
+  def __str__(self):
+    return f'chunk_sizes={self.chunks}; chunks_per_block={self.chunks_per_block}; chunks_read={self.get_chunks_read()}; unique_chunks={self.unique_chunks}; redundant_reads={self.get_redundant_reads()}.'
+
+
+  def get_chunks_read(self) -> int:
+    return int(sum(self.chunks_per_block))
+
+
+  def get_redundant_reads(self) -> int:
+    return self.get_chunks_read() - self.unique_chunks
+
+
+def get_chunk_report(
+  blocks: list[Block],
+  dim_lens: dict[str, int],
+  chunks: dict[str, int],
+  offsets: dict[str, int] = None
+) -> ChunkReport:
+  """
+  Builds the ChunkReport of a plan.
+  """
+  whole = Block(number=0, slices={})
+  return ChunkReport(
+    chunks=chunks,
+    chunks_per_block=[ count_chunks(b, dim_lens, chunks, offsets) for b in blocks ],
+    unique_chunks=count_chunks(whole, dim_lens, chunks, offsets))
+
+
+def get_rows(blocks: list[Block]) -> list[list[Block]]:
+  """
+  Groups the blocks that share the slice of the outermost cut dimension.
+  Every group (row) forms a gap-free hyperslab of the subset.
+  """
+  rows: list[list[Block]] = []
+  outer_slice = None
+  for block in blocks:
+    block_outer_slice = next(iter(block.slices.values()), None)
+    if not rows or block_outer_slice != outer_slice:
+      rows.append([])
+      outer_slice = block_outer_slice
+    rows[-1].append(block)
+  return rows
@@ -1,66 +1,283 @@
 # Standard
 import re
 import sys
+import glob
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 # Third party
 import xarray as xr
 import numpy as np
-from cftime import num2pydate
+import pandas as pd
+from cftime import num2date
+# Own
+from siaextractlib.utils.locks import NETCDF_LOCK
+
+
+class CoordinateIndex:
+  """
+  Sorted copies of the indexed (1-D) dimension coordinates of a dataset.
+  It is built once per dataset and reused to turn value constraints into
+  integer positions, without label lookups on the dataset. Positions are
+  returned in ascending order of their values, also for descending
+  coordinates (e.g. latitudes from north to south).
+  """
+  def __init__(self, dataset: xr.Dataset | xr.DataArray):
+    self.__indexes = {}
+    for dim_name in dataset.dims:
+      if dim_name not in dataset.indexes:
+        continue
+      index = dataset.indexes[dim_name]
+      values = np.asarray(index)
+      sorter = np.argsort(values, kind='stable')
+      self.__indexes[dim_name] = (index, values[sorter], sorter)
+
+
+  def has_dim(self, dim_name: str) -> bool:
+    return dim_name in self.__indexes
+
+
+  def get_slice(self, dim_name: str, constraint: slice) -> slice:
+    """
+    Returns the positions of the values between the bounds of the slice
+    (both included), as `xr.Dataset.sel` does. On descending coordinates
+    they are returned backwards (a negative step).
+    """
+    index = self.__indexes[dim_name][0]
+    start, stop = index.slice_locs(constraint.start, constraint.stop)
+    if not index.is_monotonic_decreasing or index.is_monotonic_increasing:
+      return slice(int(start), int(stop), constraint.step)
+    positions = range(int(start), int(stop), constraint.step or 1)
+    if len(positions) == 0:
+      return slice(0, 0)
+    return slice(positions[-1], positions[0] - 1 if positions[0] > 0 else None, -positions.step)
+
+
+  def get_nearest(self, dim_name: str, values: list) -> np.ndarray | slice:
+    """
+    Returns the unique positions of the nearest values to `values`, in
+    ascending order of their values. Ties are resolved to the larger value.
+    Contiguous positions are returned as a slice.
+    """
+    _, sorted_values, sorter = self.__indexes[dim_name]
+    if sorted_values.dtype.kind == 'M':
+      targets = np.array([ pd.Timestamp(value).to_datetime64() for value in values ]).astype(sorted_values.dtype)
+    elif sorted_values.dtype.kind in 'iuf':
+      targets = np.asarray(values, dtype='float64')
+    else:
+      targets = np.asarray(values, dtype=sorted_values.dtype)
+    last = len(sorted_values) - 1
+    right = np.clip(np.searchsorted(sorted_values, targets, side='left'), 0, last)
+    left = np.clip(right - 1, 0, last)
+    use_left = abs(targets - sorted_values[left]) < abs(sorted_values[right] - targets)
+    positions = sorter[np.unique(np.where(use_left, left, right))]
+    if len(positions) > 1 and positions[-1] - positions[0] == len(positions) - 1:
+      return slice(int(positions[0]), int(positions[-1]) + 1)
+    if len(positions) > 1 and positions[0] - positions[-1] == len(positions) - 1:
+      return slice(int(positions[0]), int(positions[-1]) - 1 if positions[-1] > 0 else None, -1)
+    return positions
+
+
+  def resolve(self, dim_name: str, constraint: slice | list) -> slice | np.ndarray:
+    """
+    Resolves a constraint as `slice_dice` does: slices by their bounds and
+    any other value (or list of values) by the nearest values.
+    """
+    if not self.has_dim(dim_name):
+      raise KeyError(f'No index found for dimension "{dim_name}".')
+    if type(constraint) is slice:
+      return self.get_slice(dim_name, constraint)
+    if type(constraint) is not list:
+      # Make it a list.
+      constraint = [ constraint ]
+    return self.get_nearest(dim_name, constraint)
+
+
+  def get_len(self, dim_name: str, constraint: slice | list) -> int:
+    """
+    Returns the number of positions a constraint resolves to.
+    """
+    positions = self.resolve(dim_name, constraint)
+    if type(positions) is slice:
+      return len(range(*positions.indices(len(self.__indexes[dim_name][0]))))
+    return len(positions)
+
+
+  def get_lens(self, dim_name: str, constraints: list) -> np.ndarray:
+    """
+    Vectorised `get_len` for many constraints on the same dimension. A None
+    constraint takes the whole dimension. Slices with numeric bounds on a
+    monotonic coordinate are resolved with a single `searchsorted` call.
+    """
+    index, sorted_values, _ = self.__indexes[dim_name]
+    lens = np.full(len(constraints), len(index), dtype='int64')
+    vectorised = []
+    for i, constraint in enumerate(constraints):
+      if constraint is None:
+        continue
+      if (
+        type(constraint) is slice and constraint.step is None
+        and sorted_values.dtype.kind in 'iuf'
+        and (index.is_monotonic_increasing or index.is_monotonic_decreasing)
+        and all([ b is None or isinstance(b, (int, float, np.number)) for b in [constraint.start, constraint.stop] ])
+      ):
+        vectorised.append(i)
+      else:
+        lens[i] = self.get_len(dim_name, constraint)
+    if not vectorised:
+      return lens
+    starts = np.array([ -np.inf if constraints[i].start is None else constraints[i].start for i in vectorised ], dtype='float64')
+    stops = np.array([ np.inf if constraints[i].stop is None else constraints[i].stop for i in vectorised ], dtype='float64')
+    if index.is_monotonic_increasing:
+      lows, highs = starts, stops
+    else:
+      lows, highs = np.where(np.isinf(stops), -np.inf, stops), np.where(np.isinf(starts), np.inf, starts)
+    counts = np.searchsorted(sorted_values, highs, side='right') - np.searchsorted(sorted_values, lows, side='left')
+    lens[vectorised] = np.maximum(counts, 0)
+    return lens
 
 
 def slice_dice(
   dataset: xr.DataArray,
   dim_constraints: dict[str, slice|list],
   var: str | list = None,
-  squeeze = True
+  squeeze = True,
+  index: CoordinateIndex = None
 ) -> xr.DataArray:
   """
   Makes a subset by dimension contraints and a selected (and optional)
   list of variables. A single variable name can be passed as a string.
   The dimensions take the nearest values to the specified. Unique values
   in dimensions are warranteed.
+  The constraints are resolved to integer positions in a single pass with
+  `index`, which should be reused for every call on the same dataset.
   """
+  if index is None:
+    index = CoordinateIndex(dataset)
+  if dim_constraints is None:
+    dim_constraints = {}
+
   # Initializing.
   subset = dataset
 
   # Selecting variables of interest.
   if var is not None:
     subset = dataset[var]
-  
-  constraints_w_slices = {}
-  constraints_w_no_slices = {}
-  for dim_name in dim_constraints.keys():
-    if type(dim_constraints[dim_name]) is slice:
-      constraints_w_slices[dim_name] = dim_constraints[dim_name]
-    else:
-      if type(dim_constraints[dim_name]) is list:
-        constraints_w_no_slices[dim_name] = dim_constraints[dim_name]
-      else:
-        # Make it a list.
-        constraints_w_no_slices[dim_name] = [ dim_constraints[dim_name] ]
-  
-  # Apply dimension constraints
-  subset = subset.sel(constraints_w_no_slices, method = 'nearest')#.squeeze()
-  subset = subset.sel(constraints_w_slices)#.squeeze()
 
-  # Ensure unique values in constraints.
-  dims_unique_values = get_dim_unique_values(dataset=subset)
-  _dim_constraints = {}
-  for dim_name in dim_constraints.keys():
-    _dim_constraints[dim_name] = dims_unique_values[dim_name]
+  indexers = {}
+  label_constraints = {}
+  for dim_name, constraint in dim_constraints.items():
+    if not index.has_dim(dim_name):
+      # Not indexed. Let xarray resolve (or reject) it.
+      label_constraints[dim_name] = constraint
+    else:
+      indexers[dim_name] = index.resolve(dim_name, constraint)
 
-  # Subsetting again but with unique values in dimensions.
-  subset = dataset
-  # Selecting variables of interest.
-  if var is not None:
-    subset = dataset[var]
+  # Apply dimension constraints
+  subset = subset.isel(indexers)
+  if label_constraints:
+    subset = subset.sel(label_constraints)
   if squeeze:
-    subset = subset.sel(_dim_constraints).squeeze()
-  else:
-    subset = subset.sel(_dim_constraints)
+    subset = subset.squeeze()
 
   return subset
 
 
+class SizeEstimator:
+  """
+  Estimates the size in bytes of the subsets `slice_dice` would make
+  (without squeezing), from the shapes and dtypes of the variables and the
+  index ranges the constraints resolve to. No subset is built and no data
+  is read. The last `max_memo` results are memoised per (constraints,
+  variables), the least recently used ones are dropped.
+  """
+  def __init__(self, dataset: xr.Dataset, index: CoordinateIndex = None, max_memo: int = 256):
+    self.dataset = dataset
+    self.index = index if index is not None else CoordinateIndex(dataset)
+    self.max_memo = max_memo
+    self.__memo: OrderedDict[str, int] = OrderedDict()
+    self.__lock = threading.Lock()
+
+
+  def __len__(self):
+    return len(self.__memo)
+
+
+  def get_variables(self, var: str | list = None) -> list[xr.Variable]:
+    """
+    Returns the variables the size of a subset of `var` accounts for: the
+    selected variables and the coordinates along their dimensions.
+    """
+    if var is None:
+      return list(self.dataset.variables.values())
+    if type(var) is str:
+      # A DataArray. Its size does not include the coordinates.
+      return [ self.dataset.variables[var] ]
+    names = list(var)
+    dims = set()
+    for name in names:
+      dims.update(self.dataset[name].dims)
+    variables = [ self.dataset.variables[name] for name in names ]
+    for name, coord in self.dataset.coords.items():
+      if name not in names and set(coord.dims) <= dims:
+        variables.append(coord.variable)
+    return variables
+
+
+  def get_dim_lens(self, dim_constraints: dict[str, slice | list]) -> dict[str, int]:
+    dim_lens = dict(self.dataset.sizes)
+    if dim_constraints:
+      for dim_name, constraint in dim_constraints.items():
+        dim_lens[dim_name] = self.index.get_len(dim_name, constraint)
+    return dim_lens
+
+
+  def estimate(self, dim_constraints: dict[str, slice | list], var: str | list = None) -> int:
+    """
+    Returns the size in bytes of the subset.
+    """
+    key = repr((sorted((dim_constraints or {}).items()), var))
+    with self.__lock:
+      if key in self.__memo:
+        self.__memo.move_to_end(key)
+        return self.__memo[key]
+    dim_lens = self.get_dim_lens(dim_constraints)
+    nbytes = 0
+    for variable in self.get_variables(var):
+      n_items = 1
+      for dim_name in variable.dims:
+        n_items *= dim_lens[dim_name]
+      nbytes += n_items * variable.dtype.itemsize
+    with self.__lock:
+      self.__memo[key] = nbytes
+      while len(self.__memo) > self.max_memo:
+        self.__memo.popitem(last=False)
+    return nbytes
+
+
+  def estimate_many(self, constraint_sets: list[dict[str, slice | list]], var: str | list = None) -> np.ndarray:
+    """
+    Returns the size in bytes of the subset of every set of constraints
+    in a single vectorised pass.
+    """
+    n_sets = len(constraint_sets)
+    dim_lens = { d: np.full(n_sets, n, dtype='int64') for d, n in self.dataset.sizes.items() }
+    dim_names = set()
+    for dim_constraints in constraint_sets:
+      dim_names.update(dim_constraints or {})
+    for dim_name in dim_names:
+      constraints = [ (c or {}).get(dim_name) for c in constraint_sets ]
+      dim_lens[dim_name] = self.index.get_lens(dim_name, constraints)
+    nbytes = np.zeros(n_sets, dtype='int64')
+    for variable in self.get_variables(var):
+      n_items = np.ones(n_sets, dtype='int64')
+      for dim_name in variable.dims:
+        n_items *= dim_lens[dim_name]
+      nbytes += n_items * variable.dtype.itemsize
+    return nbytes
+
+
 # def slice_dice(
 #   dataset: xr.Dataset,
 #   dim_constraints: dict,
@@ -101,7 +318,8 @@ def get_time_dim(dataset: xr.Dataset) -> tuple[xr.DataArray, str] | tuple[None,
       dim_name = time_dim_names[0]
       return dataset[dim_name], dim_name
   except:
-    return None, ''
+    pass
+  return None, ''
 
 
 def get_time_bound_from_ds(dataset: xr.Dataset):
@@ -114,6 +332,13 @@ def get_time_bound_from_ds(dataset: xr.Dataset):
   return time_min, time_max
 
 
+def select_times_after(dataset: xr.Dataset, time_dim: str, time: object) -> xr.Dataset:
+  """
+  Returns the time steps of `dataset` after `time`.
+  """
+  return dataset.isel({ time_dim: np.asarray(dataset[time_dim].values > time) })
+
+
 def get_dims(dataset: xr.Dataset) -> list[str]:
   return list(dataset.coords)
 
@@ -147,6 +372,98 @@ def get_time_dims(dataset: xr.Dataset):
   return time_dim_list
 
 
+# Nanoseconds of the time units of CF "<unit> since <date>" strings.
+TIME_UNIT_NS = {
+  'weeks': 7 * 86400 * 10**9,
+  'days': 86400 * 10**9,
+  'hours': 3600 * 10**9,
+  'minutes': 60 * 10**9,
+  'seconds': 10**9,
+  'milliseconds': 10**6,
+  'microseconds': 10**3
+}
+TIME_UNIT_ALIASES = {
+  'week': 'weeks', 'w': 'weeks',
+  'day': 'days', 'd': 'days',
+  'hour': 'hours', 'hr': 'hours', 'hrs': 'hours', 'h': 'hours',
+  'minute': 'minutes', 'min': 'minutes', 'mins': 'minutes',
+  'second': 'seconds', 'sec': 'seconds', 'secs': 'seconds', 's': 'seconds',
+  'millisecond': 'milliseconds', 'msec': 'milliseconds', 'ms': 'milliseconds',
+  'microsecond': 'microseconds', 'usec': 'microseconds', 'us': 'microseconds'
+}
+# CF reference dates parsed without cftime: a 4-digit year, an optional
+# time and an optional UTC designator. Anything else is left to cftime.
+REFERENCE_DATE_PATTERN = re.compile(
+  r'^(\d{4})-(\d{1,2})-(\d{1,2})'
+  r'(?:(?:T|\s+)(\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d+)?))?)?'
+  r'\s*(?:Z|UTC)?$',
+  flags=re.IGNORECASE)
+# Calendars that match numpy datetimes (the standard calendar does after 1582-10-15).
+NUMPY_CALENDARS = ['standard', 'gregorian', 'proleptic_gregorian']
+
+
+def parse_time_units(units: str) -> tuple[int, np.datetime64] | None:
+  """
+  Parses CF time units ("<unit> since <date>") into the nanoseconds of the
+  unit and the reference date, as a naive UTC datetime64[ns]. Returns None
+  if they can not be parsed, or the date is not in the strict form of
+  REFERENCE_DATE_PATTERN (e.g. short years, as in "days since 10-1-1").
+  """
+  m = re.match(r'^\s*(\w+)\s+since\s+(.+?)\s*$', str(units), flags=re.IGNORECASE)
+  if not m:
+    return None
+  unit = m.group(1).lower()
+  unit = TIME_UNIT_ALIASES.get(unit, unit)
+  if unit not in TIME_UNIT_NS:
+    return None
+  date = REFERENCE_DATE_PATTERN.match(m.group(2).strip())
+  if not date:
+    return None
+  year, month, day, hour, minute, second = date.groups()
+  try:
+    reference = pd.Timestamp(
+      year=int(year), month=int(month), day=int(day),
+      hour=int(hour or 0), minute=int(minute or 0)) + pd.Timedelta(seconds=float(second or 0))
+  except (ValueError, OverflowError):
+    return None
+  return TIME_UNIT_NS[unit], reference.to_datetime64().astype('datetime64[ns]')
+
+
+def decode_times(values, units: str, calendar: str = 'standard') -> np.ndarray:
+  """
+  Decodes numeric times in CF `units` into datetimes. Standard calendars
+  are decoded at once into datetime64[ns] with numpy arithmetic; the units
+  are parsed once and NaN values become NaT. Other calendars, units that
+  can not be parsed and dates out of the datetime64[ns] range are decoded
+  with cftime, into an object array of datetimes (cftime ones for the
+  calendars python datetimes can not represent).
+  """
+  values = np.asarray(values)
+  calendar = str(calendar).lower()
+  parsed = parse_time_units(units)
+  # References parsed as datetime64[ns] are after 1582-10-15, so the
+  # standard calendar is the proleptic gregorian one.
+  if parsed is not None and calendar in NUMPY_CALENDARS and values.dtype.kind in 'iuf':
+    unit_ns, reference = parsed
+    finite = np.isfinite(values)
+    offsets = np.where(finite, values, 0)
+    # The limits of datetime64[ns], with a margin for the rounding.
+    start, limit = float(reference.astype('int64')), 0.999 * 2.0**63
+    if -limit < start + float(offsets.min(initial=0)) * unit_ns and start + float(offsets.max(initial=0)) * unit_ns < limit:
+      if values.dtype.kind == 'f':
+        # Whole and fractional units apart, to keep the precision of the
+        # whole units in int64.
+        whole = np.floor(offsets)
+        nanoseconds = whole.astype('int64') * unit_ns + np.round((offsets - whole) * unit_ns).astype('int64')
+      else:
+        nanoseconds = offsets.astype('int64') * unit_ns
+      decoded = reference + nanoseconds.astype('timedelta64[ns]')
+      decoded[~finite] = np.datetime64('NaT')
+      return decoded
+  # Python datetimes when the calendar allows them, cftime datetimes if not.
+  return num2date(values, units=units, calendar=calendar, only_use_cftime_datetimes=False)
+
+
 # TODO: this should open a dataset like the original method, but when fails
 # tries to identify if it was a problem with time dimension, if so, it opens the dataset without
 # the built-in time decoding feature, then decode the time by itself, adjust the
@@ -163,6 +480,16 @@ def open_dataset(filename_or_obj, log_stream = sys.stderr, **kwargs):
   # May need custom time decoding.
   print(f'Trying to open it without the built-in time decoding.', file=log_stream)
   dataset = xr.open_dataset(filename_or_obj, decode_times=False, **kwargs)
+  dataset = decode_time_dims(dataset, log_stream=log_stream)
+  print(f'Dataset successfully loaded and decoded.', file=log_stream)
+  return dataset
+
+
+def decode_time_dims(dataset: xr.Dataset, log_stream = sys.stderr) -> xr.Dataset:
+  """
+  Decodes the time dimensions of a dataset opened without the built-in
+  time decoding (see decode_times).
+  """
   time_dims = get_time_dims(dataset)
   if not time_dims:
     print(f'WARNING: No time dimension detected. Could be this an error?', file=log_stream)
@@ -175,13 +502,25 @@ def open_dataset(filename_or_obj, log_stream = sys.stderr, **kwargs):
       calendar = dim.attrs['calendar']
       del dim_attrs['calendar']
     del dim_attrs['units']
-    decoded_times = num2pydate(dim.data, units=dim.attrs['units'], calendar=calendar)
+    decoded_times = decode_times(dim.values, units=dim.attrs['units'], calendar=calendar)
     dataset = dataset.assign_coords({time_dim_name: (time_dim_name, decoded_times, dim_attrs)})
-  print(f'Dataset successfully loaded and decoded.', file=log_stream)
   return dataset
 
 
-def open_mfdataset(paths, log_stream = sys.stderr, **kwargs):
+def open_mfdataset(paths, log_stream = sys.stderr, max_workers: int = None, **kwargs):
+  """
+  Opens several files as a single dataset with xr.open_mfdataset (`kwargs`
+  are its options). If their time units can not be decoded, the files are
+  opened and decoded by up to `max_workers` threads, lazily (as dask
+  arrays), and concatenated along their time dimension, in the order of
+  `paths`: they are expected to be disjoint blocks, in order, of the same
+  dataset (other dimensions, coordinates and variables without time are
+  taken from the first file). Files that do not share their other
+  dimensions are combined by their coordinates instead, and files without
+  time dimension are merged. Their data is read holding NETCDF_LOCK, so it
+  can be computed by several threads.
+  Must not be called (nor its data computed) holding NETCDF_LOCK.
+  """
   try:
     return xr.open_mfdataset(paths, **kwargs)
   except ValueError as err:
@@ -189,13 +528,36 @@ def open_mfdataset(paths, log_stream = sys.stderr, **kwargs):
     print(f'An error occured while opening the datasets: {err_msg}', file=log_stream)
     if not re.search(r'unable to decode time units', err_msg):
       raise err.with_traceback(err.__traceback__)
-  
-  # Load one by one using custom time decoding. Then merge them manually.
-  print(f'Trying to load the datasets one by one with custom time decoding to merge them manually.', file=log_stream)
-  datasets = []
-  for p in paths:
-    ds = open_dataset(p, log_stream=log_stream)
-    datasets.append(ds)
-  dataset = xr.merge(datasets)
-  print(f'Datasets successfully merged.', file=log_stream)
+
+  # Open them in parallel using custom time decoding. Then concatenate them.
+  if isinstance(paths, (str, Path)):
+    paths = sorted(glob.glob(str(paths)))
+  paths = list(paths)
+  print(f'Trying to open the {len(paths)} datasets in parallel with custom time decoding to concatenate them.', file=log_stream)
+  def open_block(path) -> tuple[list[str], xr.Dataset]:
+    with NETCDF_LOCK:
+      # The lock of the data reads too, made by dask threads later on.
+      dataset = xr.open_dataset(path, decode_times=False, chunks={}, lock=NETCDF_LOCK)
+    # Detected before decoding, which drops the units.
+    return get_time_dims(dataset), decode_time_dims(dataset, log_stream=log_stream)
+  with ThreadPoolExecutor(max_workers=max_workers or min(32, len(paths))) as executor:
+    opened = list(executor.map(open_block, paths))
+  time_dims = opened[0][0]
+  datasets = [ dataset for _, dataset in opened ]
+  if not time_dims:
+    dataset = xr.merge(datasets)
+    print(f'Datasets successfully merged.', file=log_stream)
+    return dataset
+  time_dim_name = time_dims[0]
+  def same_other_dims(dataset: xr.Dataset) -> bool:
+    first = datasets[0]
+    if { d for d in dataset.dims if d != time_dim_name } != { d for d in first.dims if d != time_dim_name }:
+      return False
+    return all([ dataset.indexes[d].equals(first.indexes[d]) if d in first.indexes else dataset.sizes[d] == first.sizes[d] for d in first.dims if d != time_dim_name ])
+  if all([ same_other_dims(ds) for ds in datasets ]):
+    # No alignment: the blocks only differ in time.
+    dataset = xr.concat(datasets, dim=time_dim_name, data_vars='minimal', coords='minimal', compat='override', join='override')
+  else:
+    dataset = xr.combine_by_coords(datasets, data_vars='minimal', coords='minimal', compat='override')
+  print(f'Datasets successfully concatenated along {time_dim_name}.', file=log_stream)
   return dataset
@@ -0,0 +1,522 @@
+# Standard
+import sys
+import math
+import shutil
+import threading
+import contextlib
+from collections import Counter
+from pathlib import Path
+# Third party
+import numpy as np
+import xarray as xr
+import dask.array
+import netCDF4
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+# Own
+from siaextractlib.utils.locks import NETCDF_LOCK
+from siaextractlib.utils.exceptions import ExtractionException
+from siaextractlib.processing import wrangling
+from siaextractlib.processing.planning import Block
+
+
+class OutputEncoding:
+  """
+  How the data variables of the extracted files are stored: zlib
+  compression with `complevel` (1-9) and the `shuffle` filter, the chunk
+  shape and `dtypes` overrides by variable name (e.g. {'sst': 'float32'}).
+  `chunking` is a dict of chunk lengths by dimension name (dimensions not in
+  it are not cut) or one of the presets:
+  * 'map': one time step (and one level of the other outer dimensions) and
+    the whole horizontal grid per chunk, for reading maps.
+  * 'timeseries': the whole time dimension and tiles of `tile_size` points
+    of the other dimensions per chunk, for reading time series.
+  None leaves the chunking to the netCDF library.
+  """
+  PRESETS = ['map', 'timeseries']
+
+
+  def __init__(
+    self,
+    zlib: bool = False,
+    complevel: int = 4,
+    shuffle: bool = True,
+    chunking: str | dict[str, int] = None,
+    dtypes: dict[str, str] = None,
+    tile_size: int = 32
+  ):
+    if type(chunking) is str and chunking not in self.PRESETS:
+      raise ValueError(f'Unknown chunking preset: {chunking}. Use one of {self.PRESETS} or a dict.')
+    self.zlib = zlib
+    self.complevel = complevel
+    self.shuffle = shuffle
+    self.chunking = chunking
+    self.dtypes = dtypes if dtypes is not None else {}
+    self.tile_size = tile_size
+
+
+  def to_dict(self) -> dict:
+    return {
+      'zlib': self.zlib,
+      'complevel': self.complevel,
+      'shuffle': self.shuffle,
+      'chunking': self.chunking,
+      'dtypes': { str(v): str(t) for v, t in self.dtypes.items() },
+      'tile_size': self.tile_size
+    }
+
+
+  def get_chunk_sizes(self, dims: tuple[str], sizes: dict[str, int], time_dim: str = None) -> tuple[int] | None:
+    """
+    Returns the chunk lengths of a variable of dimensions `dims` in a file
+    whose dimension lengths are `sizes`.
+    """
+    if self.chunking is None or not dims:
+      return None
+    if self.chunking == 'map':
+      horizontal = dims[-2:]
+      chunks = [ sizes[d] if d in horizontal else 1 for d in dims ]
+    elif self.chunking == 'timeseries':
+      chunks = [ sizes[d] if d == time_dim else self.tile_size for d in dims ]
+    else:
+      chunks = [ self.chunking.get(d, sizes[d]) for d in dims ]
+    return tuple([ max(1, min(c, sizes[d])) for c, d in zip(chunks, dims) ])
+
+
+  def get_var_encoding(self, dims: tuple[str], sizes: dict[str, int], time_dim: str = None) -> dict:
+    """
+    Returns the compression and chunking options of a data variable, as
+    netCDF4 createVariable(...) takes them.
+    """
+    encoding = {}
+    if self.zlib:
+      encoding.update({ 'zlib': True, 'complevel': self.complevel, 'shuffle': self.shuffle })
+    chunk_sizes = self.get_chunk_sizes(dims, sizes, time_dim)
+    if chunk_sizes is not None:
+      encoding['chunksizes'] = chunk_sizes
+    return encoding
+
+
+  def apply_dtypes(self, dataset: xr.Dataset) -> xr.Dataset:
+    """
+    Sets the overridden dtypes in the encoding of the variables, so they
+    are written (and packed, if they have a scale_factor) with them.
+    """
+    for name, dtype in self.dtypes.items():
+      if name in dataset.variables:
+        dataset.variables[name].encoding['dtype'] = np.dtype(dtype)
+    return dataset
+
+
+  def get_encoding(self, dataset: xr.Dataset, time_dim: str = None) -> dict[str, dict]:
+    """
+    Returns the `encoding` argument of `dataset.to_netcdf(...)`.
+    """
+    sizes = { d: int(n) for d, n in dataset.sizes.items() }
+    encoding = {}
+    for name, var in dataset.data_vars.items():
+      encoding[name] = self.get_var_encoding(var.dims, sizes, time_dim)
+    for name, dtype in self.dtypes.items():
+      if name in dataset.variables:
+        encoding.setdefault(name, {})['dtype'] = np.dtype(dtype)
+    return encoding
+
+
+class NetcdfBlockWriter:
+  """
+  Writes the blocks of an extraction into a single NetCDF file as they are
+  extracted, so the blocks are never merged in a second pass. The file is
+  created from `template` (the requested subset, not loaded) with the
+  `unlimited_dims` as unlimited dimensions, and every block is written in
+  its region of the file. The data variables are stored as the
+  `output_encoding` says, if any.
+  `offsets` are the positions in the file of the first item of the template
+  by dimension, e.g. the length of the time dimension of an existing file
+  (see "open()") the template is appended to.
+  The netCDF library is not thread-safe, so every access to the file is
+  made holding the lock of the library (NETCDF_LOCK) and the one xarray uses.
+  """
+  # Blocks are written by a single thread, in order (see the `direct`
+  # writers below).
+  direct = False
+
+
+  def __init__(
+    self,
+    path: Path | str,
+    template: xr.Dataset,
+    unlimited_dims: list[str] = None,
+    output_encoding: OutputEncoding = None,
+    time_dim: str = None,
+    offsets: dict[str, int] = None
+  ):
+    self.path = Path(path)
+    self.template = template
+    self.unlimited_dims = unlimited_dims if unlimited_dims is not None else []
+    self.output_encoding = output_encoding if output_encoding is not None else OutputEncoding()
+    self.time_dim = time_dim
+    self.offsets = offsets if offsets is not None else {}
+    self.__nc: netCDF4.Dataset = None
+    self.__encodings: dict[str, dict] = {}
+    self.__written: set = set()
+
+
+  def create(self):
+    """
+    Creates the file with the dimensions, variables and attributes of the
+    template. Only the coordinates are written. An existing file is replaced.
+    """
+    # Data variables are encoded from a sample so they are not downloaded.
+    # Coordinates are encoded whole, since time units may depend on them.
+    sample = self.template.isel({ d: slice(0, min(1, n)) for d, n in self.template.sizes.items() })
+    sample = self.output_encoding.apply_dtypes(sample.copy())
+    variables, attributes = xr.conventions.cf_encoder(dict(sample.variables), dict(sample.attrs))
+    for name in self.template.coords:
+      coord = self.template.variables[name]
+      if name in self.output_encoding.dtypes:
+        coord = coord.copy(deep=False)
+        coord.encoding['dtype'] = np.dtype(self.output_encoding.dtypes[name])
+      encoded = xr.conventions.encode_cf_variable(coord, name=name)
+      encoded.attrs.update({ k: v for k, v in variables[name].attrs.items() if k not in encoded.attrs })
+      variables[name] = encoded
+    with NETCDF_LOCK, NETCDF4_PYTHON_LOCK:
+      self.__nc = netCDF4.Dataset(self.path, mode='w', format='NETCDF4')
+      for dim_name, dim_len in self.template.sizes.items():
+        self.__nc.createDimension(dim_name, None if dim_name in self.unlimited_dims else dim_len)
+      sizes = { d: int(n) for d, n in self.template.sizes.items() }
+      for name, var in variables.items():
+        attrs = dict(var.attrs)
+        fill_value = attrs.pop('_FillValue', None)
+        options = {}
+        if name in self.template.data_vars:
+          options = self.output_encoding.get_var_encoding(var.dims, sizes, self.time_dim)
+        nc_var = self.__nc.createVariable(name, var.dtype, var.dims, fill_value=fill_value, **options)
+        nc_var.setncatts(attrs)
+      self.__nc.setncatts(attributes)
+      self.__nc.set_auto_maskandscale(False)
+      self.__load_encodings()
+
+
+  def open(self):
+    """
+    Opens a file previously created by this writer to continue writing blocks,
+    or to append blocks after its end (see `offsets`).
+    """
+    with NETCDF_LOCK, NETCDF4_PYTHON_LOCK:
+      self.__nc = netCDF4.Dataset(self.path, mode='a')
+      self.__nc.set_auto_maskandscale(False)
+      self.__load_encodings()
+
+
+  def __load_encodings(self):
+    """
+    Reads from the file the encoding every block must be written with.
+    """
+    self.__encodings = {}
+    for name, nc_var in self.__nc.variables.items():
+      if name not in self.template.variables:
+        continue
+      encoding = { 'dtype': nc_var.dtype }
+      keys = ['_FillValue', 'scale_factor', 'add_offset']
+      if self.template.variables[name].dtype.kind in ['M', 'm', 'O']:
+        keys += ['units', 'calendar']
+      for key in keys:
+        if key in nc_var.ncattrs():
+          encoding[key] = nc_var.getncattr(key)
+      self.__encodings[name] = encoding
+
+
+  def write(self, block: Block, dataset: xr.Dataset):
+    """
+    Writes the variables of `dataset`, the data of `block`, in the region
+    of the block. Variables not cut by the block are written only once.
+    """
+    for name, encoding in self.__encodings.items():
+      if name not in dataset.variables:
+        continue
+      var = dataset.variables[name]
+      region_key = (name, tuple([ (d, block.slices[d].start) for d in var.dims if d in block.slices ]))
+      if region_key in self.__written:
+        continue
+      region = []
+      for d in var.dims:
+        dim_slice = block.slices.get(d, slice(0, self.template.sizes[d]))
+        offset = self.offsets.get(d, 0)
+        region.append(slice(dim_slice.start + offset, dim_slice.stop + offset))
+      region = tuple(region)
+      var = xr.Variable(var.dims, var.values, encoding=dict(encoding))
+      values = np.asarray(xr.conventions.encode_cf_variable(var, name=name).values)
+      with NETCDF_LOCK, NETCDF4_PYTHON_LOCK:
+        self.__nc.variables[name][region if region else Ellipsis] = values
+      self.__written.add(region_key)
+
+
+  def close(self):
+    if self.__nc is not None:
+      with NETCDF_LOCK, NETCDF4_PYTHON_LOCK:
+        self.__nc.close()
+      self.__nc = None
+
+
+  def open_dataset(self, log_stream = sys.stderr) -> xr.Dataset:
+    """
+    Opens the written file, once closed. Hold NETCDF_LOCK while using it.
+    """
+    return wrangling.open_dataset(self.path, log_stream=log_stream)
+
+
+  def unlink(self):
+    self.path.unlink()
+
+
+class MemoryBlockWriter:
+  """
+  Assembles the blocks of an extraction into in-memory arrays shaped as
+  `template`. Blocks cover disjoint regions, so they can be written by the
+  workers that download them, at once. Regions not written are NaN (or 0
+  for non float variables).
+  """
+  direct = True
+
+
+  def __init__(self, template: xr.Dataset):
+    self.template = template
+    self.__arrays: dict[str, np.ndarray] = {}
+
+
+  def create(self):
+    self.__arrays = {}
+    for name, var in self.template.data_vars.items():
+      if var.dtype.kind in ['f', 'c']:
+        self.__arrays[name] = np.full(var.shape, np.nan, dtype=var.dtype)
+      else:
+        self.__arrays[name] = np.zeros(var.shape, dtype=var.dtype)
+
+
+  def write(self, block: Block, dataset: xr.Dataset):
+    """
+    Copies the data variables of `dataset`, the data of `block`, into the
+    region of the block.
+    """
+    for name, array in self.__arrays.items():
+      if name not in dataset.variables:
+        continue
+      var = dataset.variables[name]
+      region = tuple([ block.slices.get(d, slice(0, self.template.sizes[d])) for d in var.dims ])
+      array[region if region else Ellipsis] = var.values
+
+
+  def close(self):
+    pass
+
+
+  def get_dataset(self) -> xr.Dataset:
+    """
+    Returns the assembled dataset, with the coordinates of the template.
+    """
+    data_vars = {}
+    for name, array in self.__arrays.items():
+      var = self.template.variables[name]
+      data_vars[name] = xr.Variable(var.dims, array, attrs=var.attrs, encoding=var.encoding)
+    coords = { name: self.template.variables[name].compute() for name in self.template.coords }
+    return xr.Dataset(data_vars, coords=coords, attrs=self.template.attrs)
+
+
+  def open_dataset(self, log_stream = sys.stderr) -> xr.Dataset:
+    """
+    Same as "get_dataset()", for the extractions that open their output.
+    """
+    return self.get_dataset()
+
+
+  def unlink(self):
+    """
+    Discards the arrays.
+    """
+    self.__arrays = {}
+
+
+  def get_nbytes(self) -> int:
+    return sum([ a.nbytes for a in self.__arrays.values() ])
+
+
+def import_zarr():
+  """
+  Returns the zarr module, an optional dependency.
+  """
+  try:
+    import zarr
+  except ImportError as err:
+    raise ExtractionException(messages='The Zarr output needs the zarr package: pip install "siaextractlib[zarr]".', tb=err.__traceback__)
+  return zarr
+
+
+class ZarrBlockWriter:
+  """
+  Writes the blocks of an extraction into a Zarr store. Every block is
+  written into its region by the worker that downloaded it. The chunks of
+  the store follow the common length of the `blocks` (see get_chunk_sizes),
+  so blocks are written without locks, except the chunks shared by two
+  blocks that do not start at a chunk boundary (e.g. blocks aligned with
+  the remote chunks from an offset), which are written one block at a time.
+  The store is created from `template` (the requested
+  subset, not loaded): only its coordinates and metadata are written. The
+  consolidated metadata is written on close.
+  The data variables are stored as the `output_encoding` says, if any.
+  Needs the zarr package (version 2).
+  """
+  direct = True
+
+
+  def __init__(
+    self,
+    path: Path | str,
+    template: xr.Dataset,
+    blocks: list[Block],
+    output_encoding: OutputEncoding = None,
+    time_dim: str = None
+  ):
+    self.path = Path(path)
+    self.template = template
+    self.blocks = blocks
+    self.output_encoding = output_encoding if output_encoding is not None else OutputEncoding()
+    self.time_dim = time_dim
+    self.__chunks: dict[str, int] = None
+    self.__shared_chunks: set[tuple[str, int]] = None
+    self.__chunk_locks: dict[tuple[str, int], threading.Lock] = {}
+    self.__lock = threading.Lock()
+
+
+  def get_chunk_sizes(self) -> dict[str, int]:
+    """
+    Returns the chunk length of every dimension: the common length of the
+    blocks along it, or the one `output_encoding` asks for if it is shorter
+    (reduced to a divisor of the block length), so the chunks tile the
+    blocks. Block starts that are not a multiple of it (relative to the
+    origin of the subset) leave chunks shared by two blocks (see
+    get_shared_chunks).
+    """
+    sizes = { d: int(n) for d, n in self.template.sizes.items() }
+    dims = tuple(sizes)
+    preferred = self.output_encoding.get_chunk_sizes(dims, sizes, self.time_dim)
+    preferred = dict(zip(dims, preferred)) if preferred is not None else {}
+    chunks = {}
+    for dim_name, dim_len in sizes.items():
+      lengths = [ b.slices[dim_name].stop - b.slices[dim_name].start for b in self.blocks if dim_name in b.slices ]
+      # The first and last blocks may be shorter.
+      block_len = Counter(lengths).most_common(1)[0][0] if lengths else dim_len
+      chunk_len = preferred.get(dim_name, block_len)
+      if chunk_len < block_len:
+        chunk_len = math.gcd(chunk_len, block_len)
+      chunks[dim_name] = max(1, min(chunk_len, block_len))
+    return chunks
+
+
+  def get_shared_chunks(self, chunks: dict[str, int]) -> set[tuple[str, int]]:
+    """
+    Returns the (dimension, chunk index) of the chunks that contain the
+    boundary of a block, so belong to more than one block.
+    """
+    shared = set()
+    for block in self.blocks:
+      for dim_name, s in block.slices.items():
+        for boundary in (s.start, s.stop):
+          if boundary % chunks[dim_name] != 0 and boundary < self.template.sizes[dim_name]:
+            shared.add((dim_name, boundary // chunks[dim_name]))
+    return shared
+
+
+  def get_chunks(self) -> dict[str, int]:
+    """
+    Returns the chunk lengths (see get_chunk_sizes), computed once.
+    """
+    with self.__lock:
+      if self.__chunks is None:
+        self.__chunks = self.get_chunk_sizes()
+        self.__shared_chunks = self.get_shared_chunks(self.__chunks)
+      return self.__chunks
+
+
+  def get_chunk_lock(self, key: tuple[str, int]) -> threading.Lock:
+    with self.__lock:
+      return self.__chunk_locks.setdefault(key, threading.Lock())
+
+
+  def get_encoding(self, chunks: dict[str, int]) -> dict[str, dict]:
+    import_zarr()
+    import numcodecs
+    encoding = {}
+    for name, var in self.template.data_vars.items():
+      var_encoding = { 'chunks': tuple([ chunks[d] for d in var.dims ]) }
+      if self.output_encoding.zlib:
+        var_encoding['compressor'] = numcodecs.Zlib(level=self.output_encoding.complevel)
+        if self.output_encoding.shuffle:
+          var_encoding['filters'] = [numcodecs.Shuffle(elementsize=np.dtype(self.output_encoding.dtypes.get(name, var.dtype)).itemsize)]
+      encoding[name] = var_encoding
+    for name, dtype in self.output_encoding.dtypes.items():
+      if name in self.template.variables:
+        encoding.setdefault(name, {})['dtype'] = np.dtype(dtype)
+    return encoding
+
+
+  def create(self):
+    """
+    Creates the store with the coordinates and the metadata of the template.
+    An existing store is replaced.
+    """
+    import_zarr()
+    chunks = self.get_chunks()
+    data_vars = {}
+    for name, var in self.template.data_vars.items():
+      # Placeholders that are never computed.
+      data = dask.array.empty(var.shape, dtype=var.dtype, chunks=tuple([ chunks[d] for d in var.dims ]))
+      data_vars[name] = xr.Variable(var.dims, data, attrs=var.attrs)
+    coords = { name: self.template.variables[name] for name in self.template.coords }
+    placeholder = xr.Dataset(data_vars, coords=coords, attrs=self.template.attrs)
+    placeholder.to_zarr(self.path, mode='w', compute=False, encoding=self.get_encoding(chunks), consolidated=False)
+
+
+  def open(self):
+    """
+    Checks the store created by this writer exists to continue writing blocks.
+    """
+    if not self.path.exists():
+      raise ExtractionException(messages=f'Zarr store not found: {self.path}')
+
+
+  def write(self, block: Block, dataset: xr.Dataset):
+    """
+    Writes the data variables of `dataset`, the data of `block`, in the
+    region of the block. The coordinates were written on creation.
+    """
+    data = dataset[[ name for name in self.template.data_vars if name in dataset.data_vars ]]
+    data = data.drop_vars(list(data.coords))
+    for var in data.variables.values():
+      var.encoding = {}
+    region = { d: block.slices.get(d, slice(0, int(n))) for d, n in self.template.sizes.items() if d in data.dims }
+    chunks = self.get_chunks()
+    # The chunks shared with other blocks are read and rewritten whole, so
+    # they are written by one block at a time. Acquired in order.
+    shared = sorted(set([
+      (d, i) for d, s in block.slices.items()
+      for i in (s.start // chunks[d], (s.stop - 1) // chunks[d])
+    ]) & self.__shared_chunks)
+    with contextlib.ExitStack() as stack:
+      for key in shared:
+        stack.enter_context(self.get_chunk_lock(key))
+      data.to_zarr(self.path, region=region, mode='r+', consolidated=False)
+
+
+  def close(self):
+    if self.path.exists():
+      import_zarr().consolidate_metadata(str(self.path))
+
+
+  def open_dataset(self, log_stream = sys.stderr) -> xr.Dataset:
+    """
+    Opens the written store, once closed.
+    """
+    return xr.open_zarr(self.path)
+
+
+  def unlink(self):
+    shutil.rmtree(self.path)
@@ -0,0 +1,305 @@
+# Standard
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+# Third party
+import requests
+import xarray as xr
+# Own
+from siaextractlib.utils.locks import NETCDF_LOCK
+
+
+def get_last_modified(url: str, session: requests.Session = None) -> str | None:
+  """
+  Returns the `Last-Modified` header of the DDS of the remote dataset,
+  or None if the server does not report it.
+  """
+  try:
+    getter = session if session is not None else requests
+    response = getter.head(f'{url}.dds', allow_redirects=True, timeout=30)
+    return response.headers.get('Last-Modified')
+  except requests.RequestException:
+    return None
+
+
+class MetadataCache:
+  """
+  On-disk cache of the dimension coordinates of remote datasets, keyed by
+  URL. Opening a remote dataset downloads (and decodes) every indexed
+  coordinate, which for long time axes takes most of the connection time.
+  Entries younger than `ttl` seconds are used as they are. Older entries
+  are validated against the `Last-Modified` header of the remote dataset
+  and downloaded again if it changed or cannot be known.
+  """
+  # Encoding keys kept for the cached coordinates.
+  ENCODING_KEYS = ['units', 'calendar', 'dtype', '_FillValue']
+
+
+  def __init__(self, cache_dir: Path | str, ttl: float = 24 * 3600):
+    self.cache_dir = Path(cache_dir)
+    self.ttl = ttl
+    self.__lock = threading.Lock()
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+
+  def get_entry_dir(self, key: str) -> Path:
+    return Path(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+  def get_last_modified(self, url: str, session: requests.Session = None) -> str | None:
+    return get_last_modified(url, session=session)
+
+
+  def read_info(self, key: str) -> dict | None:
+    info_path = Path(self.get_entry_dir(key), 'info.json')
+    try:
+      with open(info_path, 'r') as f:
+        info = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if info.get('key') != key:
+      return None
+    return info
+
+
+  def write_info(self, key: str, info: dict):
+    entry_dir = self.get_entry_dir(key)
+    tmp_path = Path(entry_dir, f'info.json.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(info, f)
+    os.replace(tmp_path, Path(entry_dir, 'info.json'))
+
+
+  def get(self, url: str, session: requests.Session = None, key: str = None) -> xr.Dataset | None:
+    """
+    Returns the cached coordinates of `url` (a dataset with coordinates only)
+    if the entry is still valid. Returns None otherwise. A `key` other than
+    the URL can be given to keep apart datasets opened with other options.
+    """
+    if key is None:
+      key = url
+    info = self.read_info(key)
+    if info is None:
+      return None
+    if time.time() - info['created_at'] > self.ttl:
+      last_modified = self.get_last_modified(url, session=session)
+      if last_modified is None or last_modified != info.get('last_modified'):
+        return None
+      info['created_at'] = time.time()
+      self.write_info(key, info)
+    try:
+      with NETCDF_LOCK, xr.open_dataset(Path(self.get_entry_dir(key), info['coords_file'])) as coords:
+        coords = coords.load()
+    except (OSError, ValueError):
+      return None
+    for coord in coords.variables.values():
+      coord.encoding = { k: v for k, v in coord.encoding.items() if k in MetadataCache.ENCODING_KEYS }
+    return coords
+
+
+  def set(self, url: str, dataset: xr.Dataset, session: requests.Session = None, key: str = None):
+    """
+    Stores the indexed coordinates of `dataset`, opened from `url`.
+    """
+    if key is None:
+      key = url
+    coord_names = [ d for d in dataset.dims if d in dataset.indexes ]
+    coords = xr.Dataset(coords={ name: dataset[name].variable for name in coord_names })
+    last_modified = self.get_last_modified(url, session=session)
+    entry_dir = self.get_entry_dir(key)
+    with self.__lock:
+      os.makedirs(entry_dir, exist_ok=True)
+      coords_file = f'coords_{time.time()}_{threading.get_ident()}.nc'
+      with NETCDF_LOCK:
+        coords.to_netcdf(Path(entry_dir, coords_file))
+      old_info = self.read_info(key)
+      self.write_info(key, {
+        'key': key,
+        'url': url,
+        'created_at': time.time(),
+        'last_modified': last_modified,
+        'coords_file': coords_file
+      })
+      if old_info is not None and old_info.get('coords_file') != coords_file:
+        Path(entry_dir, old_info['coords_file']).unlink(missing_ok=True)
+
+
+  def invalidate(self, key: str):
+    """
+    Removes the entry of `key` (the URL by default).
+    """
+    entry_dir = self.get_entry_dir(key)
+    with self.__lock:
+      if entry_dir.exists():
+        for path in entry_dir.iterdir():
+          path.unlink()
+        entry_dir.rmdir()
+
+
+class BlockCache:
+  """
+  On-disk cache of the blocks extracted from remote datasets, shared by
+  every extraction that uses it. A block is stored as the NetCDF file it
+  was extracted into, named after the digest of what it holds (see
+  "get_key(...)"): the dataset, its version, the variables and the ranges of
+  indexes of the block in the dataset. Extractions overlapping others read
+  the blocks in common from disk instead of downloading them again.
+  The cache takes at most `max_size` MB: the least recently used blocks are
+  evicted when a new one does not fit. Blocks older than `ttl` seconds are
+  evicted too (the version of a remote dataset is its `Last-Modified`
+  header, which not every server reports).
+  """
+  def __init__(self, cache_dir: Path | str, max_size: float = 1024, ttl: float = 7 * 24 * 3600):
+    self.cache_dir = Path(cache_dir)
+    self.max_size = max_size # MB
+    self.ttl = ttl # seconds
+    self.__lock = threading.Lock()
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+
+  def __str__(self):
+    return f'Block cache: cache_dir={self.cache_dir}; max_size={self.max_size}MB; ttl={self.ttl}s; size={self.get_size() / 1e6}MB.'
+
+
+  @staticmethod
+  def get_key(
+    url: str,
+    variables: list[str],
+    ranges: dict[str, list[list[int]]],
+    version: str = None,
+    decode_options: dict = None,
+    encoding: dict = None
+  ) -> str:
+    """
+    Returns the digest that identifies a block. `ranges` are the positions
+    of the block in every dimension of the dataset, as runs of contiguous
+    positions: [[start, stop], ...]. `decode_options` are the options the
+    dataset was opened with (e.g. mask_and_scale, decode_times) and
+    `encoding` the description of the output encoding the block is stored
+    with (see OutputEncoding.to_dict()).
+    """
+    description = {
+      'url': str(url),
+      'variables': sorted([ str(v) for v in variables ]),
+      'ranges': { str(d): [ [int(start), int(stop)] for start, stop in r ] for d, r in ranges.items() },
+      'version': version,
+      'decode_options': { str(k): repr(v) for k, v in (decode_options or {}).items() },
+      'encoding': encoding or {}
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+  def get_version(self, url: str, session: requests.Session = None) -> str | None:
+    """
+    Returns the version of the remote dataset, part of the keys of its blocks.
+    """
+    return get_last_modified(url, session=session)
+
+
+  def get_path(self, key: str) -> Path:
+    return Path(self.cache_dir, f'{key}.nc')
+
+
+  def get(self, key: str) -> Path | None:
+    """
+    Returns the path of the cached block of `key`, or None if it is not
+    cached or expired. The path is valid until the block is evicted: link
+    or copy it before using it.
+    """
+    path = self.get_path(key)
+    with self.__lock:
+      try:
+        stat = path.stat()
+        if time.time() - stat.st_mtime > self.ttl:
+          path.unlink()
+          return None
+        # The access time orders the blocks for the LRU eviction.
+        os.utime(path, (time.time(), stat.st_mtime))
+      except OSError:
+        return None
+    return path
+
+
+  def put(self, key: str, path: Path | str):
+    """
+    Stores the NetCDF file `path` as the block of `key` (a hard link if
+    possible, a copy otherwise) and evicts blocks to keep the size limit.
+    """
+    entry_path = self.get_path(key)
+    tmp_path = Path(self.cache_dir, f'{key}.{threading.get_ident()}.tmp')
+    tmp_path.unlink(missing_ok=True)
+    try:
+      os.link(path, tmp_path)
+    except OSError:
+      shutil.copyfile(path, tmp_path)
+    now = time.time()
+    os.utime(tmp_path, (now, now))
+    with self.__lock:
+      os.replace(tmp_path, entry_path)
+      self.evict(keep=entry_path)
+
+
+  def put_dataset(self, key: str, dataset: xr.Dataset, encoding: dict = None):
+    """
+    Writes `dataset` (with `encoding`) as the block of `key`.
+    """
+    tmp_path = Path(self.cache_dir, f'{key}.{threading.get_ident()}.nc.tmp')
+    try:
+      with NETCDF_LOCK:
+        dataset.to_netcdf(tmp_path, encoding=encoding)
+      self.put(key, tmp_path)
+    finally:
+      tmp_path.unlink(missing_ok=True)
+
+
+  def get_entries(self) -> list[tuple[Path, os.stat_result]]:
+    entries = []
+    for path in self.cache_dir.glob('*.nc'):
+      try:
+        entries.append((path, path.stat()))
+      except OSError:
+        # Evicted by another process meanwhile.
+        continue
+    return entries
+
+
+  def get_size(self) -> int:
+    """
+    Returns the bytes taken by the cached blocks.
+    """
+    return sum([ stat.st_size for _, stat in self.get_entries() ])
+
+
+  def evict(self, keep: Path = None):
+    """
+    Removes the expired blocks, and then the least recently used ones until
+    the cache fits in self.max_size (`keep` is never removed).
+    """
+    now = time.time()
+    entries = []
+    for path, stat in self.get_entries():
+      if path != keep and now - stat.st_mtime > self.ttl:
+        path.unlink(missing_ok=True)
+      else:
+        entries.append((path, stat))
+    size = sum([ stat.st_size for _, stat in entries ])
+    for path, stat in sorted(entries, key=lambda e: e[1].st_atime):
+      if size <= self.max_size * 1e6:
+        break
+      if path == keep:
+        continue
+      path.unlink(missing_ok=True)
+      size -= stat.st_size
+
+
+  def clear(self):
+    """
+    Removes every cached block.
+    """
+    with self.__lock:
+      for path, _ in self.get_entries():
+        path.unlink(missing_ok=True)
@@ -97,3 +97,13 @@ class DuplicatedAsyncRunnerException(ExtractionException):
 class AsyncRunnerMissingException(ExtractionException):
   def __init__(self, **kwargs):
     super().__init__(**kwargs)
+
+
+class JobMissingException(ExtractionException):
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+
+
+class ExtractionCancelledException(ExtractionException):
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
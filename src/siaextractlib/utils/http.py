@@ -0,0 +1,481 @@
+# Standard
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit
+from wsgiref.util import request_uri
+# Third party
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# Own
+from siaextractlib.utils.auth import SimpleAuth
+
+
+class TokenBucket:
+  """
+  Holds up to `capacity` tokens, refilled at `rate` tokens per second. Its
+  balance may go below 0 (costs known after the fact, e.g. the bytes of a
+  response): it must be paid back before anything else is taken.
+  """
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+
+
+  def refill(self, now: float):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+
+  def get_wait(self, tokens: float, now: float) -> float:
+    """
+    Returns the seconds until the bucket holds `tokens`.
+    """
+    self.refill(now)
+    return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+  def take(self, tokens: float):
+    self.tokens -= tokens
+
+
+class HostRateLimiter:
+  """
+  Politeness limits of the requests sent to every host, shared by the
+  sessions of a SessionPool: at most `requests_per_second` requests (in
+  bursts of up to `burst`), `max_connections` requests at once and
+  `max_bandwidth` MB/s of responses per host (None for no limit).
+  `host_limits` overrides them for some hosts, e.g.
+  `{ 'host.org': { 'requests_per_second': 2 } }`.
+  A host can also be deferred, e.g. when it answers with a `Retry-After`
+  header: its requests wait until then.
+  """
+  def __init__(
+    self,
+    requests_per_second: float = None,
+    burst: int = 1,
+    max_connections: int = None,
+    max_bandwidth: float = None, # MB/s
+    host_limits: dict[str, dict[str, float]] = None
+  ):
+    self.requests_per_second = requests_per_second
+    self.burst = burst
+    self.max_connections = max_connections
+    self.max_bandwidth = max_bandwidth
+    self.host_limits = host_limits if host_limits is not None else {}
+    self.request_buckets: dict[str, TokenBucket] = {}
+    self.byte_buckets: dict[str, TokenBucket] = {}
+    self.connections: dict[str, int] = {}
+    self.blocked_until: dict[str, float] = {}
+    self.__condition = threading.Condition()
+
+
+  def __str__(self):
+    return f'Host rate limiter: requests_per_second={self.requests_per_second}; burst={self.burst}; max_connections={self.max_connections}; max_bandwidth={self.max_bandwidth}MB/s.'
+
+
+  @staticmethod
+  def get_host(url: str) -> str:
+    return urlsplit(str(url)).netloc
+
+
+  def get_limit(self, host: str, name: str) -> float | None:
+    return self.host_limits.get(host, {}).get(name, getattr(self, name))
+
+
+  def get_buckets(self, host: str) -> tuple[TokenBucket | None, TokenBucket | None]:
+    if host not in self.request_buckets:
+      rate = self.get_limit(host, 'requests_per_second')
+      bandwidth = self.get_limit(host, 'max_bandwidth')
+      self.request_buckets[host] = TokenBucket(rate, max(1, self.get_limit(host, 'burst'))) if rate else None
+      self.byte_buckets[host] = TokenBucket(bandwidth * 1e6, bandwidth * 1e6) if bandwidth else None
+    return self.request_buckets[host], self.byte_buckets[host]
+
+
+  def get_wait(self, host: str) -> float:
+    """
+    Returns the seconds a request to `host` has to wait before it is sent
+    (0 if it can be sent now). Call it holding the condition.
+    """
+    max_connections = self.get_limit(host, 'max_connections')
+    if max_connections is not None and self.connections.get(host, 0) >= max_connections:
+      return 0.1
+    now = time.monotonic()
+    request_bucket, byte_bucket = self.get_buckets(host)
+    waits = [ self.blocked_until.get(host, now) - now ]
+    if request_bucket is not None:
+      waits.append(request_bucket.get_wait(1, now))
+    if byte_bucket is not None:
+      # Bytes are charged after the response: wait until the debt is paid.
+      waits.append(byte_bucket.get_wait(0, now))
+    return max(waits)
+
+
+  def acquire(self, url: str) -> str:
+    """
+    Waits until a request to `url` fits in the limits of its host, counts
+    it and returns the host.
+    """
+    host = self.get_host(url)
+    with self.__condition:
+      wait = self.get_wait(host)
+      while wait > 0:
+        self.__condition.wait(timeout=min(wait, 0.1))
+        wait = self.get_wait(host)
+      request_bucket, _ = self.get_buckets(host)
+      if request_bucket is not None:
+        request_bucket.take(1)
+      self.connections[host] = self.connections.get(host, 0) + 1
+    return host
+
+
+  def release(self, host: str, nbytes: int = 0):
+    """
+    Ends a request to `host` counted by "acquire(...)", charging the
+    `nbytes` of its response.
+    """
+    with self.__condition:
+      _, byte_bucket = self.get_buckets(host)
+      if byte_bucket is not None:
+        byte_bucket.take(nbytes)
+      self.connections[host] = max(0, self.connections.get(host, 0) - 1)
+      self.__condition.notify_all()
+
+
+  def wait_bandwidth(self, host: str):
+    """
+    Waits until the bytes charged to `host` are paid back.
+    """
+    with self.__condition:
+      _, byte_bucket = self.get_buckets(host)
+      if byte_bucket is None:
+        return
+      wait = byte_bucket.get_wait(0, time.monotonic())
+      while wait > 0:
+        self.__condition.wait(timeout=min(wait, 0.1))
+        wait = byte_bucket.get_wait(0, time.monotonic())
+
+
+  def charge(self, host: str, nbytes: int):
+    """
+    Charges `nbytes` read from a response of `host` to its bandwidth.
+    """
+    with self.__condition:
+      _, byte_bucket = self.get_buckets(host)
+      if byte_bucket is not None:
+        byte_bucket.take(nbytes)
+
+
+  def defer(self, host: str, seconds: float):
+    """
+    Holds the requests to `host` for `seconds`.
+    """
+    with self.__condition:
+      self.blocked_until[host] = max(self.blocked_until.get(host, 0.0), time.monotonic() + seconds)
+      self.__condition.notify_all()
+
+
+def parse_retry_after(value: str | None) -> float | None:
+  """
+  Returns the seconds of a `Retry-After` header, given in seconds or as an
+  HTTP date, or None if it is missing or invalid.
+  """
+  if not value:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    return float(value)
+  try:
+    date = parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  if date.tzinfo is None:
+    date = date.replace(tzinfo=timezone.utc)
+  return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+class ThrottledStream:
+  """
+  Raw body of a response whose request holds a connection of a
+  HostRateLimiter. Its bytes are charged to the bandwidth of the host as
+  they are read, and every read waits until the bytes read before are paid
+  back, so streamed and chunked responses are throttled too. The
+  connection is released when the body ends or is closed. Anything else
+  is delegated to the wrapped `raw` (a urllib3 response).
+  """
+  def __init__(self, raw, rate_limiter: HostRateLimiter, host: str):
+    self.raw = raw
+    self.rate_limiter = rate_limiter
+    self.host = host
+    self.__released = False
+    self.__lock = threading.Lock()
+
+
+  def __getattr__(self, name: str):
+    return getattr(self.raw, name)
+
+
+  def read(self, amt: int = None, *args, **kwargs) -> bytes:
+    self.rate_limiter.wait_bandwidth(self.host)
+    start = self.raw.tell()
+    try:
+      data = self.raw.read(amt, *args, **kwargs)
+    except BaseException:
+      self.release()
+      raise
+    self.rate_limiter.charge(self.host, self.raw.tell() - start)
+    if amt is None or not data:
+      self.release()
+    return data
+
+
+  def stream(self, amt: int = 2 ** 16, decode_content: bool = None):
+    while True:
+      data = self.read(amt=amt, decode_content=decode_content)
+      if not data:
+        break
+      yield data
+
+
+  def release(self):
+    """
+    Releases the connection of the request in the limiter, once.
+    """
+    with self.__lock:
+      if self.__released:
+        return
+      self.__released = True
+    self.rate_limiter.release(self.host)
+
+
+  def release_conn(self):
+    self.raw.release_conn()
+    self.release()
+
+
+  def close(self):
+    self.raw.close()
+    self.release()
+
+
+class ThrottledAdapter(HTTPAdapter):
+  """
+  HTTPAdapter whose requests go through a HostRateLimiter. The body of a
+  response is charged to the bandwidth of the host as it is read, and its
+  request holds its connection of the limiter until then (see
+  ThrottledStream). Responses not streamed are read here.
+  Idempotent requests answered with 429 or 503 are retried here, up to
+  `throttle_retries` times, after deferring the whole host for the seconds
+  of their `Retry-After` header (`backoff_factor * 2 ** retry` without it),
+  so every request to the host waits, not only the retried one. Waits
+  longer than `max_retry_after` seconds are not waited: the response is
+  returned.
+  """
+  THROTTLE_STATUSES = [429, 503]
+  RETRY_METHODS = ['HEAD', 'GET', 'OPTIONS']
+
+
+  def __init__(
+    self,
+    rate_limiter: HostRateLimiter,
+    throttle_retries: int = 3,
+    backoff_factor: float = 0.5, # seconds
+    max_retry_after: float = 300, # seconds
+    **kwargs
+  ):
+    self.rate_limiter = rate_limiter
+    self.throttle_retries = throttle_retries
+    self.backoff_factor = backoff_factor
+    self.max_retry_after = max_retry_after
+    super().__init__(**kwargs)
+
+
+  def send(self, request: requests.PreparedRequest, stream: bool = False, **kwargs) -> requests.Response:
+    retry = 0
+    while True:
+      host = self.rate_limiter.acquire(request.url)
+      try:
+        response = super().send(request, stream=stream, **kwargs)
+      except BaseException:
+        self.rate_limiter.release(host)
+        raise
+      response.raw = ThrottledStream(response.raw, self.rate_limiter, host)
+      if not stream:
+        response.content
+      if response.status_code not in self.THROTTLE_STATUSES or request.method not in self.RETRY_METHODS or retry >= self.throttle_retries:
+        return response
+      delay = parse_retry_after(response.headers.get('Retry-After'))
+      if delay is None:
+        delay = self.backoff_factor * 2 ** retry
+      if delay > self.max_retry_after:
+        return response
+      self.rate_limiter.defer(host, delay)
+      response.close()
+      retry += 1
+
+
+class SessionPool:
+  """
+  HTTP sessions shared by every extractor of the process, one per host and
+  credentials, so connections are kept alive and reused across extractors
+  instead of opening a new TCP/TLS connection per extraction.
+  Every session mounts an adapter that keeps up to `pool_maxsize`
+  connections per host (it should not be lower than the number of
+  workers) and retries failed idempotent requests up to `max_retries`
+  times, waiting `backoff_factor * 2 ** (retry - 1)` seconds between them.
+  With a `rate_limiter`, the requests of every session follow its limits
+  per host and 429 and 503 responses are retried by a ThrottledAdapter,
+  which honours their `Retry-After` header for the whole host.
+  """
+  # Server errors worth retrying.
+  RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+  def __init__(
+    self,
+    pool_connections: int = 10,
+    pool_maxsize: int = 32,
+    max_retries: int = 3,
+    backoff_factor: float = 0.5, # seconds
+    keep_alive: bool = True,
+    rate_limiter: HostRateLimiter = None
+  ):
+    self.pool_connections = pool_connections
+    self.pool_maxsize = pool_maxsize
+    self.max_retries = max_retries
+    self.backoff_factor = backoff_factor
+    self.keep_alive = keep_alive
+    self.rate_limiter = rate_limiter
+    self.__sessions: dict[tuple, requests.Session] = {}
+    self.__lock = threading.Lock()
+
+
+  def get_key(self, url: str, auth: SimpleAuth = None) -> tuple:
+    """
+    Returns the key of the session for `url` and `auth`: the scheme and
+    host of the URL and a digest of the credentials.
+    """
+    parts = urlsplit(str(url))
+    credentials = None
+    if auth is not None:
+      credentials = hashlib.sha256(f'{auth.user}:{auth.passwd}'.encode('utf-8')).hexdigest()
+    return (parts.scheme, parts.netloc, credentials)
+
+
+  def new_adapter(self) -> HTTPAdapter:
+    statuses = self.RETRY_STATUSES
+    if self.rate_limiter is not None:
+      # Retried by the ThrottledAdapter, through the limiter.
+      statuses = [ s for s in statuses if s not in ThrottledAdapter.THROTTLE_STATUSES ]
+    retry = Retry(
+      total=self.max_retries,
+      backoff_factor=self.backoff_factor,
+      status_forcelist=statuses,
+      allowed_methods=['HEAD', 'GET', 'OPTIONS'],
+      raise_on_status=False)
+    kwargs = { 'pool_connections': self.pool_connections, 'pool_maxsize': self.pool_maxsize, 'max_retries': retry }
+    if self.rate_limiter is None:
+      return HTTPAdapter(**kwargs)
+    return ThrottledAdapter(
+      self.rate_limiter,
+      throttle_retries=self.max_retries,
+      backoff_factor=self.backoff_factor,
+      **kwargs)
+
+
+  def new_session(self, auth: SimpleAuth = None) -> requests.Session:
+    session = requests.Session()
+    adapter = self.new_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not self.keep_alive:
+      session.headers['Connection'] = 'close'
+    if auth:
+      session.auth = (auth.user, auth.passwd)
+    return session
+
+
+  def get_session(self, url: str, auth: SimpleAuth = None) -> requests.Session:
+    """
+    Returns the session shared for the host of `url` and `auth`, creating
+    it the first time.
+    """
+    key = self.get_key(url, auth)
+    with self.__lock:
+      session = self.__sessions.get(key)
+      if session is None:
+        session = self.new_session(auth)
+        self.__sessions[key] = session
+      return session
+
+
+  def close(self):
+    """
+    Closes every session of the pool.
+    """
+    with self.__lock:
+      for session in self.__sessions.values():
+        session.close()
+      self.__sessions = {}
+
+
+  def __len__(self):
+    return len(self.__sessions)
+
+
+class SessionApplication:
+  """
+  WSGI application that sends the requests it gets to the host of `url`
+  through `session`. Pydap builds a new session for every request to a
+  remote dataset, keeping only the bearer token of the one it is given, so
+  the connections, retries and credentials of `session` would be skipped.
+  Opening the dataset with this application (Pydap's `application`
+  argument) makes every request of that connection go through `session`.
+  Error responses raise a `requests.HTTPError`, as Pydap does.
+  """
+  # Headers that describe the connection or the encoding of the original
+  # response, not the decoded body returned.
+  SKIPPED_HEADERS = ['connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length']
+
+
+  def __init__(self, url: str, session: requests.Session):
+    parts = urlsplit(str(url))
+    self.scheme = parts.scheme
+    self.netloc = parts.netloc
+    self.session = session
+
+
+  def get_url(self, environ: dict) -> str:
+    parts = urlsplit(request_uri(environ))
+    return urlunsplit((self.scheme, self.netloc, parts.path, parts.query, ''))
+
+
+  def __call__(self, environ: dict, start_response):
+    response = self.session.get(self.get_url(environ), timeout=environ.get('webob.client.timeout'))
+    response.raise_for_status()
+    body = response.content
+    headers = [ (k, v) for k, v in response.headers.items() if k.lower() not in self.SKIPPED_HEADERS ]
+    start_response(f'{response.status_code} {response.reason}', headers + [('Content-Length', str(len(body)))])
+    return [body]
+
+
+# Pool shared by the extractors that are not given one.
+_default_pool: SessionPool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> SessionPool:
+  """
+  Returns the process-wide SessionPool. Its limiter sets no rate limits,
+  but it honours the `Retry-After` headers of every host.
+  """
+  global _default_pool
+  with _default_pool_lock:
+    if _default_pool is None:
+      _default_pool = SessionPool(rate_limiter=HostRateLimiter())
+    return _default_pool
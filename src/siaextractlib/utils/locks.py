@@ -0,0 +1,11 @@
+# Standard
+import threading
+
+
+# Lock held by every access of this library to NetCDF files (writing tmp
+# files, merging blocks, the metadata cache...), so they never overlap.
+# xarray guards the netCDF library with combined locks whose acquisition
+# order is not stable across files, so concurrent reads and writes of
+# different files may deadlock. It is reentrant, so a function holding it
+# can call another one that takes it.
+NETCDF_LOCK = threading.RLock()
@@ -0,0 +1,223 @@
+# Standard
+import os
+import json
+import threading
+from enum import Enum
+from pathlib import Path
+# Own
+from siaextractlib.utils.metadata import FileDetails
+
+
+class BlockStatus(Enum):
+  PENDING = 'pending'
+  COMPLETED = 'completed'
+  MERGED = 'merged'
+  FAILED = 'failed'
+
+
+class BlockRecord:
+  """
+  State of a single block of an extraction, as stored in the manifest.
+  """
+  def __init__(
+    self,
+    number: int,
+    key: str,
+    time_min: str = None,
+    time_max: str = None,
+    path: Path | str = None,
+    size: int = None,
+    status: BlockStatus = BlockStatus.PENDING
+  ):
+    self.number = number
+    self.key = key
+    self.time_min = time_min
+    self.time_max = time_max
+    self.path = path
+    self.size = size
+    self.status = status
+
+
+  def __str__(self):
+    return f'Block {self.number}: {self.key}. Time: [{self.time_min}, {self.time_max}]. Status: {self.status.value}. Path: {self.path}. Size: {self.size}.'
+
+
+  def to_dict(self) -> dict:
+    return {
+      'number': self.number,
+      'key': self.key,
+      'time_min': self.time_min,
+      'time_max': self.time_max,
+      'path': None if self.path is None else str(self.path),
+      'size': self.size,
+      'status': self.status.value
+    }
+
+
+  @staticmethod
+  def from_dict(data: dict):
+    return BlockRecord(
+      number=data['number'],
+      key=data['key'],
+      time_min=data['time_min'],
+      time_max=data['time_max'],
+      path=None if data['path'] is None else Path(data['path']),
+      size=data['size'],
+      status=BlockStatus(data['status']))
+
+
+class BlockManifest:
+  """
+  Records on disk the state of every block of an extraction, so an
+  interrupted extraction can be resumed fetching only the missing blocks.
+  The manifest is a JSON file placed next to the output file. It is safe
+  to update it from several worker threads.
+  """
+  def __init__(self, path: Path | str, signature: dict):
+    self.path = Path(path)
+    self.signature = signature
+    self.__records: dict[str, BlockRecord] = {}
+    self.__lock = threading.Lock()
+
+
+  @staticmethod
+  def path_for(filepath: Path | str) -> Path:
+    """
+    Returns the manifest path used for the output file `filepath`.
+    """
+    filepath = Path(filepath)
+    return filepath.with_name(f'{filepath.name}.manifest.json')
+
+
+  @staticmethod
+  def read_completed_paths(path: Path | str) -> list[Path]:
+    """
+    Returns the paths of the blocks recorded as completed (extracted but
+    not merged) by the manifest `path`, whatever its request. Returns an
+    empty list if it does not exist.
+    """
+    try:
+      with open(path, 'r') as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      return []
+    records = [ BlockRecord.from_dict(d) for d in data.get('blocks', []) ]
+    return [ Path(r.path) for r in records if r.status == BlockStatus.COMPLETED and r.path is not None ]
+
+
+  def load(self) -> bool:
+    """
+    Loads the records from disk. Returns False, keeping no records, if
+    the file does not exist or belongs to a different request.
+    """
+    with self.__lock:
+      self.__records = {}
+      if not self.path.exists():
+        return False
+      try:
+        with open(self.path, 'r') as f:
+          data = json.load(f)
+      except (OSError, ValueError):
+        return False
+      if data.get('signature') != self.signature:
+        return False
+      for record_data in data.get('blocks', []):
+        record = BlockRecord.from_dict(record_data)
+        self.__records[record.key] = record
+      return True
+
+
+  def save(self):
+    with self.__lock:
+      self.__save()
+
+
+  def __save(self):
+    data = {
+      'signature': self.signature,
+      'blocks': [ r.to_dict() for r in sorted(self.__records.values(), key=lambda r: r.number) ]
+    }
+    tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(data, f, indent=2)
+    os.replace(tmp_path, self.path)
+
+
+  def set_record(self, record: BlockRecord):
+    """
+    Adds or replaces the record of a block and writes the manifest.
+    """
+    with self.__lock:
+      self.__records[record.key] = record
+      self.__save()
+
+
+  def set_status(self, key: str, status: BlockStatus, path: Path | str = None, size: int = None):
+    """
+    Updates the status of a recorded block and writes the manifest.
+    """
+    with self.__lock:
+      record = self.__records[key]
+      record.status = status
+      record.path = path
+      record.size = size
+      self.__save()
+
+
+  def get_keys(self, status: BlockStatus) -> set[str]:
+    """
+    Returns the keys of the blocks with the given status.
+    """
+    with self.__lock:
+      return set([ k for k, r in self.__records.items() if r.status == status ])
+
+
+  def get_record(self, key: str) -> BlockRecord | None:
+    with self.__lock:
+      return self.__records.get(key)
+
+
+  def get_records(self) -> list[BlockRecord]:
+    with self.__lock:
+      return sorted(self.__records.values(), key=lambda r: r.number)
+
+
+  def matches_plan(self, keys: set[str]) -> bool:
+    """
+    Returns True if every recorded block is one of `keys`, the blocks
+    planned for the run. A run planned with other blocks (e.g. another
+    block size) can not reuse the records.
+    """
+    with self.__lock:
+      return set(self.__records).issubset(keys)
+
+
+  def discard(self):
+    """
+    Removes the files of the blocks completed but not merged recorded on
+    disk, whatever their request, and the records.
+    """
+    for path in self.read_completed_paths(self.path):
+      path.unlink(missing_ok=True)
+    self.unlink()
+
+
+  def get_completed_file(self, key: str) -> FileDetails | None:
+    """
+    Returns the file of a block previously completed if it is still on
+    disk with the recorded size. Returns None otherwise.
+    """
+    record = self.get_record(key)
+    if record is None or record.status != BlockStatus.COMPLETED or record.path is None:
+      return None
+    path = Path(record.path)
+    if not path.exists() or path.stat().st_size != record.size:
+      return None
+    return FileDetails(description='dataset', path=path)
+
+
+  def unlink(self):
+    with self.__lock:
+      self.__records = {}
+      if self.path.exists():
+        self.path.unlink()
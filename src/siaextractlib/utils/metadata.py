@@ -1,6 +1,10 @@
+import time
+import threading
 from enum import Enum
 from pathlib import Path
 from datetime import datetime
+from collections import deque
+from collections.abc import Callable
 
 
 class SizeUnit(Enum):
@@ -67,7 +71,8 @@ class ExtractionDetails:
     file: FileDetails = None,
     complete: bool = False,
     time_min: datetime | str = None,
-    time_max: datetime | str = None
+    time_max: datetime | str = None,
+    telemetry: 'ExtractionTelemetry' = None
   ):
     self.description = description
     self.file = file
@@ -75,7 +80,121 @@ class ExtractionDetails:
     self.time_min = time_min
     self.time_max =  time_max
     self.logs = logs
+    # Performance data of the extraction, if the extractor collects it.
+    self.telemetry = telemetry
   
 
   def __str__(self):
     return f'Description: {self.description}. Completed: {self.complete}. Time min: {self.time_min}. Time max: {self.time_max}. Logs: {self.logs}.'
+
+
+class ExtractionProgress:
+  """
+  Live progress of an extraction: blocks and bytes done out of the total,
+  the current throughput (bytes per second over the last `window` seconds)
+  and the estimated time left. It is updated by the extraction threads and
+  can be polled at any time. If a `callback` is given, it is called with the
+  progress after every update, on the thread that made it.
+  Bytes are the (uncompressed) size of the data requested.
+  """
+  def __init__(
+    self,
+    blocks_total: int = 0,
+    bytes_total: float = 0,
+    window: float = 30.0, # seconds
+    callback: Callable[['ExtractionProgress'], None] = None
+  ):
+    self.blocks_total = blocks_total
+    self.bytes_total = bytes_total
+    self.window = window
+    self.callback = callback
+    # Blocks extracted (downloaded or reused) and written into the output file.
+    self.blocks_done = 0
+    self.blocks_merged = 0
+    # Bytes of the blocks done, and the bytes actually downloaded by this run.
+    self.bytes_done = 0
+    self.bytes_downloaded = 0
+    self.started_at = time.monotonic()
+    self.__samples: deque[tuple[float, float]] = deque()
+    self.__lock = threading.Lock()
+
+
+  def __str__(self):
+    eta = self.get_eta()
+    return f'blocks={self.blocks_done}/{self.blocks_total}; merged={self.blocks_merged}; bytes={self.bytes_done}/{self.bytes_total}; throughput={self.get_throughput():.0f}B/s; eta={"unknown" if eta is None else f"{eta:.1f}s"}.'
+
+
+  def notify(self):
+    if self.callback is not None:
+      self.callback(self)
+
+
+  def add_downloaded(self, nbytes: float):
+    """
+    Records `nbytes` bytes downloaded (a block or a part of it).
+    """
+    now = time.monotonic()
+    with self.__lock:
+      self.bytes_downloaded += nbytes
+      self.__samples.append((now, nbytes))
+      self.__drop_old_samples(now)
+    self.notify()
+
+
+  def add_block(self, nbytes: float):
+    """
+    Records a block of `nbytes` bytes extracted.
+    """
+    with self.__lock:
+      self.blocks_done += 1
+      self.bytes_done += nbytes
+    self.notify()
+
+
+  def add_merged(self, n_blocks: int = 1):
+    """
+    Records blocks written into the output file.
+    """
+    with self.__lock:
+      self.blocks_merged += n_blocks
+    self.notify()
+
+
+  def __drop_old_samples(self, now: float):
+    while self.__samples and now - self.__samples[0][0] > self.window:
+      self.__samples.popleft()
+
+
+  def get_elapsed(self) -> float:
+    return time.monotonic() - self.started_at
+
+
+  def get_throughput(self) -> float:
+    """
+    Returns the bytes per second downloaded over the last `window` seconds.
+    """
+    now = time.monotonic()
+    with self.__lock:
+      self.__drop_old_samples(now)
+      nbytes = sum([ n for _, n in self.__samples ])
+    seconds = min(self.window, now - self.started_at)
+    return nbytes / seconds if seconds > 0 else 0.0
+
+
+  def get_fraction(self) -> float:
+    if self.bytes_total:
+      return min(1.0, self.bytes_done / self.bytes_total)
+    return self.blocks_done / self.blocks_total if self.blocks_total else 0.0
+
+
+  def get_eta(self) -> float | None:
+    """
+    Returns the seconds left at the current throughput, or None if nothing
+    has been downloaded recently.
+    """
+    throughput = self.get_throughput()
+    if self.bytes_done >= self.bytes_total:
+      return 0.0
+    if throughput <= 0:
+      return None
+    return (self.bytes_total - self.bytes_done) / throughput
@@ -0,0 +1,273 @@
+# Standard
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import tempfile
+import threading
+from pathlib import Path
+from collections.abc import Callable
+# Own
+from siaextractlib.utils.manifest import BlockManifest
+from siaextractlib.processing.parallelism import CancelToken
+
+
+class StagingJob:
+  """
+  Namespace of an extraction in a StagingArea: a directory of its own for
+  its tmp files, so concurrent extractions never collide. The disk space of
+  its tmp files is reserved in the area before they are written (see
+  StagingArea.reserve).
+  Tmp files are consumed in order (blocks are merged in order), so a file
+  whose `order` is lower than the ones of every file reserved by the job
+  does not wait for the quota: the files after it could never be released.
+  Closing the job removes its directory, unless the manifest of its
+  extraction references blocks in it (see "close()").
+  """
+  def __init__(self, area: 'StagingArea', path: Path):
+    self.area = area
+    self.path = path
+    self.__reservations: dict[Path, tuple[int, int | None]] = {}
+    self.__lock = threading.Lock()
+
+
+  def __str__(self):
+    return f'Staging job: path={self.path}; reserved_bytes={self.get_reserved_bytes()}.'
+
+
+  def new_path(self, prefix: str = 'tmp_dataset', suffix: str = '.nc') -> Path:
+    """
+    Returns a unique path for a tmp file of the job.
+    """
+    return Path(self.path, f'{prefix}_{uuid.uuid4().hex}{suffix}')
+
+
+  def reserve(self, path: Path, nbytes: int, order: int = None, cancel_token: CancelToken = None):
+    """
+    Reserves `nbytes` of the quota of the area for the tmp file `path`,
+    waiting until they are available. `order` is the position of the file
+    in the order they are consumed (e.g. the number of its block).
+    """
+    def goes_first() -> bool:
+      with self.__lock:
+        orders = [ o for _, o in self.__reservations.values() ]
+      return order is not None and bool(orders) and all([ o is not None and order < o for o in orders ])
+    self.area.reserve(nbytes, cancel_token=cancel_token, bypass=goes_first)
+    with self.__lock:
+      self.__reservations[Path(path)] = (nbytes, order)
+
+
+  def release(self, path: Path):
+    """
+    Gives back the space reserved for `path`, once it is removed (or kept
+    for a later run). Paths not reserved are ignored.
+    """
+    with self.__lock:
+      nbytes, _ = self.__reservations.pop(Path(path), (0, None))
+    if nbytes:
+      self.area.release(nbytes)
+
+
+  def get_reserved_bytes(self) -> int:
+    with self.__lock:
+      return sum([ nbytes for nbytes, _ in self.__reservations.values() ])
+
+
+  def release_all(self):
+    """
+    Gives back the space reserved for every tmp file of the job.
+    """
+    with self.__lock:
+      paths = list(self.__reservations)
+    for path in paths:
+      self.release(path)
+
+
+  def close(self):
+    """
+    Releases every reservation of the job and removes its directory with
+    every file in it, unless the manifest of its extraction references
+    blocks in it (a failed extraction that can be resumed). Those are kept,
+    marked as closed, until the manifest stops referencing them (see
+    "StagingArea.sweep()").
+    """
+    self.release_all()
+    if self.area.is_referenced(self.path):
+      self.area.set_closed(self.path)
+    else:
+      shutil.rmtree(self.path, ignore_errors=True)
+
+
+class StagingArea:
+  """
+  Scratch space for the tmp files of the extractions, instead of the
+  directory of their output files (often on a network volume). Point `root`
+  to a fast local disk (tmpfs, NVMe...); it is a directory of the system tmp
+  directory by default. Every extraction gets a StagingJob, a directory of
+  its own.
+  `quota` (MB) limits the disk space of the tmp files of every job of the
+  area: workers wait before writing a block until there is room for it
+  (one block is always let through, even if it is bigger than the quota).
+  Jobs are owned by the process that creates them. The directories of jobs
+  that are closed, or whose process is not running anymore (e.g. it
+  crashed), are removed when the area is created, and by "sweep()", once
+  they were not modified in the last `max_age` seconds. Jobs referenced by
+  the manifest of their extraction are kept for its resume, whatever their
+  age.
+  Derive it to stage files somewhere else.
+  """
+  OWNER_FILE = '.owner.json'
+
+
+  def __init__(self, root: Path | str = None, quota: float = None, max_age: float = 0, sweep: bool = True):
+    self.root = Path(root) if root is not None else Path(tempfile.gettempdir(), 'siaextractlib_staging')
+    self.quota = quota # MB
+    self.max_age = max_age # seconds
+    self.reserved_bytes = 0
+    self.__condition = threading.Condition()
+    os.makedirs(self.root, exist_ok=True)
+    if sweep:
+      self.sweep()
+
+
+  def __str__(self):
+    return f'Staging area: root={self.root}; quota={self.quota}MB; reserved_bytes={self.reserved_bytes}.'
+
+
+  def new_job(self, manifest_path: Path | str = None) -> StagingJob:
+    """
+    Creates the directory of a new job, owned by this process.
+    `manifest_path` is the manifest of its extraction: the job is kept
+    while it references blocks in it.
+    """
+    path = Path(self.root, f'job_{uuid.uuid4().hex}')
+    os.makedirs(path)
+    self.write_owner(path, {
+      'host': socket.gethostname(),
+      'pid': os.getpid(),
+      'created': time.time(),
+      'manifest': None if manifest_path is None else str(Path(manifest_path).absolute()),
+      'closed': False
+    })
+    return StagingJob(self, path)
+
+
+  def read_owner(self, job_path: Path) -> dict:
+    """
+    Returns the owner of a job. Jobs whose owner can not be read were
+    created by a process that crashed before writing it.
+    """
+    try:
+      with open(Path(job_path, self.OWNER_FILE), 'r') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return { 'host': socket.gethostname(), 'pid': None }
+
+
+  def write_owner(self, job_path: Path, owner: dict):
+    tmp_path = Path(job_path, f'{self.OWNER_FILE}.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(owner, f)
+    os.replace(tmp_path, Path(job_path, self.OWNER_FILE))
+
+
+  def set_closed(self, job_path: Path):
+    """
+    Records that the process of a job does not use it anymore.
+    """
+    owner = self.read_owner(job_path)
+    owner['closed'] = True
+    self.write_owner(job_path, owner)
+
+
+  def is_referenced(self, job_path: Path, owner: dict = None) -> bool:
+    """
+    Returns True if the manifest of the extraction of a job records blocks
+    completed (extracted but not merged) in its directory.
+    """
+    owner = owner if owner is not None else self.read_owner(job_path)
+    if owner.get('manifest') is None:
+      return False
+    job_path = Path(job_path).absolute()
+    paths = BlockManifest.read_completed_paths(owner['manifest'])
+    return any([ Path(p).absolute().parent == job_path for p in paths ])
+
+
+  def reserve(self, nbytes: int, cancel_token: CancelToken = None, bypass: Callable[[], bool] = None):
+    """
+    Waits until `nbytes` fit in the quota, or `bypass` returns True, and
+    reserves them. Raises an ExtractionCancelledException if `cancel_token`
+    is cancelled meanwhile.
+    """
+    with self.__condition:
+      while not self.fits(nbytes) and not (bypass is not None and bypass()):
+        if cancel_token is not None:
+          cancel_token.raise_if_cancelled('The extraction was cancelled while waiting for room in the staging area.')
+        self.__condition.wait(timeout=0.1)
+      self.reserved_bytes += nbytes
+
+
+  def fits(self, nbytes: int) -> bool:
+    if self.quota is None or self.reserved_bytes == 0:
+      return True
+    return self.reserved_bytes + nbytes <= self.quota * 1e6
+
+
+  def release(self, nbytes: int):
+    with self.__condition:
+      self.reserved_bytes = max(0, self.reserved_bytes - nbytes)
+      self.__condition.notify_all()
+
+
+  def is_orphan(self, job_path: Path) -> bool:
+    """
+    Returns True if the job was created by a process of this host that
+    closed it or is not running anymore, its manifest does not reference
+    it (see "is_referenced(...)") and it was not modified in the last
+    self.max_age seconds. Jobs of other hosts are never orphans.
+    """
+    owner = self.read_owner(job_path)
+    if owner.get('host') != socket.gethostname():
+      return False
+    if not owner.get('closed') and owner.get('pid') is not None and is_running(owner['pid']):
+      return False
+    if self.is_referenced(job_path, owner):
+      return False
+    modified = max([ p.stat().st_mtime for p in job_path.iterdir() ] + [ job_path.stat().st_mtime ])
+    return time.time() - modified >= self.max_age
+
+
+  def sweep(self) -> list[Path]:
+    """
+    Removes the orphan jobs (see "is_orphan(...)") and returns their paths.
+    """
+    removed = []
+    for job_path in self.root.glob('job_*'):
+      try:
+        if job_path.is_dir() and self.is_orphan(job_path):
+          shutil.rmtree(job_path, ignore_errors=True)
+          removed.append(job_path)
+      except OSError:
+        # Removed by another sweep meanwhile.
+        continue
+    return removed
+
+
+def is_running(pid: int) -> bool:
+  """
+  Returns True if a process with `pid` is running on this host.
+  """
+  if pid == os.getpid():
+    return True
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # Running, owned by another user.
+    return True
+  except OSError:
+    return False
+  return True
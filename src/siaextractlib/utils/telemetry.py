@@ -0,0 +1,232 @@
+# Standard
+import time
+import threading
+from contextlib import contextmanager
+
+
+class MetricsHook:
+  """
+  Receives the metrics of the extractions. This one discards them; derive
+  it to feed a metrics sink (e.g. Prometheus or StatsD clients). Counters
+  only grow, histograms receive single observations (seconds or bytes).
+  `tags` are labels of the observation, e.g. {'phase': 'fetch'}.
+  """
+  def increment(self, name: str, value: float = 1, tags: dict[str, str] = None) -> None:
+    pass
+
+
+  def observe(self, name: str, value: float, tags: dict[str, str] = None) -> None:
+    pass
+
+
+class InMemoryMetricsHook(MetricsHook):
+  """
+  A MetricsHook that keeps the counters and the observations of the
+  histograms in memory, by name and tags.
+  """
+  def __init__(self) -> None:
+    self.counters: dict[tuple, float] = {}
+    self.histograms: dict[tuple, list[float]] = {}
+    self.__lock = threading.Lock()
+
+
+  @staticmethod
+  def get_key(name: str, tags: dict[str, str] = None) -> tuple:
+    return (name, ) + tuple(sorted((tags or {}).items()))
+
+
+  def increment(self, name: str, value: float = 1, tags: dict[str, str] = None) -> None:
+    key = self.get_key(name, tags)
+    with self.__lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+
+  def observe(self, name: str, value: float, tags: dict[str, str] = None) -> None:
+    key = self.get_key(name, tags)
+    with self.__lock:
+      self.histograms.setdefault(key, []).append(value)
+
+
+  def get_counter(self, name: str, tags: dict[str, str] = None) -> float:
+    with self.__lock:
+      return self.counters.get(self.get_key(name, tags), 0)
+
+
+  def get_observations(self, name: str, tags: dict[str, str] = None) -> list[float]:
+    with self.__lock:
+      return list(self.histograms.get(self.get_key(name, tags), []))
+
+
+class BlockTelemetry:
+  """
+  What it took to extract a block: its wall time (from its first attempt
+  to its end, backoff waits included), the time spent downloading, the
+  bytes requested, the attempts made and the reason of every failed one.
+  `outcome` is one of BlockTelemetry.OUTCOMES.
+  """
+  OUTCOMES = ['completed', 'reused', 'cached', 'failed', 'cancelled']
+
+
+  def __init__(
+    self,
+    number: int,
+    key: str,
+    nbytes: int = None,
+    outcome: str = 'completed',
+    attempts: int = 0,
+    wall_seconds: float = 0.0,
+    fetch_seconds: float = 0.0,
+    merge_seconds: float = None,
+    retry_reasons: list[str] = None
+  ):
+    self.number = number
+    self.key = key
+    self.nbytes = nbytes
+    self.outcome = outcome
+    self.attempts = attempts
+    self.wall_seconds = wall_seconds
+    self.fetch_seconds = fetch_seconds
+    self.merge_seconds = merge_seconds
+    self.retry_reasons = retry_reasons if retry_reasons is not None else []
+
+
+  def __str__(self):
+    return f'Block {self.number + 1} ({self.key}): outcome={self.outcome}; bytes={self.nbytes}; attempts={self.attempts}; wall={self.wall_seconds:.3f}s; fetch={self.fetch_seconds:.3f}s; merge={self.merge_seconds}s; retries={self.retry_reasons}.'
+
+
+  def to_dict(self) -> dict:
+    return {
+      'number': self.number,
+      'key': self.key,
+      'nbytes': self.nbytes,
+      'outcome': self.outcome,
+      'attempts': self.attempts,
+      'wall_seconds': self.wall_seconds,
+      'fetch_seconds': self.fetch_seconds,
+      'merge_seconds': self.merge_seconds,
+      'retry_reasons': list(self.retry_reasons)
+    }
+
+
+class ExtractionTelemetry:
+  """
+  Performance data of an extraction: the telemetry of every block, the
+  seconds spent in every phase (see ExtractionTelemetry.PHASES) and the
+  peak disk usage of the tmp files of the blocks. Every record is also sent
+  to the `metrics_hook`, if any, as the metrics named in METRICS.
+  It is updated by the worker threads of the extraction.
+  Phases: `connect` opens the remote dataset, `plan` plans the blocks and
+  prepares the output file, `fetch` waits for the blocks to be downloaded,
+  `merge` writes them into the output file and `cleanup` closes the
+  extraction. Blocks are downloaded while others are merged, so `fetch` is
+  the wall time not spent merging.
+  """
+  PHASES = ['connect', 'plan', 'fetch', 'merge', 'cleanup']
+  METRICS = {
+    'blocks': 'siaextractlib_blocks_total', # counter, tags: outcome
+    'attempts': 'siaextractlib_block_attempts_total', # counter
+    'retries': 'siaextractlib_block_retries_total', # counter, tags: reason
+    'bytes': 'siaextractlib_bytes_downloaded_total', # counter
+    'block_seconds': 'siaextractlib_block_seconds', # histogram
+    'fetch_seconds': 'siaextractlib_block_fetch_seconds', # histogram
+    'merge_seconds': 'siaextractlib_block_merge_seconds', # histogram
+    'block_bytes': 'siaextractlib_block_bytes', # histogram
+    'phase_seconds': 'siaextractlib_phase_seconds', # histogram, tags: phase
+    'peak_tmp_bytes': 'siaextractlib_peak_tmp_bytes' # histogram
+  }
+
+
+  def __init__(self, metrics_hook: MetricsHook = None):
+    self.metrics_hook = metrics_hook if metrics_hook is not None else MetricsHook()
+    self.blocks: dict[int, BlockTelemetry] = {}
+    self.phases: dict[str, float] = { phase: 0.0 for phase in self.PHASES }
+    self.tmp_bytes = 0
+    self.peak_tmp_bytes = 0
+    self.__lock = threading.Lock()
+
+
+  def __str__(self):
+    phases = ', '.join([ f'{p}={s:.3f}s' for p, s in self.phases.items() ])
+    return f'phases=({phases}); blocks={len(self.blocks)}; attempts={self.get_attempts()}; retries={self.get_retries()}; bytes_downloaded={self.get_bytes_downloaded()}; peak_tmp_bytes={self.peak_tmp_bytes}.'
+
+
+  def add_phase_time(self, phase: str, seconds: float):
+    with self.__lock:
+      self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+    self.metrics_hook.observe(self.METRICS['phase_seconds'], seconds, tags={ 'phase': phase })
+
+
+  @contextmanager
+  def time_phase(self, phase: str):
+    """
+    Adds the time spent in the block of the `with` statement to `phase`.
+    """
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.add_phase_time(phase, time.monotonic() - start)
+
+
+  def record_block(self, block: BlockTelemetry):
+    with self.__lock:
+      self.blocks[block.number] = block
+    self.metrics_hook.increment(self.METRICS['blocks'], tags={ 'outcome': block.outcome })
+    self.metrics_hook.increment(self.METRICS['attempts'], block.attempts)
+    for reason in block.retry_reasons:
+      # The type of the error, not its message, to keep the tags bounded.
+      self.metrics_hook.increment(self.METRICS['retries'], tags={ 'reason': reason.split(':')[0] })
+    if block.outcome == 'completed':
+      self.metrics_hook.increment(self.METRICS['bytes'], block.nbytes)
+      self.metrics_hook.observe(self.METRICS['block_bytes'], block.nbytes)
+      self.metrics_hook.observe(self.METRICS['block_seconds'], block.wall_seconds)
+      self.metrics_hook.observe(self.METRICS['fetch_seconds'], block.fetch_seconds)
+
+
+  def record_merge(self, number: int, seconds: float):
+    with self.__lock:
+      if number in self.blocks:
+        self.blocks[number].merge_seconds = seconds
+    self.metrics_hook.observe(self.METRICS['merge_seconds'], seconds)
+
+
+  def add_tmp_bytes(self, nbytes: int):
+    """
+    Records the creation (positive `nbytes`) or the removal (negative) of
+    a tmp file.
+    """
+    with self.__lock:
+      self.tmp_bytes += nbytes
+      self.peak_tmp_bytes = max(self.peak_tmp_bytes, self.tmp_bytes)
+
+
+  def finish(self):
+    """
+    Sends the metrics known once the extraction ends.
+    """
+    self.metrics_hook.observe(self.METRICS['peak_tmp_bytes'], self.peak_tmp_bytes)
+
+
+  def get_blocks(self) -> list[BlockTelemetry]:
+    with self.__lock:
+      return [ self.blocks[n] for n in sorted(self.blocks) ]
+
+
+  def get_attempts(self) -> int:
+    return sum([ b.attempts for b in self.get_blocks() ])
+
+
+  def get_retries(self) -> int:
+    return sum([ len(b.retry_reasons) for b in self.get_blocks() ])
+
+
+  def get_bytes_downloaded(self) -> int:
+    return sum([ b.nbytes for b in self.get_blocks() if b.outcome == 'completed' ])
+
+
+  def to_dict(self) -> dict:
+    return {
+      'phases': dict(self.phases),
+      'peak_tmp_bytes': self.peak_tmp_bytes,
+      'blocks': [ b.to_dict() for b in self.get_blocks() ]
+    }
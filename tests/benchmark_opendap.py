@@ -0,0 +1,242 @@
+"""
+Offline benchmark of the OpendapExtractor. Serves synthetic datasets from a
+local Pydap server (see lib/opendap_server.py), optionally slow or
+unreliable, and runs complete extractions across a matrix of dataset shapes,
+request sizes and concurrency levels. Reports the throughput, the block
+latency percentiles and the peak memory of every case.
+
+Run it from the tests directory, e.g.:
+
+  python benchmark_opendap.py --shapes 60x90x180 --req-max-sizes 0.5 2 --workers 1 4 --latency 0.05
+
+Results can be saved with --json and compared with a previous run with
+--baseline, which exits with status 1 if the throughput of any case dropped
+more than --tolerance.
+"""
+# Standard
+import sys
+import json
+import time
+import argparse
+import tempfile
+import warnings
+import itertools
+import tracemalloc
+from pathlib import Path
+# Third party
+import numpy as np
+# Own
+from siaextractlib.extractors import OpendapExtractor
+from siaextractlib.utils.http import SessionPool
+# Custom for testing
+from lib.local_opendap import make_dataset
+from lib.opendap_server import LocalOpendapServer
+
+warnings.filterwarnings("ignore")
+
+
+class BenchmarkCase:
+  """
+  A point of the benchmark matrix. `shape` is (times, lats, lons).
+  """
+  def __init__(self, shape: tuple[int, int, int], req_max_size: float, max_workers: int):
+    self.shape = shape
+    self.req_max_size = req_max_size
+    self.max_workers = max_workers
+
+
+  def get_key(self) -> str:
+    return f'shape={"x".join([ str(n) for n in self.shape ])};req_max_size={self.req_max_size};max_workers={self.max_workers}'
+
+
+class BenchmarkResult:
+  """
+  Measures of a BenchmarkCase: the mean over its repetitions of the
+  throughput (MB/s of requested data), the percentiles of the wall time of
+  the blocks, and the worst peak of memory traced by tracemalloc.
+  """
+  def __init__(
+    self,
+    case: BenchmarkCase,
+    seconds: list[float],
+    megabytes: float,
+    block_seconds: list[float],
+    n_blocks: int,
+    n_retries: int,
+    peak_memory: float = None, # MB
+    peak_tmp: float = None # MB
+  ):
+    self.case = case
+    self.seconds = seconds
+    self.megabytes = megabytes
+    self.block_seconds = block_seconds
+    self.n_blocks = n_blocks
+    self.n_retries = n_retries
+    self.peak_memory = peak_memory
+    self.peak_tmp = peak_tmp
+
+
+  def get_throughput(self) -> float:
+    return self.megabytes / float(np.mean(self.seconds))
+
+
+  def get_percentile(self, q: float) -> float:
+    return float(np.percentile(self.block_seconds, q)) if self.block_seconds else 0.0
+
+
+  def to_dict(self) -> dict:
+    return {
+      'key': self.case.get_key(),
+      'shape': list(self.case.shape),
+      'req_max_size': self.case.req_max_size,
+      'max_workers': self.case.max_workers,
+      'seconds': self.seconds,
+      'megabytes': self.megabytes,
+      'throughput': self.get_throughput(),
+      'block_p50': self.get_percentile(50),
+      'block_p90': self.get_percentile(90),
+      'block_p99': self.get_percentile(99),
+      'n_blocks': self.n_blocks,
+      'n_retries': self.n_retries,
+      'peak_memory': self.peak_memory,
+      'peak_tmp': self.peak_tmp
+    }
+
+
+def run_case(case: BenchmarkCase, server: LocalOpendapServer, work_dir: Path, repeat: int = 1, trace_memory: bool = True) -> BenchmarkResult:
+  """
+  Extracts the whole dataset served by `server` `repeat` times.
+  """
+  seconds, block_seconds = [], []
+  megabytes, n_blocks, n_retries, peak_memory, peak_tmp = 0.0, 0, 0, 0.0, 0.0
+  for i in range(repeat):
+    path = Path(work_dir, f'out_{i}.nc')
+    if trace_memory:
+      tracemalloc.start()
+    start = time.perf_counter()
+    extractor = OpendapExtractor(
+      opendap_url=server.url,
+      req_max_size=case.req_max_size,
+      max_workers=case.max_workers,
+      backoff_base=0.1,
+      session_pool=SessionPool(pool_maxsize=max(case.max_workers, 10)))
+    extractor.sync_connect()
+    details = extractor.sync_extract(path)
+    extractor.close()
+    seconds.append(time.perf_counter() - start)
+    if trace_memory:
+      peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1] / 1e6)
+      tracemalloc.stop()
+    if not details.complete:
+      raise RuntimeError(f'Extraction not completed: {case.get_key()}')
+    telemetry = details.telemetry
+    blocks = [ b for b in telemetry.get_blocks() if b.outcome == 'completed' ]
+    block_seconds += [ b.wall_seconds for b in blocks ]
+    megabytes = telemetry.get_bytes_downloaded() / 1e6
+    n_blocks = len(blocks)
+    n_retries += telemetry.get_retries()
+    peak_tmp = max(peak_tmp, telemetry.peak_tmp_bytes / 1e6)
+    path.unlink()
+  return BenchmarkResult(
+    case=case,
+    seconds=seconds,
+    megabytes=megabytes,
+    block_seconds=block_seconds,
+    n_blocks=n_blocks,
+    n_retries=n_retries,
+    peak_memory=peak_memory if trace_memory else None,
+    peak_tmp=peak_tmp)
+
+
+def run_benchmark(
+  shapes: list[tuple[int, int, int]],
+  req_max_sizes: list[float],
+  workers: list[int],
+  repeat: int = 1,
+  trace_memory: bool = True,
+  log_stream = sys.stdout,
+  **server_kwargs
+) -> list[BenchmarkResult]:
+  """
+  Runs every case of the matrix. A server is started for every shape with
+  the `server_kwargs` (latency, jitter, failure_rate, max_response_bytes...).
+  """
+  results = []
+  with tempfile.TemporaryDirectory() as work_dir:
+    for shape in shapes:
+      dataset = make_dataset(n_times=shape[0], n_lats=shape[1], n_lons=shape[2])
+      with LocalOpendapServer(dataset, **server_kwargs) as server:
+        for req_max_size, max_workers in itertools.product(req_max_sizes, workers):
+          case = BenchmarkCase(shape, req_max_size, max_workers)
+          result = run_case(case, server, Path(work_dir), repeat=repeat, trace_memory=trace_memory)
+          print_result(result, log_stream)
+          results.append(result)
+  return results
+
+
+def print_result(result: BenchmarkResult, log_stream = sys.stdout):
+  data = result.to_dict()
+  memory = 'n/a' if data['peak_memory'] is None else f'{data["peak_memory"]:.1f}MB'
+  print(
+    f'{data["key"]}: {data["throughput"]:.2f}MB/s; {data["megabytes"]:.1f}MB in {np.mean(data["seconds"]):.2f}s; '
+    f'blocks={data["n_blocks"]}; p50={data["block_p50"]:.3f}s; p90={data["block_p90"]:.3f}s; p99={data["block_p99"]:.3f}s; '
+    f'retries={data["n_retries"]}; peak_memory={memory}; peak_tmp={data["peak_tmp"]:.1f}MB',
+    file=log_stream)
+
+
+def compare_with_baseline(results: list[BenchmarkResult], baseline: list[dict], tolerance: float, log_stream = sys.stdout) -> bool:
+  """
+  Returns False if the throughput of a case dropped more than `tolerance`
+  (a fraction) from the one of the same case in the `baseline`.
+  """
+  baseline = { data['key']: data for data in baseline }
+  ok = True
+  for result in results:
+    key = result.case.get_key()
+    if key not in baseline:
+      continue
+    before, now = baseline[key]['throughput'], result.get_throughput()
+    if now < before * (1 - tolerance):
+      print(f'REGRESSION {key}: {now:.2f}MB/s, baseline {before:.2f}MB/s.', file=log_stream)
+      ok = False
+  return ok
+
+
+def parse_shape(text: str) -> tuple[int, int, int]:
+  return tuple([ int(n) for n in text.lower().split('x') ])
+
+
+def main(argv: list[str] = None) -> int:
+  parser = argparse.ArgumentParser(description='Offline benchmark of the OpendapExtractor.')
+  parser.add_argument('--shapes', nargs='+', type=parse_shape, default=[(60, 90, 180)], help='Dataset shapes as TIMESxLATSxLONS.')
+  parser.add_argument('--req-max-sizes', nargs='+', type=float, default=[0.5, 2.0], help='Values of req_max_size (MB).')
+  parser.add_argument('--workers', nargs='+', type=int, default=[1, 4], help='Values of max_workers.')
+  parser.add_argument('--repeat', type=int, default=1)
+  parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every data request.')
+  parser.add_argument('--jitter', type=float, default=0.0, help='Maximum random seconds added to the latency.')
+  parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of a data request failing.')
+  parser.add_argument('--max-response-bytes', type=int, default=None, help='Data responses bigger than this fail.')
+  parser.add_argument('--no-memory', action='store_true', help='Do not trace memory (tracing slows the extraction down).')
+  parser.add_argument('--json', type=Path, default=None, help='Saves the results to this file.')
+  parser.add_argument('--baseline', type=Path, default=None, help='Results of a previous run to compare with.')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='Throughput drop allowed against the baseline.')
+  args = parser.parse_args(argv)
+  results = run_benchmark(
+    shapes=args.shapes,
+    req_max_sizes=args.req_max_sizes,
+    workers=args.workers,
+    repeat=args.repeat,
+    trace_memory=not args.no_memory,
+    latency=args.latency,
+    jitter=args.jitter,
+    failure_rate=args.failure_rate,
+    max_response_bytes=args.max_response_bytes)
+  if args.json is not None:
+    args.json.write_text(json.dumps([ r.to_dict() for r in results ], indent=2))
+  if args.baseline is not None:
+    return 0 if compare_with_baseline(results, json.loads(args.baseline.read_text()), args.tolerance) else 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,265 @@
+# Standard
+import sys
+import time
+import threading
+from pathlib import Path
+# Third party
+import numpy as np
+import pandas as pd
+import xarray as xr
+import requests
+import webob
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from pydap.model import DatasetType, BaseType, GridType
+# Own
+from siaextractlib.extractors import OpendapExtractor
+from siaextractlib.utils.locks import NETCDF_LOCK
+
+
+def make_dataset(
+  n_times: int = 40,
+  n_lats: int = 20,
+  n_lons: int = 30,
+  var_names: list[str] = ['sst']
+) -> xr.Dataset:
+  """
+  Builds a synthetic (time, lat, lon) dataset with deterministic values.
+  """
+  shape = (n_times, n_lats, n_lons)
+  data_vars = {}
+  for i, var_name in enumerate(var_names):
+    values = np.arange(np.prod(shape), dtype='float32').reshape(shape) + i
+    data_vars[var_name] = (('time', 'lat', 'lon'), values)
+  return xr.Dataset(
+    data_vars,
+    coords={
+      'time': ('time', pd.date_range('2020-01-01', periods=n_times, freq='D'), {'axis': 'T'}),
+      'lat': np.linspace(15, 30, n_lats),
+      'lon': np.linspace(-96, -85, n_lons)
+    })
+
+
+def write_dataset(path: Path | str, **kwargs) -> Path:
+  """
+  Writes a synthetic dataset to `path` and returns the path.
+  """
+  path = Path(path)
+  make_dataset(**kwargs).to_netcdf(path)
+  return path
+
+
+def to_pydap_dataset(dataset: xr.Dataset, name: str = 'dataset', chunk_sizes: dict[str, int] = None) -> DatasetType:
+  """
+  Converts a xarray dataset into a Pydap dataset. Datetime coordinates are
+  encoded as days since 1970-01-01. Data variables become grids whose maps
+  are their dimension coordinates. If `chunk_sizes` is given, the data
+  variables advertise it in the `_ChunkSizes` attribute, as THREDDS does.
+  """
+  pydap_dataset = DatasetType(name, attributes=dict(dataset.attrs))
+  coords = {}
+  for coord_name in dataset.dims:
+    coord = dataset[coord_name]
+    values = coord.values
+    attributes = dict(coord.attrs)
+    if np.issubdtype(values.dtype, np.datetime64):
+      values = (values - np.datetime64('1970-01-01')) / np.timedelta64(1, 'D')
+      attributes['units'] = 'days since 1970-01-01'
+    coords[coord_name] = BaseType(coord_name, values, dimensions=(coord_name, ), attributes=attributes)
+    pydap_dataset[coord_name] = coords[coord_name]
+  for var_name, var in dataset.data_vars.items():
+    attributes = dict(var.attrs)
+    if chunk_sizes is not None:
+      attributes['_ChunkSizes'] = [ chunk_sizes.get(d, dataset.sizes[d]) for d in var.dims ]
+    grid = GridType(var_name, attributes=attributes)
+    grid[var_name] = BaseType(var_name, var.values, dimensions=var.dims, attributes=attributes)
+    for dim_name in var.dims:
+      grid[dim_name] = coords[dim_name]
+    pydap_dataset[var_name] = grid
+  return pydap_dataset
+
+
+class LocalOpendapExtractor(OpendapExtractor):
+  """
+  An OpendapExtractor that reads a local NetCDF file instead of a remote
+  dataset. The `opendap_url` is the path of the file.
+  The file is loaded (not decoded) into an in-memory store, so, as with a
+  Pydap store, reading the dataset does not go through the netCDF library.
+  """
+  def open_store(self, session: requests.Session):
+    with NETCDF_LOCK, xr.open_dataset(self.opendap_url, decode_cf=False) as raw:
+      raw = raw.load()
+    return xr.backends.InMemoryDataStore(variables=dict(raw.variables), attributes=dict(raw.attrs))
+
+
+class FlakyLocalOpendapExtractor(LocalOpendapExtractor):
+  """
+  A LocalOpendapExtractor whose fetches fail for the blocks containing
+  any of the times in `failing_times`, after `failure_delay` seconds (so the
+  blocks after them finish first). Every fetch is counted.
+  """
+  def __init__(self, failing_times: list[str] = [], failure_delay: float = 0, **kwargs) -> None:
+    super().__init__(**kwargs)
+    self.failing_times = [ np.datetime64(t) for t in failing_times ]
+    self.failure_delay = failure_delay
+    self.fetch_count = 0
+
+
+  def check(self, subset: xr.Dataset):
+    self.fetch_count += 1
+    for t in self.failing_times:
+      if t in subset['time'].values:
+        time.sleep(self.failure_delay)
+        raise IOError(f'Simulated failure for time {t}.')
+
+
+  def fetch(self, subset: xr.Dataset, path: Path | str):
+    self.check(subset)
+    return super().fetch(subset, path)
+
+
+  def fetch_part(self, subset: xr.Dataset):
+    self.check(subset)
+    return super().fetch_part(subset)
+
+
+class SizeLimitedLocalOpendapExtractor(LocalOpendapExtractor):
+  """
+  A LocalOpendapExtractor whose fetches fail, as a server rejecting or
+  timing out large requests, when they are bigger than `max_fetch_bytes`.
+  The size of every successful fetch is recorded.
+  """
+  def __init__(self, max_fetch_bytes: int, **kwargs) -> None:
+    super().__init__(**kwargs)
+    self.max_fetch_bytes = max_fetch_bytes
+    self.fetched_bytes = []
+    self.n_rejected = 0
+
+
+  def check(self, subset: xr.Dataset):
+    if subset.nbytes > self.max_fetch_bytes:
+      self.n_rejected += 1
+      raise IOError(f'Simulated rejection of a request of {subset.nbytes} bytes.')
+    self.fetched_bytes.append(subset.nbytes)
+
+
+  def fetch(self, subset: xr.Dataset, path: Path | str):
+    self.check(subset)
+    return super().fetch(subset, path)
+
+
+  def fetch_part(self, subset: xr.Dataset):
+    self.check(subset)
+    return super().fetch_part(subset)
+
+
+class DownloadProbe:
+  """
+  Counts the downloads running at once across the extractors sharing it.
+  """
+  def __init__(self) -> None:
+    self.running = 0
+    self.max_running = 0
+    self.__lock = threading.Lock()
+
+
+  def start(self):
+    with self.__lock:
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+
+
+  def stop(self):
+    with self.__lock:
+      self.running -= 1
+
+
+class SlowLocalOpendapExtractor(LocalOpendapExtractor):
+  """
+  A LocalOpendapExtractor whose downloads take `delay` seconds more, as
+  those of a remote server, and are counted by `probe`.
+  """
+  def __init__(self, probe: DownloadProbe, delay: float = 0.02, **kwargs) -> None:
+    super().__init__(**kwargs)
+    self.probe = probe
+    self.delay = delay
+
+
+  def download(self, fn, *args):
+    self.probe.start()
+    try:
+      time.sleep(self.delay)
+      return fn(*args)
+    finally:
+      self.probe.stop()
+
+
+  def fetch(self, subset: xr.Dataset, path: Path | str):
+    return self.download(super().fetch, subset, path)
+
+
+  def fetch_part(self, subset: xr.Dataset):
+    return self.download(super().fetch_part, subset)
+
+
+class DelayedLocalOpendapExtractor(LocalOpendapExtractor):
+  """
+  A LocalOpendapExtractor whose fetches of the blocks containing any of the
+  times in `delayed_times` take `delay` seconds more (or the seconds they
+  map to, if it is a dict). The start and end of every fetch are recorded
+  by the first time of its block, and the numbers of the blocks in the
+  order they are merged.
+  """
+  def __init__(self, delayed_times: list[str] | dict[str, float] = [], delay: float = 0.5, **kwargs) -> None:
+    super().__init__(**kwargs)
+    if not isinstance(delayed_times, dict):
+      delayed_times = { t: delay for t in delayed_times }
+    self.delays = { np.datetime64(t): d for t, d in delayed_times.items() }
+    self.fetch_spans: dict[np.datetime64, tuple[float, float]] = {}
+    self.merged: list[int] = []
+    self.__lock = threading.Lock()
+
+
+  def fetch(self, subset: xr.Dataset, path: Path | str):
+    start = time.monotonic()
+    delays = [ d for t, d in self.delays.items() if t in subset['time'].values ]
+    if delays:
+      time.sleep(max(delays))
+    result = super().fetch(subset, path)
+    with self.__lock:
+      self.fetch_spans[subset['time'].values[0]] = (start, time.monotonic())
+    return result
+
+
+  def merge_block(self, writer, block, *args, **kwargs):
+    self.merged.append(block.number)
+    return super().merge_block(writer, block, *args, **kwargs)
+
+
+class WsgiAdapter(BaseAdapter):
+  """
+  A requests adapter that answers the requests with a WSGI `application`
+  (e.g. a Pydap handler) instead of sending them. The URL of every request
+  is recorded.
+  """
+  def __init__(self, application) -> None:
+    super().__init__()
+    self.application = application
+    self.urls = []
+
+
+  def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+    self.urls.append(request.url)
+    answer = webob.Request.blank(request.url).get_response(self.application)
+    response = requests.Response()
+    response.status_code = answer.status_code
+    response.reason = answer.status.split(' ', 1)[-1]
+    response.headers = CaseInsensitiveDict(answer.headers)
+    response._content = answer.body
+    response.url = request.url
+    response.request = request
+    return response
+
+
+  def close(self):
+    pass
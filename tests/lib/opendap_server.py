@@ -0,0 +1,131 @@
+# Standard
+import time
+import random
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+# Third party
+import xarray as xr
+from pydap.handlers.lib import BaseHandler
+# Custom for testing
+from lib.local_opendap import to_pydap_dataset
+
+
+class FaultInjector:
+  """
+  WSGI middleware that makes the data requests (`.dods`) of `application`
+  behave as a slow or unreliable server: every one is delayed `latency`
+  seconds plus a random jitter of up to `jitter` seconds, fails with
+  `failure_status` with probability `failure_rate` (with a `Retry-After`
+  header if `retry_after` is given), and fails if its response is bigger
+  than `max_response_bytes`, as servers rejecting big requests do. Metadata
+  requests are not affected. Requests are counted.
+  """
+  def __init__(
+    self,
+    application,
+    latency: float = 0.0, # seconds
+    jitter: float = 0.0, # seconds
+    failure_rate: float = 0.0,
+    failure_status: str = '500 Internal Server Error',
+    max_response_bytes: int = None,
+    retry_after: str = None,
+    seed: int = 0
+  ):
+    self.application = application
+    self.latency = latency
+    self.jitter = jitter
+    self.failure_rate = failure_rate
+    self.failure_status = failure_status
+    self.max_response_bytes = max_response_bytes
+    self.retry_after = retry_after
+    self.rng = random.Random(seed)
+    self.n_requests = 0
+    self.n_failures = 0
+    self.bytes_sent = 0
+    self.__lock = threading.Lock()
+
+
+  def fail(self, start_response, message: str):
+    with self.__lock:
+      self.n_failures += 1
+    body = message.encode('utf-8')
+    headers = [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))]
+    if self.retry_after is not None:
+      headers.append(('Retry-After', self.retry_after))
+    start_response(self.failure_status, headers)
+    return [body]
+
+
+  def __call__(self, environ, start_response):
+    if not environ.get('PATH_INFO', '').endswith('.dods'):
+      return self.application(environ, start_response)
+    with self.__lock:
+      self.n_requests += 1
+      delay = self.latency + self.rng.uniform(0, self.jitter)
+      failing = self.rng.random() < self.failure_rate
+    if delay > 0:
+      time.sleep(delay)
+    if failing:
+      return self.fail(start_response, 'Simulated server failure.')
+    captured = {}
+    def capture(status, headers, exc_info=None):
+      captured['status'], captured['headers'] = status, headers
+    body = b''.join(self.application(environ, capture))
+    if self.max_response_bytes is not None and len(body) > self.max_response_bytes:
+      return self.fail(start_response, f'Request too big: {len(body)} bytes. max={self.max_response_bytes}')
+    with self.__lock:
+      self.bytes_sent += len(body)
+    headers = [ (k, v) for k, v in captured['headers'] if k.lower() != 'content-length' ]
+    start_response(captured['status'], headers + [('Content-Length', str(len(body)))])
+    return [body]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+  daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+  def log_message(self, *args):
+    pass
+
+
+class LocalOpendapServer:
+  """
+  A DAP2 server on localhost that serves `dataset` with Pydap, one thread
+  per request. The keyword arguments configure its FaultInjector. Use it
+  as a context manager or call start() and shutdown().
+  """
+  def __init__(self, dataset: xr.Dataset, name: str = 'dataset', chunk_sizes: dict[str, int] = None, **kwargs):
+    self.name = name
+    self.faults = FaultInjector(BaseHandler(to_pydap_dataset(dataset, name=name, chunk_sizes=chunk_sizes)), **kwargs)
+    self.httpd: ThreadingWSGIServer = None
+    self.thread: threading.Thread = None
+
+
+  @property
+  def url(self) -> str:
+    return f'http://127.0.0.1:{self.httpd.server_port}/{self.name}'
+
+
+  def start(self):
+    self.httpd = make_server('127.0.0.1', 0, self.faults, server_class=ThreadingWSGIServer, handler_class=QuietRequestHandler)
+    self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={ 'poll_interval': 0.05 }, daemon=True)
+    self.thread.start()
+    return self
+
+
+  def shutdown(self):
+    if self.httpd is not None:
+      self.httpd.shutdown()
+      self.httpd.server_close()
+      self.thread.join()
+      self.httpd = None
+
+
+  def __enter__(self):
+    return self.start()
+
+
+  def __exit__(self, *args):
+    self.shutdown()
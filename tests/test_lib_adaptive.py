@@ -0,0 +1,55 @@
+# Standard
+import random
+import unittest
+
+# Own
+from siaextractlib.processing.adaptive import Backoff, AdaptiveSizeController
+
+
+class TestBackoff(unittest.TestCase):
+  def test_delays_grow_and_are_capped(self):
+    backoff = Backoff(base=1.0, cap=5.0, rng=random.Random(0))
+    self.assertEqual(backoff.get_delay(1), 0.0)
+    for attempt in range(2, 10):
+      delays = [ backoff.get_delay(attempt) for _ in range(50) ]
+      self.assertTrue(all([ 0 <= d <= min(5.0, 2 ** (attempt - 2)) for d in delays ]))
+    # Jittered, not fixed.
+    self.assertGreater(len(set([ backoff.get_delay(4) for _ in range(10) ])), 1)
+
+
+  def test_no_delay_without_base(self):
+    backoff = Backoff(base=0)
+    self.assertEqual(backoff.get_delay(5), 0.0)
+
+
+class TestAdaptiveSizeController(unittest.TestCase):
+  def test_halves_on_failure_down_to_min_size(self):
+    controller = AdaptiveSizeController(size=100, min_size=10, max_size=100)
+    controller.record_failure(100)
+    self.assertEqual(controller.get_size(), 50)
+    # Concurrent failures of the same size halve it only once.
+    controller.record_failure(100)
+    self.assertEqual(controller.get_size(), 50)
+    for _ in range(5):
+      controller.record_failure(controller.get_size())
+    self.assertEqual(controller.get_size(), 10)
+
+
+  def test_grows_after_a_run_of_fast_successes(self):
+    controller = AdaptiveSizeController(size=100, min_size=10, max_size=150, growth_factor=1.25, growth_run=3, target_seconds=1)
+    controller.record_success(100, 0.1)
+    controller.record_success(100, 0.1)
+    # A slow download breaks the run.
+    controller.record_success(100, 5)
+    controller.record_success(100, 0.1)
+    controller.record_success(100, 0.1)
+    self.assertEqual(controller.get_size(), 100)
+    controller.record_success(100, 0.1)
+    self.assertEqual(controller.get_size(), 125)
+    for _ in range(6):
+      controller.record_success(controller.get_size(), 0.1)
+    self.assertEqual(controller.get_size(), 150)
+
+
+if __name__ == '__main__':
+  unittest.main()
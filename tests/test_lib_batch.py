@@ -0,0 +1,138 @@
+# Standard
+import asyncio
+import unittest
+import tempfile
+import warnings
+from pathlib import Path
+
+# Third party
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.utils.log import LogStream
+from siaextractlib.processing import wrangling
+from siaextractlib.processing.parallelism import Scheduler
+from siaextractlib.utils.exceptions import ExtractionCancelledException
+from siaextractlib.extractors import BatchExtractor, ExtractionSpec
+
+# Custom for testing
+from lib.local_opendap import SlowLocalOpendapExtractor, DownloadProbe, make_dataset, write_dataset
+
+warnings.filterwarnings("ignore")
+
+
+class LocalBatchExtractor(BatchExtractor):
+  """
+  A BatchExtractor of local NetCDF files, whose downloads are counted by
+  `probe`.
+  """
+  def __init__(self, specs: list[ExtractionSpec], probe: DownloadProbe, **kwargs) -> None:
+    super().__init__(specs, **kwargs)
+    self.probe = probe
+
+
+  def new_extractor(self, spec: ExtractionSpec) -> SlowLocalOpendapExtractor:
+    return SlowLocalOpendapExtractor(
+      probe=self.probe,
+      opendap_url=spec.opendap_url,
+      dim_constraints=spec.dim_constraints,
+      requested_vars=spec.requested_vars,
+      log_stream=self.log_stream,
+      concurrency_limiter=self.concurrency_limiter,
+      scheduler=self.scheduler,
+      **{ **self.extractor_options, **spec.options })
+
+
+class TestBatchExtractor(unittest.TestCase):
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.data_dir = Path(self.tmp_dir.name)
+    self.source_path = write_dataset(Path(self.data_dir, 'source.nc'))
+    self.probe = DownloadProbe()
+
+
+  def tearDown(self) -> None:
+    self.tmp_dir.cleanup()
+
+
+  def new_spec(self, name: str, lat: slice = slice(18, 27), source_path: Path = None) -> ExtractionSpec:
+    return ExtractionSpec(
+      opendap_url=str(source_path if source_path is not None else self.source_path),
+      filepath=Path(self.data_dir, f'{name}.nc'),
+      requested_vars=['sst'],
+      dim_constraints={ 'time': slice('2020-01-05', '2020-02-03'), 'lat': lat },
+      options={ 'req_max_size': 0.01 })
+
+
+  def new_batch(self, specs: list[ExtractionSpec], **kwargs) -> LocalBatchExtractor:
+    options = { 'max_jobs': 3, 'max_per_host': 2, 'max_workers': 3, 'log_stream': LogStream(), 'verbose': True }
+    options.update(kwargs)
+    return LocalBatchExtractor(specs, probe=self.probe, **options)
+
+
+  def assert_extracted(self, spec: ExtractionSpec):
+    expected = wrangling.slice_dice(make_dataset(), spec.dim_constraints, spec.requested_vars, squeeze=False)
+    with xr.open_dataset(spec.filepath) as extracted:
+      np.testing.assert_array_equal(extracted['time'].values, expected['time'].values)
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+
+
+  def test_results_are_yielded_as_they_complete(self):
+    specs = [ self.new_spec('a'), self.new_spec('b', lat=slice(15, 20)), self.new_spec('c', lat=slice(25, 30)) ]
+    specs.append(self.new_spec('missing', source_path=Path(self.data_dir, 'missing.nc')))
+    results = list(self.new_batch(specs).sync_extract())
+    self.assertEqual(sorted([ r.spec.name for r in results ]), sorted([ s.name for s in specs ]))
+    for result in results:
+      if result.spec.name == 'missing.nc':
+        self.assertFalse(result.ok())
+        self.assertIsNotNone(result.error)
+      else:
+        self.assertTrue(result.ok(), str(result))
+        self.assert_extracted(result.spec)
+    # Every extractor has 3 workers, but the host allows 2 downloads at once.
+    self.assertLessEqual(self.probe.max_running, 2)
+
+
+  def test_async_batch(self):
+    specs = [ self.new_spec('a'), self.new_spec('b', lat=slice(15, 20)) ]
+    batch = self.new_batch(specs, max_concurrent=1)
+    async def run():
+      return [ result async for result in batch.aextract() ]
+    results = asyncio.run(run())
+    self.assertEqual(len(results), 2)
+    self.assertTrue(all([ r.ok() for r in results ]))
+    self.assertEqual(self.probe.max_running, 1)
+    for spec in specs:
+      self.assert_extracted(spec)
+
+
+  def test_closing_the_iterator_cancels_the_rest(self):
+    specs = [ self.new_spec(name) for name in ['a', 'b', 'c'] ]
+    results = self.new_batch(specs, max_jobs=1).sync_extract()
+    first = next(results)
+    self.assertTrue(first.ok())
+    results.close()
+    self.assertFalse(specs[2].filepath.exists())
+
+
+  def test_extractions_are_jobs_of_the_scheduler(self):
+    scheduler = Scheduler(max_workers=1)
+    specs = [ self.new_spec(name) for name in ['a', 'b', 'c'] ]
+    results = self.new_batch(specs, scheduler=scheduler).sync_extract()
+    first = next(results)
+    self.assertEqual(first.spec.name, 'a.nc')
+    self.assertTrue(first.ok())
+    # The scheduler runs one extraction at a time: the last one is queued.
+    jobs = scheduler.get_jobs()
+    self.assertIn('c.nc', [ job.name for job in jobs ])
+    for job in jobs:
+      job.cancel()
+    last = [ r for r in results if r.spec.name == 'c.nc' ][0]
+    self.assertIsInstance(last.error, ExtractionCancelledException)
+    self.assertFalse(specs[2].filepath.exists())
+    scheduler.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+# Standard
+import os
+import time
+import unittest
+import tempfile
+import warnings
+from pathlib import Path
+
+# Third party
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.utils.cache import BlockCache
+from siaextractlib.processing import planning
+from siaextractlib.processing.planning import Block
+from siaextractlib.processing.writers import OutputEncoding
+
+warnings.filterwarnings("ignore")
+
+
+class TestBlockCache(unittest.TestCase):
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.cache_dir = Path(self.tmp_dir.name, 'blocks')
+
+
+  def tearDown(self) -> None:
+    self.tmp_dir.cleanup()
+
+
+  def new_block_file(self, name: str, nbytes: int = 1000) -> Path:
+    path = Path(self.tmp_dir.name, name)
+    path.write_bytes(b'\0' * nbytes)
+    return path
+
+
+  def test_keys_identify_the_blocks(self):
+    key = BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[0, 6]] }, version='v1')
+    self.assertEqual(key, BlockCache.get_key('http://server/dataset', ['sss', 'sst'], { 'time': [[0, 6]] }, version='v1'))
+    self.assertNotEqual(key, BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[6, 12]] }, version='v1'))
+    self.assertNotEqual(key, BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[0, 6]] }, version='v2'))
+    self.assertNotEqual(key, BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[0, 6]] }, version='v1', encoding=OutputEncoding(dtypes={ 'sst': 'int16' }).to_dict()))
+    self.assertNotEqual(key, BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[0, 6]] }, version='v1', encoding=OutputEncoding(zlib=True).to_dict()))
+    self.assertNotEqual(key, BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[0, 6]] }, version='v1', decode_options={ 'mask_and_scale': False }))
+    self.assertEqual(key, BlockCache.get_key('http://server/dataset', ['sst', 'sss'], { 'time': [[0, 6]] }, version='v1', decode_options={}, encoding={}))
+
+
+  def test_put_and_get(self):
+    cache = BlockCache(self.cache_dir)
+    self.assertIsNone(cache.get('a'))
+    source = self.new_block_file('a.nc')
+    cache.put('a', source)
+    source.unlink()
+    self.assertEqual(cache.get('a').read_bytes(), b'\0' * 1000)
+    dataset = xr.Dataset({ 'sst': ('time', np.arange(4.0)) })
+    cache.put_dataset('b', dataset)
+    with xr.open_dataset(cache.get('b')) as cached:
+      np.testing.assert_array_equal(cached['sst'].values, dataset['sst'].values)
+    cache.clear()
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(cache.get_size(), 0)
+
+
+  def test_least_recently_used_blocks_are_evicted(self):
+    cache = BlockCache(self.cache_dir, max_size=0.0025) # 2 blocks of 1000 bytes.
+    cache.put('a', self.new_block_file('a.nc'))
+    cache.put('b', self.new_block_file('b.nc'))
+    # "a" was used after "b".
+    past = time.time() - 10
+    os.utime(cache.get_path('b'), (past, past))
+    self.assertIsNotNone(cache.get('a'))
+    cache.put('c', self.new_block_file('c.nc'))
+    self.assertIsNotNone(cache.get('a'))
+    self.assertIsNone(cache.get('b'))
+    self.assertIsNotNone(cache.get('c'))
+    self.assertLessEqual(cache.get_size(), 2500)
+
+
+  def test_expired_blocks_are_evicted(self):
+    cache = BlockCache(self.cache_dir, ttl=60)
+    cache.put('a', self.new_block_file('a.nc'))
+    past = time.time() - 120
+    os.utime(cache.get_path('a'), (past, past))
+    self.assertIsNone(cache.get('a'))
+    self.assertFalse(cache.get_path('a').exists())
+
+
+class TestBlockRanges(unittest.TestCase):
+  def test_ranges_in_the_dataset(self):
+    dataset = xr.Dataset(coords={ 'time': np.arange(10), 'lat': np.arange(5) })
+    subset = dataset.sel(time=[2, 3, 4, 5, 8], lat=slice(1, 3))
+    positions = planning.get_index_positions(dataset, subset)
+    ranges = planning.get_block_ranges(Block(number=0, slices={ 'time': slice(0, 3) }), positions)
+    self.assertEqual(ranges, { 'time': [[2, 5]], 'lat': [[1, 4]] })
+    ranges = planning.get_block_ranges(Block(number=1, slices={ 'time': slice(3, 5) }), positions)
+    self.assertEqual(ranges, { 'time': [[5, 6], [8, 9]], 'lat': [[1, 4]] })
+
+
+  def test_ranges_of_a_descending_coordinate(self):
+    dataset = xr.Dataset(coords={ 'lat': np.arange(10)[::-1] })
+    # Subset in ascending order of latitude, backwards in the dataset.
+    subset = dataset.isel(lat=slice(7, 1, -1))
+    positions = planning.get_index_positions(dataset, subset)
+    ranges = planning.get_block_ranges(Block(number=0, slices={ 'lat': slice(0, 3) }), positions)
+    self.assertEqual(ranges, { 'lat': [[5, 8]] })
+
+
+if __name__ == '__main__':
+  unittest.main()
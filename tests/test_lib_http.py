@@ -0,0 +1,210 @@
+# Standard
+import time
+import unittest
+import warnings
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Third party
+import numpy as np
+from pydap.handlers.lib import BaseHandler
+
+# Own
+from siaextractlib.utils.auth import SimpleAuth
+from siaextractlib.utils.http import SessionPool, HostRateLimiter, ThrottledAdapter, get_default_pool, parse_retry_after
+from siaextractlib.extractors import OpendapExtractor
+
+# Custom for testing
+from lib.local_opendap import WsgiAdapter, make_dataset, to_pydap_dataset
+
+warnings.filterwarnings("ignore")
+
+
+class TestSessionPool(unittest.TestCase):
+  def setUp(self) -> None:
+    self.pool = SessionPool(pool_maxsize=16, max_retries=2)
+
+
+  def tearDown(self) -> None:
+    self.pool.close()
+
+
+  def test_sessions_are_shared_by_host_and_credentials(self):
+    auth = SimpleAuth('user', 'passwd')
+    session = self.pool.get_session('https://host.org/thredds/dodsC/a.nc', auth)
+    self.assertIs(session, self.pool.get_session('https://host.org/thredds/dodsC/b.nc', auth))
+    self.assertIsNot(session, self.pool.get_session('https://host.org/thredds/dodsC/a.nc', SimpleAuth('other', 'passwd')))
+    self.assertIsNot(session, self.pool.get_session('https://other.org/thredds/dodsC/a.nc', auth))
+    self.assertEqual(session.auth, ('user', 'passwd'))
+    self.assertEqual(len(self.pool), 3)
+
+
+  def test_adapter_settings(self):
+    session = self.pool.get_session('https://host.org/thredds/dodsC/a.nc')
+    adapter = session.get_adapter('https://host.org/thredds/dodsC/a.nc')
+    self.assertEqual(adapter._pool_maxsize, 16)
+    self.assertEqual(adapter.max_retries.total, 2)
+    self.assertIn(503, adapter.max_retries.status_forcelist)
+
+
+  def test_extractors_share_the_default_pool(self):
+    url = 'https://host.org/thredds/dodsC/a.nc'
+    first = OpendapExtractor(opendap_url=url)
+    second = OpendapExtractor(opendap_url=url)
+    self.assertIs(first.get_session(), second.get_session())
+    self.assertIs(first.get_session(), get_default_pool().get_session(url))
+    own = OpendapExtractor(opendap_url=url, session_pool=self.pool)
+    self.assertIs(own.get_session(), self.pool.get_session(url))
+
+
+  def test_pydap_requests_go_through_the_session(self):
+    url = 'http://opendap.test/thredds/dodsC/dataset'
+    adapter = WsgiAdapter(BaseHandler(to_pydap_dataset(make_dataset())))
+    self.pool.get_session(url).mount('http://', adapter)
+    extractor = OpendapExtractor(opendap_url=url, session_pool=self.pool).sync_connect()
+    values = extractor.dataset['sst'].isel(time=0).values
+    extractor.close()
+    np.testing.assert_array_equal(values, make_dataset()['sst'].isel(time=0).values)
+    self.assertIn(f'{url}.dds', adapter.urls)
+    self.assertIn(f'{url}.das', adapter.urls)
+    self.assertTrue(any([ u.startswith(f'{url}.dods?sst') for u in adapter.urls ]), adapter.urls)
+
+
+  def test_throttled_adapter(self):
+    limiter = HostRateLimiter(requests_per_second=5)
+    pool = SessionPool(max_retries=2, rate_limiter=limiter)
+    adapter = pool.get_session('https://host.org/a.nc').get_adapter('https://host.org/a.nc')
+    self.assertIsInstance(adapter, ThrottledAdapter)
+    self.assertIs(adapter.rate_limiter, limiter)
+    self.assertEqual(adapter.throttle_retries, 2)
+    # Retried by the adapter, not by urllib3.
+    self.assertNotIn(429, adapter.max_retries.status_forcelist)
+    self.assertIn(500, adapter.max_retries.status_forcelist)
+    pool.close()
+
+
+class ChunkedHandler(BaseHTTPRequestHandler):
+  """
+  Answers every GET with `n_chunks` chunks of `chunk_size` bytes, with
+  chunked transfer encoding (no Content-Length).
+  """
+  protocol_version = 'HTTP/1.1'
+  n_chunks = 16
+  chunk_size = 10000
+
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+    for _ in range(self.n_chunks):
+      self.wfile.write(f'{self.chunk_size:x}\r\n'.encode() + b'x' * self.chunk_size + b'\r\n')
+    self.wfile.write(b'0\r\n\r\n')
+
+
+  def log_message(self, *args):
+    pass
+
+
+class TestThrottledAdapter(unittest.TestCase):
+  def setUp(self) -> None:
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), ChunkedHandler)
+    self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ 'poll_interval': 0.05 }, daemon=True)
+    self.thread.start()
+    self.url = f'http://127.0.0.1:{self.server.server_port}/data'
+    self.host = f'127.0.0.1:{self.server.server_port}'
+
+
+  def tearDown(self) -> None:
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+
+  def test_chunked_responses_are_charged_as_read(self):
+    # 100000 bytes/s, with a burst of 100000 bytes.
+    limiter = HostRateLimiter(max_bandwidth=0.1, max_connections=1)
+    pool = SessionPool(rate_limiter=limiter)
+    nbytes = ChunkedHandler.n_chunks * ChunkedHandler.chunk_size
+    start = time.monotonic()
+    with pool.get_session(self.url).get(self.url, stream=True) as response:
+      self.assertNotIn('Content-Length', response.headers)
+      # The connection is held while the body is read.
+      self.assertEqual(limiter.connections, { self.host: 1 })
+      body = b''.join(response.iter_content(chunk_size=10000))
+    self.assertEqual(len(body), nbytes)
+    # The 60000 bytes over the burst are paid before the end of the body.
+    self.assertGreaterEqual(time.monotonic() - start, 0.5)
+    self.assertEqual(limiter.connections, { self.host: 0 })
+    # Responses read by requests (not streamed) are charged too.
+    start = time.monotonic()
+    self.assertEqual(len(pool.get_session(self.url).get(self.url).content), nbytes)
+    self.assertGreaterEqual(time.monotonic() - start, 1.5)
+    self.assertEqual(limiter.connections, { self.host: 0 })
+    pool.close()
+
+
+class TestHostRateLimiter(unittest.TestCase):
+  def request(self, limiter: HostRateLimiter, url: str, nbytes: int = 0):
+    limiter.release(limiter.acquire(url), nbytes)
+
+
+  def test_requests_per_second(self):
+    limiter = HostRateLimiter(requests_per_second=20, burst=2)
+    start = time.monotonic()
+    for _ in range(6):
+      self.request(limiter, 'https://host.org/a.nc')
+    # 2 at once, then one every 0.05s.
+    self.assertGreaterEqual(time.monotonic() - start, 0.18)
+    start = time.monotonic()
+    self.request(limiter, 'https://other.org/a.nc')
+    self.assertLess(time.monotonic() - start, 0.05)
+
+
+  def test_max_connections(self):
+    limiter = HostRateLimiter(max_connections=2, host_limits={ 'other.org': { 'max_connections': 1 } })
+    hosts = [ limiter.acquire('https://host.org/a.nc') for _ in range(2) ]
+    other = limiter.acquire('https://other.org/a.nc')
+    acquired = threading.Event()
+    def third():
+      limiter.acquire('https://host.org/b.nc')
+      acquired.set()
+    thread = threading.Thread(target=third)
+    thread.start()
+    self.assertFalse(acquired.wait(0.2))
+    limiter.release(hosts[0])
+    self.assertTrue(acquired.wait(1))
+    thread.join()
+    self.assertEqual(limiter.connections, { 'host.org': 2, 'other.org': 1 })
+    self.assertGreater(limiter.get_wait(other), 0)
+
+
+  def test_bandwidth_debt_is_paid_before_the_next_request(self):
+    limiter = HostRateLimiter(max_bandwidth=0.01) # 10000 bytes/s.
+    self.request(limiter, 'https://host.org/a.nc', nbytes=12000)
+    start = time.monotonic()
+    self.request(limiter, 'https://host.org/a.nc')
+    self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+  def test_deferred_hosts_wait(self):
+    limiter = HostRateLimiter()
+    limiter.defer('host.org', 0.2)
+    start = time.monotonic()
+    self.request(limiter, 'https://other.org/a.nc')
+    self.assertLess(time.monotonic() - start, 0.1)
+    self.request(limiter, 'https://host.org/a.nc')
+    self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+  def test_parse_retry_after(self):
+    self.assertEqual(parse_retry_after('5'), 5.0)
+    self.assertAlmostEqual(parse_retry_after(formatdate(time.time() + 60, usegmt=True)), 60, delta=2)
+    self.assertEqual(parse_retry_after(formatdate(time.time() - 60, usegmt=True)), 0.0)
+    self.assertIsNone(parse_retry_after(None))
+    self.assertIsNone(parse_retry_after('soon'))
+
+
+if __name__ == '__main__':
+  unittest.main()
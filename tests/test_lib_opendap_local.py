@@ -0,0 +1,786 @@
+# Standard
+import asyncio
+import time
+import importlib.util
+import unittest
+import tempfile
+import warnings
+import threading
+from pathlib import Path
+
+# Third party
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.utils.log import LogStream
+from siaextractlib.processing import wrangling
+from siaextractlib.utils.manifest import BlockManifest, BlockStatus
+from siaextractlib.utils.cache import MetadataCache, BlockCache
+from siaextractlib.utils.staging import StagingArea
+from siaextractlib.utils.exceptions import ExtractionException, ExtractionCancelledException
+from siaextractlib.utils.telemetry import InMemoryMetricsHook, ExtractionTelemetry
+from siaextractlib.processing.writers import OutputEncoding
+from siaextractlib.processing.parallelism import CancelToken, Scheduler
+
+# Custom for testing
+from lib.local_opendap import LocalOpendapExtractor, FlakyLocalOpendapExtractor, SizeLimitedLocalOpendapExtractor, DelayedLocalOpendapExtractor, make_dataset, write_dataset
+
+warnings.filterwarnings("ignore")
+
+
+class LocalOpendapTestCase(unittest.TestCase):
+  """
+  Runs the OpendapExtractor against local NetCDF files, so no network
+  access or credentials are needed.
+  """
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.data_dir = Path(self.tmp_dir.name)
+    self.source_path = write_dataset(Path(self.data_dir, 'source.nc'))
+    self.log_stream = LogStream()
+
+
+  def tearDown(self) -> None:
+    self.tmp_dir.cleanup()
+
+
+  def new_extractor(self, extractor_class = LocalOpendapExtractor, **kwargs) -> LocalOpendapExtractor:
+    options = {
+      'dim_constraints': {
+        'time': slice('2020-01-05', '2020-02-03'),
+        'lat': slice(18, 27)
+      },
+      'requested_vars': ['sst'],
+      'req_max_size': 0.01,
+      'log_stream': self.log_stream,
+      'verbose': True
+    }
+    options.update(kwargs)
+    return extractor_class(opendap_url=str(self.source_path), **options)
+
+
+  def expected_subset(self, extractor: LocalOpendapExtractor) -> xr.Dataset:
+    dataset = make_dataset()
+    return wrangling.slice_dice(dataset, extractor.dim_constraints, extractor.requested_vars, squeeze=False)
+
+
+  def assert_extracted(self, extractor: LocalOpendapExtractor, path: Path):
+    expected = self.expected_subset(extractor)
+    with xr.open_dataset(path) as extracted:
+      np.testing.assert_array_equal(extracted['time'].values, expected['time'].values)
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+
+
+class TestLocalOpendap(LocalOpendapTestCase):
+  def test_sequential_extraction(self):
+    extractor = self.new_extractor().sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_concurrent_extraction_keeps_block_order(self):
+    extractor = self.new_extractor(max_workers=4).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+
+
+  def test_blocks_after_a_slow_one_are_fetched_meanwhile(self):
+    extractor = self.new_extractor(
+      extractor_class=DelayedLocalOpendapExtractor,
+      delayed_times=['2020-01-05', '2020-01-11'],
+      max_workers=4).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    spans = [ extractor.fetch_spans[t] for t in sorted(extractor.fetch_spans) ]
+    self.assertEqual(len(spans), 5)
+    # The last blocks are fetched while the first ones are downloading...
+    first_end = min([ end for _, end in spans[:2] ])
+    self.assertTrue(all([ end < first_end for _, end in spans[2:4] ]))
+    # ... but merged after them.
+    self.assertEqual(extractor.merged, [0, 1, 2, 3, 4])
+
+
+  def test_multi_dimensional_blocks(self):
+    # A single time step does not fit in a block, so latitude is cut too.
+    extractor = self.new_extractor(req_max_size=0.0008).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    self.assertIn('block_shape={\'time\': 1, \'lat\':', self.log_stream.read())
+
+
+  def test_descending_latitudes(self):
+    self.source_path = Path(self.data_dir, 'north_to_south.nc')
+    make_dataset().isel(lat=slice(None, None, -1)).to_netcdf(self.source_path)
+    # Latitude is cut too.
+    extractor = self.new_extractor(
+      dim_constraints={ 'time': slice('2020-01-05', '2020-01-10'), 'lat': slice(27, 18) },
+      req_max_size=0.0008,
+      block_cache=BlockCache(Path(self.data_dir, 'blocks'))).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    expected = make_dataset()['sst'].sel(time=slice('2020-01-05', '2020-01-10'), lat=slice(18, 27))
+    with xr.open_dataset(path) as extracted:
+      np.testing.assert_array_equal(extracted['lat'].values, expected['lat'].values)
+      np.testing.assert_array_equal(extracted['sst'].values, expected.values)
+
+
+  def test_no_time_dimension(self):
+    self.source_path = Path(self.data_dir, 'static.nc')
+    make_dataset().isel(time=0, drop=True).to_netcdf(self.source_path)
+    extractor = self.new_extractor(dim_constraints={ 'lat': slice(18, 27) }, req_max_size=0.0008).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    expected = wrangling.slice_dice(make_dataset().isel(time=0, drop=True), extractor.dim_constraints, ['sst'], squeeze=False)
+    with xr.open_dataset(path) as extracted:
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+
+
+  def test_output_encoding(self):
+    dataset = make_dataset()
+    # Mostly masked, as ocean grids.
+    dataset['sst'] = dataset['sst'].where(dataset['lat'] > 25)
+    self.source_path = Path(self.data_dir, 'masked.nc')
+    dataset.to_netcdf(self.source_path)
+    sizes = {}
+    for name, output_encoding in [('plain', None), ('compressed', OutputEncoding(zlib=True, chunking='timeseries', dtypes={ 'sst': 'float64' }))]:
+      extractor = self.new_extractor(output_encoding=output_encoding).sync_connect()
+      path = Path(self.data_dir, f'{name}.nc')
+      extractor.sync_extract(path)
+      extractor.close()
+      sizes[name] = path.stat().st_size
+    expected = wrangling.slice_dice(dataset, extractor.dim_constraints, ['sst'], squeeze=False)
+    with xr.open_dataset(path) as extracted:
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+      self.assertEqual(extracted['sst'].dtype, np.float64)
+      self.assertTrue(extracted['sst'].encoding['zlib'])
+      self.assertEqual(extracted['sst'].encoding['chunksizes'], (30, 12, 30))
+    self.assertLess(sizes['compressed'], sizes['plain'])
+
+
+class TestResumableExtraction(LocalOpendapTestCase):
+  def test_resume_fetches_only_missing_blocks(self):
+    path = Path(self.data_dir, 'out.nc')
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      failing_times=['2020-01-17'],
+      max_attempts=1,
+      max_workers=2).sync_connect()
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertFalse(details.complete)
+    manifest = BlockManifest(BlockManifest.path_for(path), signature=extractor.get_request_signature())
+    self.assertTrue(manifest.load())
+    records = manifest.get_records()
+    completed = [ r for r in records if r.status in [BlockStatus.COMPLETED, BlockStatus.MERGED] ]
+    failed = [ r for r in records if r.status == BlockStatus.FAILED ]
+    self.assertEqual(len(failed), 1)
+    self.assertGreater(len(completed), 0)
+    # The partial output is the gap-free prefix before the failed block.
+    with xr.open_dataset(path) as extracted:
+      self.assertLess(extracted['time'].values.max(), np.datetime64('2020-01-17'))
+      self.assertFalse(np.isnan(extracted['sst'].values).any())
+
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor).sync_connect()
+    details = extractor.sync_extract(path, resume=True)
+    extractor.close()
+    self.assertTrue(details.complete)
+    n_blocks = 5 # 30 time steps in blocks of 6.
+    self.assertEqual(extractor.fetch_count, n_blocks - len(completed))
+    self.assert_extracted(extractor, path)
+    self.assertFalse(manifest.path.exists())
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_resume_with_other_layout_starts_over(self):
+    layouts = [
+      ('size', { 'req_max_size': 0.005 }, 10), # Blocks of 3 time steps instead of 6.
+      ('encoding', { 'output_encoding': OutputEncoding(dtypes={ 'sst': 'float64' }) }, 5)
+    ]
+    for name, options, n_blocks in layouts:
+      path = Path(self.data_dir, f'{name}.nc')
+      extractor = self.new_extractor(
+        extractor_class=FlakyLocalOpendapExtractor,
+        failing_times=['2020-01-17'],
+        failure_delay=0.5,
+        max_attempts=1,
+        max_workers=2).sync_connect()
+      self.assertFalse(extractor.sync_extract(path).complete)
+      extractor.close()
+      self.assertGreater(len(list(self.data_dir.glob('tmp_dataset_*'))), 0)
+      extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, **options).sync_connect()
+      details = extractor.sync_extract(path, resume=True)
+      extractor.close()
+      self.assertTrue(details.complete)
+      self.assertEqual(extractor.fetch_count, n_blocks)
+      self.assert_extracted(extractor, path)
+      self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+    self.assertNotIn('Resuming extraction', self.log_stream.read())
+
+
+class TestAdaptiveBlockSize(LocalOpendapTestCase):
+  def test_shrinks_blocks_rejected_by_the_server(self):
+    extractor = self.new_extractor(
+      extractor_class=SizeLimitedLocalOpendapExtractor,
+      max_fetch_bytes=4000,
+      backoff_base=0,
+      # A single worker, so the order of the rejections and the successes,
+      # and so the final size, do not depend on the thread timing.
+      max_workers=1).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    self.assertGreater(extractor.n_rejected, 0)
+    # Every rejection shrank the size. Fast successes after the last one
+    # may grow it again, but not back to the size rejected at first.
+    self.assertEqual(extractor.size_controller.n_failures, extractor.n_rejected)
+    self.assertLess(extractor.size_controller.get_size(), 0.01 * 1e6)
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_grows_parts_after_fast_successes(self):
+    extractor = self.new_extractor(
+      extractor_class=SizeLimitedLocalOpendapExtractor,
+      max_fetch_bytes=1e9,
+      req_max_size=0.002,
+      max_block_size=0.04).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    self.assertGreater(extractor.size_controller.get_size(), 0.002 * 1e6)
+    self.assertGreater(max(extractor.fetched_bytes), 0.002 * 1e6)
+
+
+class TestAsyncExtraction(LocalOpendapTestCase):
+  def test_concurrent_coroutines(self):
+    paths = [ Path(self.data_dir, f'out_{i}.nc') for i in range(3) ]
+    async def extract(path: Path):
+      extractor = await self.new_extractor(max_workers=2).aconnect()
+      size = await extractor.aget_size()
+      details = await extractor.aextract(path)
+      extractor.close()
+      return extractor, size, details
+    async def main():
+      return await asyncio.gather(*[ extract(p) for p in paths ])
+    for (extractor, size, details), path in zip(asyncio.run(main()), paths):
+      self.assertTrue(details.complete)
+      self.assertEqual(size.size, self.expected_subset(extractor).nbytes)
+      self.assert_extracted(extractor, path)
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_connect_callback_waiting_for_the_extraction(self):
+    # As in test_lib_opendap.py, with every worker of the scheduler busy
+    # with a connection whose callback waits for its extraction.
+    scheduler = Scheduler(max_workers=2)
+    paths = [ Path(self.data_dir, f'out_{i}.nc') for i in range(4) ]
+    results = {}
+    def connected(extractor, path):
+      extractor.extract(
+        path,
+        success_callback=lambda details: results.__setitem__(path, details),
+        failure_callback=lambda err: results.__setitem__(path, err))
+      extractor.wait('extract')
+      extractor.close()
+    jobs = []
+    for path in paths:
+      extractor = self.new_extractor(scheduler=scheduler)
+      jobs.append(extractor.connect(
+        success_callback=lambda extractor, path=path: connected(extractor, path),
+        failure_callback=lambda err, path=path: results.__setitem__(path, err)))
+    for job in jobs:
+      job.result(seconds=30)
+    scheduler.shutdown()
+    for path in paths:
+      self.assertTrue(results[path].complete)
+      with xr.open_dataset(path) as extracted:
+        self.assertGreater(extracted.sizes['time'], 0)
+
+
+  def test_concurrent_runs_of_an_extractor_are_rejected(self):
+    paths = [ Path(self.data_dir, f'out_{i}.nc') for i in range(2) ]
+    extractor = self.new_extractor(max_workers=2).sync_connect()
+    async def main():
+      return await asyncio.gather(*[ extractor.aextract(p) for p in paths ], return_exceptions=True)
+    details, error = asyncio.run(main())
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, paths[0])
+    self.assertIs(type(error), ExtractionException)
+    self.assertFalse(paths[1].exists())
+    # Runs one after the other are fine.
+    details = extractor.sync_extract(paths[1])
+    extractor.close()
+    self.assertTrue(details.complete)
+
+
+  def test_failed_block_stops_the_extraction(self):
+    path = Path(self.data_dir, 'out.nc')
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      failing_times=['2020-01-17'],
+      max_attempts=1).sync_connect()
+    details = asyncio.run(extractor.aextract(path))
+    extractor.close()
+    self.assertFalse(details.complete)
+    with xr.open_dataset(path) as extracted:
+      self.assertLess(extracted['time'].values.max(), np.datetime64('2020-01-17'))
+    self.assertTrue(BlockManifest.path_for(path).exists())
+
+
+class TestStaging(LocalOpendapTestCase):
+  def test_tmp_files_are_staged_in_their_job(self):
+    staging_area = StagingArea(Path(self.data_dir, 'staging'), quota=0.02)
+    extractor = self.new_extractor(max_workers=4, staging_area=staging_area).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    self.assertIn(f'Staging the tmp files of the blocks in {staging_area.root}', self.log_stream.read())
+    self.assertEqual(list(staging_area.root.iterdir()), [])
+    self.assertEqual(staging_area.reserved_bytes, 0)
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_resume_from_a_kept_job(self):
+    staging_area = StagingArea(Path(self.data_dir, 'staging'))
+    path = Path(self.data_dir, 'out.nc')
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      failing_times=['2020-01-17'],
+      failure_delay=0.5,
+      max_attempts=1,
+      max_workers=2,
+      staging_area=staging_area).sync_connect()
+    self.assertFalse(extractor.sync_extract(path).complete)
+    extractor.close()
+    # The job keeps the blocks extracted after the failed one.
+    self.assertEqual(len(list(staging_area.root.glob('job_*'))), 1)
+    self.assertGreater(len(list(staging_area.root.glob('job_*/tmp_dataset_*'))), 0)
+    # Even if it is swept meanwhile.
+    StagingArea(staging_area.root)
+    self.assertEqual(len(list(staging_area.root.glob('job_*'))), 1)
+    self.assertEqual(staging_area.reserved_bytes, 0)
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, staging_area=staging_area).sync_connect()
+    details = extractor.sync_extract(path, resume=True)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+    # The job resumed from is not needed anymore.
+    self.assertEqual(list(staging_area.root.iterdir()), [])
+
+
+  def test_jobs_that_can_not_be_resumed_are_removed(self):
+    staging_area = StagingArea(Path(self.data_dir, 'staging'))
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      failing_times=['2020-01-05'],
+      max_attempts=1,
+      max_workers=1,
+      staging_area=staging_area).sync_connect()
+    with self.assertRaises(ExtractionException):
+      extractor.sync_extract(Path(self.data_dir, 'out.nc'))
+    extractor.close()
+    self.assertEqual(list(staging_area.root.iterdir()), [])
+
+
+class TestExtractionToMemory(LocalOpendapTestCase):
+  def test_blocks_are_assembled_in_memory(self):
+    # Blocks fetched in parts too.
+    extractor = self.new_extractor(max_workers=4, req_max_size=0.002, max_block_size=0.01).sync_connect()
+    extracted = extractor.sync_extract_to_memory()
+    extractor.close()
+    expected = self.expected_subset(extractor)
+    np.testing.assert_array_equal(extracted['time'].values, expected['time'].values)
+    np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+    self.assertIsInstance(extracted['sst'].variable._data, np.ndarray)
+    self.assertEqual(list(self.data_dir.iterdir()), [self.source_path])
+    self.assertEqual(extractor.telemetry.peak_tmp_bytes, 0)
+
+
+  def test_spills_to_disk_over_the_budget(self):
+    spill_dir = Path(self.data_dir, 'spill')
+    spill_dir.mkdir()
+    extractor = self.new_extractor(max_workers=2).sync_connect()
+    extracted = asyncio.run(extractor.aextract_to_memory(memory_budget=0.001, spill_dir=spill_dir))
+    extractor.close()
+    with extracted:
+      expected = self.expected_subset(extractor)
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+      self.assertEqual(Path(extracted.encoding['source']).parent, spill_dir)
+    self.assertEqual([ p.suffix for p in spill_dir.iterdir() ], ['.nc'])
+
+
+  def test_failed_block_discards_the_data(self):
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      failing_times=['2020-01-17'],
+      max_attempts=1).sync_connect()
+    with self.assertRaises(ExtractionException):
+      extractor.sync_extract_to_memory()
+    extractor.close()
+    self.assertEqual(list(self.data_dir.iterdir()), [self.source_path])
+
+
+@unittest.skipIf(importlib.util.find_spec('zarr') is None, 'zarr is not installed.')
+class TestZarrOutput(LocalOpendapTestCase):
+  def assert_zarr_extracted(self, extractor: LocalOpendapExtractor, path: Path):
+    expected = self.expected_subset(extractor)
+    with xr.open_zarr(path) as extracted:
+      np.testing.assert_array_equal(extracted['time'].values, expected['time'].values)
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+
+
+  def test_concurrent_blocks_are_written_into_their_regions(self):
+    # Blocks fetched in parts too.
+    extractor = self.new_extractor(max_workers=4, req_max_size=0.002, max_block_size=0.01).sync_connect()
+    path = Path(self.data_dir, 'out.zarr')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_zarr_extracted(extractor, path)
+    self.assertTrue(Path(path, '.zmetadata').exists())
+    self.assertEqual(details.telemetry.peak_tmp_bytes, 0)
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_resume(self):
+    path = Path(self.data_dir, 'out.zarr')
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      failing_times=['2020-01-17'],
+      max_attempts=1,
+      max_workers=2).sync_connect()
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertFalse(details.complete)
+    manifest = BlockManifest(BlockManifest.path_for(path), signature=extractor.get_request_signature())
+    self.assertTrue(manifest.load())
+    n_merged = len(manifest.get_keys(BlockStatus.MERGED))
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor).sync_connect()
+    details = extractor.sync_extract(path, resume=True)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assertEqual(extractor.fetch_count, 5 - n_merged)
+    self.assert_zarr_extracted(extractor, path)
+
+
+class TestCancellationAndProgress(LocalOpendapTestCase):
+  def test_progress_is_reported(self):
+    extractor = self.new_extractor(max_workers=2).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    merged = []
+    details = extractor.sync_extract(path, progress_callback=lambda p: merged.append(p.blocks_merged))
+    extractor.close()
+    self.assertTrue(details.complete)
+    progress = extractor.progress
+    self.assertEqual(progress.blocks_total, 5)
+    self.assertEqual(progress.blocks_done, 5)
+    self.assertEqual(progress.blocks_merged, 5)
+    self.assertEqual(progress.bytes_done, progress.bytes_total)
+    self.assertEqual(progress.bytes_downloaded, progress.bytes_total)
+    self.assertEqual(progress.get_fraction(), 1.0)
+    self.assertEqual(progress.get_eta(), 0.0)
+    self.assertGreater(progress.get_throughput(), 0)
+    self.assertEqual(merged, sorted(merged))
+    self.assertEqual(merged[-1], 5)
+
+
+  def test_cancel_keeps_the_extraction_resumable(self):
+    path = Path(self.data_dir, 'out.nc')
+    token = CancelToken()
+    def cancel_after_two_blocks(progress):
+      if progress.blocks_merged == 2:
+        token.cancel()
+    extractor = self.new_extractor().sync_connect()
+    with self.assertRaises(ExtractionCancelledException):
+      extractor.sync_extract(path, cancel_token=token, progress_callback=cancel_after_two_blocks)
+    extractor.close()
+    self.assertEqual(extractor.progress.blocks_merged, 2)
+    manifest = BlockManifest(BlockManifest.path_for(path), signature=extractor.get_request_signature())
+    self.assertTrue(manifest.load())
+    n_extracted = len([ r for r in manifest.get_records() if r.status in [BlockStatus.COMPLETED, BlockStatus.MERGED] ])
+
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor).sync_connect()
+    details = extractor.sync_extract(path, resume=True)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assertEqual(extractor.fetch_count, 5 - n_extracted)
+    self.assert_extracted(extractor, path)
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_cancel_before_the_first_block(self):
+    path = Path(self.data_dir, 'out.nc')
+    token = CancelToken()
+    token.cancel()
+    extractor = self.new_extractor().sync_connect()
+    with self.assertRaises(ExtractionCancelledException):
+      asyncio.run(extractor.aextract(path, cancel_token=token))
+    extractor.close()
+    self.assertFalse(path.exists())
+
+
+  def test_cancel_a_running_coroutine(self):
+    path = Path(self.data_dir, 'out.nc')
+    extractor = self.new_extractor(
+      extractor_class=DelayedLocalOpendapExtractor,
+      delayed_times={ '2020-01-05': 1.5, '2020-01-11': 0.6 },
+      max_workers=2).sync_connect()
+    async def main():
+      task = asyncio.ensure_future(extractor.aextract(path))
+      await asyncio.sleep(0.3)
+      task.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await task
+      return time.monotonic()
+    returned = asyncio.run(main())
+    extractor.close()
+    # The blocks being downloaded ended before the extraction returned.
+    self.assertEqual(len(extractor.fetch_spans), 2)
+    self.assertTrue(all([ end <= returned for _, end in extractor.fetch_spans.values() ]))
+    # They ended after the cancellation, so their blocks were discarded.
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+    manifest = BlockManifest(BlockManifest.path_for(path), signature=extractor.get_request_signature())
+    self.assertTrue(manifest.load())
+    self.assertEqual(manifest.get_keys(BlockStatus.COMPLETED), set())
+
+
+  def test_cancel_before_start(self):
+    path = Path(self.data_dir, 'out.nc')
+    scheduler = Scheduler(max_workers=1)
+    # Keeps the only worker busy, so the extraction is queued.
+    busy = threading.Event()
+    scheduler.submit(busy.wait)
+    extractor = self.new_extractor(scheduler=scheduler).sync_connect()
+    failures = []
+    job = extractor.extract(path, success_callback=lambda details: None, failure_callback=failures.append)
+    extractor.cancel()
+    busy.set()
+    with self.assertRaises(ExtractionCancelledException):
+      job.result(seconds=10)
+    self.assertIsInstance(failures[0], ExtractionCancelledException)
+    self.assertFalse(path.exists())
+    # The cancellation does not outlive the cancelled extraction.
+    details = extractor.sync_extract(path)
+    extractor.close()
+    scheduler.shutdown()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+
+
+class TestTelemetry(LocalOpendapTestCase):
+  def test_blocks_and_phases_are_recorded(self):
+    hook = InMemoryMetricsHook()
+    extractor = self.new_extractor(max_workers=2, metrics_hook=hook).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    telemetry = details.telemetry
+    self.assertIs(telemetry, extractor.telemetry)
+    blocks = telemetry.get_blocks()
+    self.assertEqual(len(blocks), 5)
+    self.assertTrue(all([ b.outcome == 'completed' and b.attempts == 1 and b.merge_seconds is not None for b in blocks ]))
+    self.assertEqual(telemetry.get_bytes_downloaded(), extractor.progress.bytes_total)
+    for phase in ExtractionTelemetry.PHASES:
+      self.assertGreater(telemetry.phases[phase], 0, phase)
+    self.assertGreater(telemetry.peak_tmp_bytes, 0)
+    self.assertEqual(telemetry.tmp_bytes, 0)
+    metrics = ExtractionTelemetry.METRICS
+    self.assertEqual(hook.get_counter(metrics['blocks'], { 'outcome': 'completed' }), 5)
+    self.assertEqual(len(hook.get_observations(metrics['block_seconds'])), 5)
+    self.assertEqual(len(hook.get_observations(metrics['phase_seconds'], { 'phase': 'plan' })), 1)
+
+
+  def test_retry_reasons_are_recorded(self):
+    extractor = self.new_extractor(
+      extractor_class=SizeLimitedLocalOpendapExtractor,
+      max_fetch_bytes=4000,
+      backoff_base=0).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assertEqual(details.telemetry.get_retries(), extractor.n_rejected)
+    self.assertEqual(details.telemetry.get_attempts(), 5 + extractor.n_rejected)
+    reasons = [ r for b in details.telemetry.get_blocks() for r in b.retry_reasons ]
+    self.assertTrue(all([ r.startswith('OSError: Simulated rejection') for r in reasons ]))
+
+
+class TestMetadataCache(LocalOpendapTestCase):
+  def test_reconnect_uses_cached_coordinates(self):
+    cache = MetadataCache(Path(self.data_dir, 'cache'), ttl=3600)
+    extractor = self.new_extractor(metadata_cache=cache).sync_connect()
+    expected_time = extractor.dataset['time'].values
+    extractor.close()
+    self.assertNotIn('Using the cached coordinates', self.log_stream.read())
+
+    extractor = self.new_extractor(metadata_cache=cache).sync_connect()
+    self.assertIn('Using the cached coordinates', self.log_stream.read())
+    np.testing.assert_array_equal(extractor.dataset['time'].values, expected_time)
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assert_extracted(extractor, path)
+
+
+  def test_expired_entry_without_last_modified_is_refreshed(self):
+    cache = MetadataCache(Path(self.data_dir, 'cache'), ttl=0)
+    self.new_extractor(metadata_cache=cache).sync_connect().close()
+    self.assertIsNone(cache.get(str(self.source_path)))
+
+
+class TestBlockCache(LocalOpendapTestCase):
+  def test_blocks_are_read_from_the_cache(self):
+    cache = BlockCache(Path(self.data_dir, 'blocks'))
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, block_cache=cache, max_workers=2).sync_connect()
+    details = extractor.sync_extract(Path(self.data_dir, 'first.nc'))
+    extractor.close()
+    self.assertTrue(details.complete)
+    n_blocks = 5 # 30 time steps in blocks of 6.
+    self.assertEqual(extractor.fetch_count, n_blocks)
+    self.assertEqual(len(list(cache.cache_dir.glob('*.nc'))), n_blocks)
+
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, block_cache=cache, max_workers=2).sync_connect()
+    path = Path(self.data_dir, 'second.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assertEqual(extractor.fetch_count, 0)
+    self.assertEqual([ b.outcome for b in details.telemetry.get_blocks() ], ['cached'] * n_blocks)
+    self.assertEqual(details.telemetry.get_bytes_downloaded(), 0)
+    self.assert_extracted(extractor, path)
+    # The tmp files linked to the cache are removed, the cache is kept.
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+    self.assertEqual(len(list(cache.cache_dir.glob('*.nc'))), n_blocks)
+
+
+  def test_overlapping_request_reuses_the_blocks_in_common(self):
+    cache = BlockCache(Path(self.data_dir, 'blocks'))
+    extractor = self.new_extractor(block_cache=cache).sync_connect()
+    self.assertTrue(extractor.sync_extract(Path(self.data_dir, 'first.nc')).complete)
+    extractor.close()
+    # Starts one block later: its blocks are the last 4 of the first request.
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      block_cache=cache,
+      dim_constraints={ 'time': slice('2020-01-11', '2020-02-03'), 'lat': slice(18, 27) }).sync_connect()
+    extracted = extractor.sync_extract_to_memory()
+    extractor.close()
+    outcomes = [ b.outcome for b in extractor.telemetry.get_blocks() ]
+    self.assertEqual(outcomes, ['cached'] * 4)
+    expected = self.expected_subset(extractor)
+    np.testing.assert_array_equal(extracted['time'].values, expected['time'].values)
+    np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+
+
+  def test_other_dtypes_are_other_blocks(self):
+    cache = BlockCache(Path(self.data_dir, 'blocks'))
+    extractor = self.new_extractor(block_cache=cache).sync_connect()
+    self.assertTrue(extractor.sync_extract(Path(self.data_dir, 'first.nc')).complete)
+    extractor.close()
+    extractor = self.new_extractor(
+      extractor_class=FlakyLocalOpendapExtractor,
+      block_cache=cache,
+      output_encoding=OutputEncoding(dtypes={ 'sst': 'float64' })).sync_connect()
+    path = Path(self.data_dir, 'second.nc')
+    self.assertTrue(extractor.sync_extract(path).complete)
+    extractor.close()
+    self.assertEqual(extractor.fetch_count, 5)
+    with xr.open_dataset(path) as extracted:
+      self.assertEqual(extracted['sst'].dtype, np.float64)
+
+
+  def test_other_decode_options_are_other_blocks(self):
+    cache = BlockCache(Path(self.data_dir, 'blocks'))
+    extractor = self.new_extractor(block_cache=cache).sync_connect()
+    self.assertTrue(extractor.sync_extract(Path(self.data_dir, 'first.nc')).complete)
+    extractor.close()
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, block_cache=cache).sync_connect(mask_and_scale=False)
+    self.assertTrue(extractor.sync_extract(Path(self.data_dir, 'second.nc')).complete)
+    extractor.close()
+    self.assertEqual(extractor.fetch_count, 5)
+    # The same options hit the cache.
+    extractor = self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, block_cache=cache).sync_connect(mask_and_scale=False)
+    self.assertTrue(extractor.sync_extract(Path(self.data_dir, 'third.nc')).complete)
+    extractor.close()
+    self.assertEqual(extractor.fetch_count, 0)
+
+
+class TestAppend(LocalOpendapTestCase):
+  def new_feed_extractor(self, **kwargs) -> FlakyLocalOpendapExtractor:
+    return self.new_extractor(extractor_class=FlakyLocalOpendapExtractor, dim_constraints={ 'lat': slice(18, 27) }, **kwargs)
+
+
+  def test_new_time_steps_are_appended(self):
+    write_dataset(self.source_path, n_times=30)
+    path = Path(self.data_dir, 'feed.nc')
+    # The file does not exist yet: the whole request is extracted.
+    extractor = self.new_feed_extractor().sync_connect()
+    self.assertTrue(extractor.sync_extract(path, append=True).complete)
+    extractor.close()
+    # The source gets 10 more days.
+    write_dataset(self.source_path, n_times=40)
+    extractor = self.new_feed_extractor(max_workers=2).sync_connect()
+    details = extractor.sync_extract(path, append=True)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assertEqual(details.time_max, np.datetime64('2020-02-09'))
+    # Only the new time steps are downloaded.
+    self.assertLess(details.telemetry.get_bytes_downloaded(), self.expected_subset(extractor).isel(time=slice(0, 11)).nbytes)
+    self.assert_extracted(extractor, path)
+    self.assertFalse(BlockManifest.path_for(path).exists())
+    self.assertEqual(list(self.data_dir.glob('tmp_dataset_*')), [])
+
+
+  def test_nothing_to_append(self):
+    path = Path(self.data_dir, 'feed.nc')
+    extractor = self.new_feed_extractor().sync_connect()
+    self.assertTrue(extractor.sync_extract(path).complete)
+    extractor.close()
+    extractor = self.new_feed_extractor().sync_connect()
+    details = extractor.sync_extract(path, append=True)
+    extractor.close()
+    self.assertTrue(details.complete)
+    self.assertEqual(extractor.fetch_count, 0)
+    self.assert_extracted(extractor, path)
+
+
+  def test_other_grid_is_not_appended(self):
+    path = Path(self.data_dir, 'feed.nc')
+    extractor = self.new_feed_extractor().sync_connect()
+    self.assertTrue(extractor.sync_extract(path).complete)
+    extractor.close()
+    extractor = self.new_extractor(dim_constraints={ 'lat': slice(18, 29) }).sync_connect()
+    with self.assertRaises(ExtractionException):
+      extractor.sync_extract(path, append=True)
+    extractor.close()
+    with xr.open_dataset(path) as extracted:
+      self.assertEqual(extracted.sizes['time'], 40)
+
+
+if __name__ == '__main__':
+  unittest.main()
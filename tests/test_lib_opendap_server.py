@@ -0,0 +1,104 @@
+# Standard
+import unittest
+import tempfile
+import warnings
+from pathlib import Path
+
+# Third party
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.extractors import OpendapExtractor
+from siaextractlib.processing import wrangling
+from siaextractlib.utils.http import SessionPool, HostRateLimiter
+from siaextractlib.utils.log import LogStream
+
+# Custom for testing
+from lib.local_opendap import make_dataset
+from lib.opendap_server import LocalOpendapServer
+
+warnings.filterwarnings("ignore")
+
+
+class OpendapServerTestCase(unittest.TestCase):
+  """
+  Runs the OpendapExtractor end to end against a local Pydap server.
+  """
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.data_dir = Path(self.tmp_dir.name)
+    self.dataset = make_dataset()
+    self.log_stream = LogStream()
+    self.dim_constraints = {
+      'time': slice('2020-01-05', '2020-02-03'),
+      'lat': slice(18, 27)
+    }
+
+
+  def tearDown(self) -> None:
+    self.tmp_dir.cleanup()
+
+
+  def extract(self, server: LocalOpendapServer, **kwargs) -> tuple[OpendapExtractor, Path]:
+    options = {
+      'dim_constraints': self.dim_constraints,
+      'requested_vars': ['sst'],
+      'req_max_size': 0.01,
+      'backoff_base': 0,
+      # No HTTP retries, so the extractor sees every failure.
+      'session_pool': SessionPool(max_retries=0),
+      'log_stream': self.log_stream,
+      'verbose': True
+    }
+    options.update(kwargs)
+    extractor = OpendapExtractor(opendap_url=server.url, **options).sync_connect()
+    path = Path(self.data_dir, 'out.nc')
+    details = extractor.sync_extract(path)
+    extractor.close()
+    self.assertTrue(details.complete)
+    expected = wrangling.slice_dice(self.dataset, self.dim_constraints, ['sst'], squeeze=False)
+    with xr.open_dataset(path) as extracted:
+      np.testing.assert_array_equal(extracted['time'].values, expected['time'].values)
+      np.testing.assert_array_equal(extracted['sst'].values, expected['sst'].values)
+    return extractor, path
+
+
+class TestOpendapServer(OpendapServerTestCase):
+  def test_concurrent_extraction(self):
+    with LocalOpendapServer(self.dataset, latency=0.01) as server:
+      extractor, _ = self.extract(server, max_workers=4)
+    # The coordinates are requested too.
+    self.assertGreater(server.faults.n_requests, len(extractor.telemetry.get_blocks()))
+    self.assertGreater(server.faults.bytes_sent, extractor.telemetry.get_bytes_downloaded())
+
+
+  def test_failures_are_retried(self):
+    # Failed reads are retried by the session, by xarray and, when they give
+    # up, by the extractor. The coordinates read on connection are only
+    # retried by the session.
+    with LocalOpendapServer(self.dataset, failure_rate=0.3, seed=1) as server:
+      self.extract(server, max_workers=2, max_attempts=10, session_pool=SessionPool(max_retries=2, backoff_factor=0))
+    self.assertGreater(server.faults.n_failures, 0)
+
+
+  def test_big_requests_are_split(self):
+    with LocalOpendapServer(self.dataset, max_response_bytes=5000) as server:
+      extractor, _ = self.extract(server, max_attempts=10)
+    self.assertGreater(server.faults.n_failures, 0)
+    self.assertLess(extractor.size_controller.get_size(), 0.01 * 1e6)
+
+
+  def test_throttled_requests_are_retried_through_the_limiter(self):
+    limiter = HostRateLimiter(requests_per_second=100, burst=4, max_connections=2)
+    session_pool = SessionPool(max_retries=8, backoff_factor=0, rate_limiter=limiter)
+    with LocalOpendapServer(self.dataset, failure_rate=0.3, failure_status='429 Too Many Requests', retry_after='0', seed=1) as server:
+      extractor, _ = self.extract(server, max_workers=4, max_attempts=10, session_pool=session_pool)
+    self.assertGreater(server.faults.n_failures, 0)
+    # Every 429 was retried by the session, none reached the extractor.
+    self.assertEqual(extractor.telemetry.get_retries(), 0)
+    self.assertEqual(sum(limiter.connections.values()), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
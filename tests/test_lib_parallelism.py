@@ -0,0 +1,197 @@
+# Standard
+import time
+import threading
+import unittest
+
+# Own
+from siaextractlib.processing.parallelism import Scheduler, AsyncRunner, CancelToken, ConcurrencyLimiter
+from siaextractlib.utils.exceptions import JobMissingException, ExtractionCancelledException
+
+
+class TestScheduler(unittest.TestCase):
+  def setUp(self) -> None:
+    self.scheduler = Scheduler(max_workers=2)
+
+
+  def tearDown(self) -> None:
+    self.scheduler.shutdown()
+
+
+  def test_concurrency_limit(self):
+    lock = threading.Lock()
+    state = { 'running': 0, 'max_running': 0 }
+    def task(seconds):
+      with lock:
+        state['running'] += 1
+        state['max_running'] = max(state['max_running'], state['running'])
+      time.sleep(seconds)
+      with lock:
+        state['running'] -= 1
+      return seconds
+    jobs = [ self.scheduler.submit(task, { 'seconds': 0.02 }) for _ in range(8) ]
+    self.assertEqual([ j.result(5) for j in jobs ], [0.02] * 8)
+    self.assertEqual(state['max_running'], 2)
+    self.assertEqual(len(set([ j.id for j in jobs ])), 8)
+    self.assertEqual(self.scheduler.get_jobs(), [])
+
+
+  def test_serial_jobs_run_in_order(self):
+    order = []
+    def task(i):
+      time.sleep(0.01)
+      order.append(i)
+    jobs = [ self.scheduler.submit(task, { 'i': i }, serial_key='same') for i in range(5) ]
+    self.scheduler.wait_all(5)
+    self.assertTrue(all([ j.done() for j in jobs ]))
+    self.assertEqual(order, list(range(5)))
+
+
+  def test_cancel_pending_job(self):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def blocker():
+      calls.append(1)
+      started.set()
+      release.wait(5)
+    first = self.scheduler.submit(blocker, serial_key='same')
+    second = self.scheduler.submit(blocker, serial_key='same')
+    started.wait(5)
+    self.assertIs(self.scheduler.get_job(second.id), second)
+    self.assertTrue(second.cancel())
+    self.assertEqual(self.scheduler.get_jobs(), [first])
+    release.set()
+    first.result(5)
+    # The queue keeps working after the cancelled job.
+    third = self.scheduler.submit(lambda: 3, serial_key='same')
+    self.assertEqual(third.result(5), 3)
+    self.assertEqual(len(calls), 1)
+    with self.assertRaises(JobMissingException):
+      self.scheduler.get_job(first.id)
+
+
+  def test_cancel_running_job_with_token(self):
+    started = threading.Event()
+    def task(cancel_token: CancelToken):
+      started.set()
+      while not cancel_token.sleep(0.01):
+        pass
+      cancel_token.raise_if_cancelled()
+    token = CancelToken()
+    job = self.scheduler.submit(task, fn_kwargs={ 'cancel_token': token }, cancel_token=token)
+    started.wait(5)
+    self.assertTrue(job.cancel())
+    with self.assertRaises(ExtractionCancelledException):
+      job.result(5)
+    self.assertFalse(job.cancel())
+
+
+  def test_jobs_waiting_for_jobs_do_not_deadlock(self):
+    # Every worker runs a job that waits for another job, which has no
+    # free worker left: the waiting worker runs it.
+    def inner(i):
+      return i
+    def outer(i):
+      time.sleep(0.02)
+      return self.scheduler.submit(inner, { 'i': i }).result(5)
+    jobs = [ self.scheduler.submit(outer, { 'i': i }) for i in range(4) ]
+    self.assertEqual([ j.result(5) for j in jobs ], list(range(4)))
+    # A job waiting for a serial job runs it once the jobs before it finish.
+    def waiting_for_serial():
+      first = self.scheduler.submit(inner, { 'i': 1 }, serial_key='same')
+      second = self.scheduler.submit(inner, { 'i': 2 }, serial_key='same')
+      return second.result(5) + first.result(5)
+    jobs = [ self.scheduler.submit(waiting_for_serial) for _ in range(2) ]
+    self.assertEqual([ j.result(5) for j in jobs ], [3, 3])
+    self.assertEqual(self.scheduler.get_jobs(), [])
+
+
+  def test_failed_job_keeps_the_exception(self):
+    def fail():
+      raise ValueError('Expected.')
+    job = self.scheduler.submit(fail)
+    with self.assertRaises(ValueError):
+      job.result(5)
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+  def test_global_and_per_host_limits(self):
+    limiter = ConcurrencyLimiter(max_concurrent=3, max_per_host=2)
+    lock = threading.Lock()
+    state = { 'running': {}, 'max_running': {}, 'max_total': 0 }
+    def task(url):
+      host = ConcurrencyLimiter.get_host(url)
+      with limiter.slot(url):
+        with lock:
+          state['running'][host] = state['running'].get(host, 0) + 1
+          state['max_running'][host] = max(state['max_running'].get(host, 0), state['running'][host])
+          state['max_total'] = max(state['max_total'], sum(state['running'].values()))
+        time.sleep(0.02)
+        with lock:
+          state['running'][host] -= 1
+    urls = [ f'http://host{i % 2}.org/dataset{i}' for i in range(12) ]
+    threads = [ threading.Thread(target=task, args=(url, )) for url in urls ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(state['max_running'], { 'host0.org': 2, 'host1.org': 2 })
+    self.assertEqual(state['max_total'], 3)
+    self.assertEqual(limiter.running, 0)
+    self.assertEqual(limiter.running_by_host, {})
+
+
+  def test_cancel_while_waiting(self):
+    limiter = ConcurrencyLimiter(max_per_host=1)
+    limiter.acquire('http://host.org/a')
+    token = CancelToken()
+    threading.Timer(0.05, token.cancel).start()
+    with self.assertRaises(ExtractionCancelledException):
+      limiter.acquire('http://host.org/b', cancel_token=token)
+    # Other hosts are not limited.
+    with limiter.slot('http://other.org/a'):
+      self.assertEqual(limiter.running, 2)
+    limiter.release('http://host.org/a')
+    self.assertEqual(limiter.running, 0)
+
+
+class TestAsyncRunner(unittest.TestCase):
+  def test_calls_are_queued_with_their_own_callbacks(self):
+    scheduler = Scheduler(max_workers=4)
+    results = []
+    def sync_fn(value):
+      time.sleep(0.01)
+      return value
+    runner = AsyncRunner(sync_fn=sync_fn, scheduler=scheduler)
+    runner.failure_callback = lambda err: results.append(err)
+    for value in range(3):
+      runner.success_callback = lambda v, tag=value: results.append((tag, v))
+      runner.sync_fn_kwargs = { 'value': value }
+      runner.run()
+    self.assertTrue(runner.still_working())
+    runner.wait(5)
+    self.assertFalse(runner.still_working())
+    self.assertEqual(results, [(0, 0), (1, 1), (2, 2)])
+    scheduler.shutdown()
+
+
+  def test_callback_waiting_for_another_runner(self):
+    # As a connect callback that waits for an extraction, with a single
+    # worker.
+    scheduler = Scheduler(max_workers=1)
+    results = []
+    second = AsyncRunner(sync_fn=lambda: 'second', scheduler=scheduler, failure_callback=results.append)
+    second.success_callback = results.append
+    def first_done(value):
+      results.append(value)
+      second.run()
+      second.wait()
+    first = AsyncRunner(sync_fn=lambda: 'first', success_callback=first_done, failure_callback=results.append, scheduler=scheduler)
+    job = first.run()
+    job.result(5)
+    self.assertEqual(results, ['first', 'second'])
+    scheduler.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
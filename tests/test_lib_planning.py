@@ -0,0 +1,111 @@
+# Standard
+import unittest
+import warnings
+
+# Third party
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.processing import planning
+
+# Custom for testing
+from lib.local_opendap import make_dataset
+
+warnings.filterwarnings("ignore")
+
+
+class TestPlanning(unittest.TestCase):
+  def assert_covers(self, dataset: xr.Dataset, blocks: list[planning.Block]):
+    """
+    Checks that the blocks cover every item of the dataset exactly once.
+    """
+    hits = np.zeros(dataset['sst'].shape, dtype=int)
+    dims = dataset['sst'].dims
+    for block in blocks:
+      index = tuple([ block.slices.get(d, slice(None)) for d in dims ])
+      hits[index] += 1
+    self.assertTrue((hits == 1).all())
+
+
+  def test_no_split_when_it_fits(self):
+    dataset = make_dataset()
+    blocks = planning.plan_blocks(dataset, dataset.nbytes)
+    self.assertEqual(len(blocks), 1)
+    self.assertEqual(blocks[0].slices, {})
+
+
+  def test_time_split(self):
+    dataset = make_dataset(n_times=40)
+    step_bytes = 20 * 30 * 4
+    blocks = planning.plan_blocks(dataset, step_bytes * 10 + 2000)
+    self.assertTrue(all([ list(b.slices) == ['time'] for b in blocks ]))
+    self.assertTrue(all([ b.nbytes <= step_bytes * 10 + 2000 for b in blocks ]))
+    self.assert_covers(dataset, blocks)
+
+
+  def test_multi_dimensional_split(self):
+    dataset = make_dataset(n_times=2)
+    max_bytes = 30 * 4 * 5 + 1000
+    blocks = planning.plan_blocks(dataset, max_bytes)
+    self.assertEqual(list(blocks[0].slices), ['time', 'lat'])
+    self.assertTrue(all([ b.nbytes <= max_bytes for b in blocks ]))
+    self.assert_covers(dataset, blocks)
+    rows = planning.get_rows(blocks)
+    self.assertEqual(len(rows), 2)
+    self.assertEqual(sum([ len(r) for r in rows ]), len(blocks))
+
+
+  def test_no_time_dimension(self):
+    dataset = make_dataset().isel(time=0, drop=True)
+    blocks = planning.plan_blocks(dataset, dataset.nbytes / 3)
+    self.assertEqual(list(blocks[0].slices), ['lat'])
+    self.assertGreaterEqual(len(blocks), 3)
+    self.assertEqual(planning.get_storage_order(dataset), ['lat', 'lon'])
+
+
+  def test_chunk_aligned_split(self):
+    dataset = make_dataset(n_times=40)
+    dataset['sst'].attrs['_ChunkSizes'] = [4, 20, 30]
+    step_bytes = 20 * 30 * 4 + 8
+    chunks = planning.get_chunk_sizes(dataset)
+    self.assertEqual(chunks, { 'time': 4, 'lat': 20, 'lon': 30 })
+    # The subset starts at the index 2 of the remote dataset.
+    subset = dataset.isel(time=slice(2, 40))
+    offsets = planning.get_index_offsets(dataset, subset)
+    self.assertEqual(offsets['time'], 2)
+    blocks = planning.plan_blocks(subset, step_bytes * 10 + 2000, chunks=chunks, offsets=offsets)
+    starts = [ b.slices['time'].start + offsets['time'] for b in blocks ]
+    self.assertEqual(starts, [2, 8, 16, 24, 32])
+    self.assertTrue(all([ b.n_chunks == (b.slices['time'].stop - b.slices['time'].start + 3) // 4 for b in blocks[1:] ]))
+    report = planning.get_chunk_report(blocks, dict(subset.sizes), chunks, offsets)
+    self.assertEqual(report.get_redundant_reads(), 0)
+
+
+  def test_unaligned_split_reports_redundant_reads(self):
+    dataset = make_dataset(n_times=40)
+    subset = dataset.isel(time=slice(2, 40))
+    chunks = { 'time': 4 }
+    offsets = planning.get_index_offsets(dataset, subset)
+    blocks = planning.plan_blocks(subset, (20 * 30 * 4 + 8) * 10 + 2000)
+    report = planning.get_chunk_report(blocks, dict(subset.sizes), chunks, offsets)
+    self.assertGreater(report.get_redundant_reads(), 0)
+
+
+  def test_split_block(self):
+    dataset = make_dataset(n_times=40)
+    block = planning.plan_blocks(dataset, dataset.nbytes / 2)[1]
+    parts = planning.split_block(dataset, block, block.nbytes / 4)
+    self.assertGreaterEqual(len(parts), 4)
+    self.assertTrue(all([ p.nbytes <= block.nbytes / 4 for p in parts ]))
+    # The parts cover the block, with slices relative to the dataset.
+    hits = np.zeros(dataset['sst'].shape, dtype=int)
+    for part in parts:
+      hits[tuple([ part.slices.get(d, slice(None)) for d in dataset['sst'].dims ])] += 1
+    expected = np.zeros(dataset['sst'].shape, dtype=int)
+    expected[tuple([ block.slices.get(d, slice(None)) for d in dataset['sst'].dims ])] = 1
+    np.testing.assert_array_equal(hits, expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,149 @@
+# Standard
+import os
+import sys
+import json
+import time
+import unittest
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+# Own
+from siaextractlib.utils.staging import StagingArea
+from siaextractlib.utils.manifest import BlockManifest, BlockRecord, BlockStatus
+from siaextractlib.utils.exceptions import ExtractionCancelledException
+from siaextractlib.processing.parallelism import CancelToken
+
+
+class TestStagingArea(unittest.TestCase):
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.root = Path(self.tmp_dir.name)
+
+
+  def tearDown(self) -> None:
+    self.tmp_dir.cleanup()
+
+
+  def new_manifest(self, block_path: Path, status: BlockStatus = BlockStatus.COMPLETED) -> BlockManifest:
+    manifest = BlockManifest(BlockManifest.path_for(Path(self.root, 'out.nc')), signature={})
+    manifest.set_record(BlockRecord(number=0, key='block_0', path=block_path.absolute(), size=5, status=status))
+    return manifest
+
+
+  def new_dead_job(self, area: StagingArea, manifest_path: Path = None) -> Path:
+    job = area.new_job(manifest_path=manifest_path)
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    owner_path = Path(job.path, StagingArea.OWNER_FILE)
+    owner = json.loads(owner_path.read_text())
+    owner['pid'] = process.pid
+    owner_path.write_text(json.dumps(owner))
+    job.new_path().write_bytes(b'block')
+    return job.path
+
+
+  def test_jobs_have_their_own_namespace(self):
+    area = StagingArea(self.root)
+    first, second = area.new_job(), area.new_job()
+    self.assertNotEqual(first.path, second.path)
+    self.assertNotEqual(first.new_path(), first.new_path())
+    first.close()
+    self.assertFalse(first.path.exists())
+    self.assertTrue(second.path.exists())
+
+
+  def test_sweep_removes_jobs_of_dead_processes(self):
+    area = StagingArea(self.root)
+    alive = area.new_job()
+    dead = self.new_dead_job(area)
+    StagingArea(self.root)
+    self.assertFalse(dead.exists())
+    self.assertTrue(alive.path.exists())
+
+
+  def test_sweep_keeps_recent_jobs(self):
+    area = StagingArea(self.root, max_age=3600)
+    dead = self.new_dead_job(area)
+    self.assertEqual(area.sweep(), [])
+    self.assertTrue(dead.exists())
+    os.utime(dead, (time.time() - 7200, time.time() - 7200))
+    for path in dead.iterdir():
+      os.utime(path, (time.time() - 7200, time.time() - 7200))
+    self.assertEqual(area.sweep(), [dead])
+
+
+  def test_sweep_keeps_jobs_referenced_by_their_manifest(self):
+    area = StagingArea(self.root)
+    manifest_path = BlockManifest.path_for(Path(self.root, 'out.nc'))
+    dead = self.new_dead_job(area, manifest_path=manifest_path)
+    block_path = next(dead.glob('tmp_dataset_*'))
+    manifest = self.new_manifest(block_path)
+    # max_age is 0, but the blocks are needed to resume the extraction.
+    self.assertEqual(area.sweep(), [])
+    self.assertTrue(dead.exists())
+    manifest.set_status('block_0', BlockStatus.MERGED)
+    self.assertEqual(area.sweep(), [dead])
+
+
+  def test_closed_jobs_are_removed_unless_referenced(self):
+    area = StagingArea(self.root)
+    manifest_path = BlockManifest.path_for(Path(self.root, 'out.nc'))
+    job = area.new_job(manifest_path=manifest_path)
+    job.new_path().write_bytes(b'block')
+    job.close()
+    self.assertFalse(job.path.exists())
+    # A failed extraction that can be resumed.
+    job = area.new_job(manifest_path=manifest_path)
+    block_path = job.new_path()
+    block_path.write_bytes(b'block')
+    manifest = self.new_manifest(block_path)
+    job.close()
+    self.assertTrue(block_path.exists())
+    self.assertEqual(area.sweep(), [])
+    # Its process is still running, but it does not use the job anymore.
+    manifest.unlink()
+    self.assertEqual(area.sweep(), [job.path])
+
+
+  def test_quota_applies_back_pressure(self):
+    area = StagingArea(self.root, quota=0.001) # 1000 bytes
+    job = area.new_job()
+    first, second = job.new_path(), job.new_path()
+    job.reserve(first, 800)
+    reserved = threading.Event()
+    def reserve():
+      job.reserve(second, 800)
+      reserved.set()
+    thread = threading.Thread(target=reserve)
+    thread.start()
+    self.assertFalse(reserved.wait(0.3))
+    job.release(first)
+    self.assertTrue(reserved.wait(5))
+    thread.join()
+    self.assertEqual(area.reserved_bytes, 800)
+    job.close()
+    self.assertEqual(area.reserved_bytes, 0)
+
+
+  def test_blocks_bigger_than_the_quota_are_let_through(self):
+    area = StagingArea(self.root, quota=0.001)
+    job = area.new_job()
+    job.reserve(job.new_path(), 5000)
+    self.assertEqual(area.reserved_bytes, 5000)
+
+
+  def test_cancel_while_waiting(self):
+    area = StagingArea(self.root, quota=0.001)
+    job = area.new_job()
+    job.reserve(job.new_path(), 800)
+    token = CancelToken()
+    threading.Timer(0.2, token.cancel).start()
+    with self.assertRaises(ExtractionCancelledException):
+      job.reserve(job.new_path(), 800, cancel_token=token)
+    self.assertEqual(area.reserved_bytes, 800)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+# Standard
+import time
+import unittest
+
+# Own
+from siaextractlib.utils.telemetry import InMemoryMetricsHook, ExtractionTelemetry, BlockTelemetry
+
+
+class TestExtractionTelemetry(unittest.TestCase):
+  def setUp(self) -> None:
+    self.hook = InMemoryMetricsHook()
+    self.telemetry = ExtractionTelemetry(metrics_hook=self.hook)
+    self.metrics = ExtractionTelemetry.METRICS
+
+
+  def test_phases_are_timed(self):
+    with self.telemetry.time_phase('fetch'):
+      time.sleep(0.01)
+    self.telemetry.add_phase_time('fetch', 1.0)
+    self.assertGreater(self.telemetry.phases['fetch'], 1.0)
+    self.assertEqual(self.telemetry.phases['merge'], 0.0)
+    self.assertEqual(len(self.hook.get_observations(self.metrics['phase_seconds'], { 'phase': 'fetch' })), 2)
+
+
+  def test_blocks_feed_the_metrics_hook(self):
+    self.telemetry.record_block(BlockTelemetry(number=1, key='time=6:12', nbytes=100, attempts=3, retry_reasons=['OSError: a', 'TimeoutError: b']))
+    self.telemetry.record_block(BlockTelemetry(number=0, key='time=0:6', nbytes=100, attempts=1))
+    self.telemetry.record_block(BlockTelemetry(number=2, key='time=12:18', nbytes=100, outcome='failed', attempts=1, retry_reasons=['OSError: c']))
+    self.telemetry.record_merge(0, 0.5)
+    self.assertEqual([ b.number for b in self.telemetry.get_blocks() ], [0, 1, 2])
+    self.assertEqual(self.telemetry.get_blocks()[0].merge_seconds, 0.5)
+    self.assertEqual(self.telemetry.get_attempts(), 5)
+    self.assertEqual(self.telemetry.get_retries(), 3)
+    self.assertEqual(self.telemetry.get_bytes_downloaded(), 200)
+    self.assertEqual(self.hook.get_counter(self.metrics['blocks'], { 'outcome': 'completed' }), 2)
+    self.assertEqual(self.hook.get_counter(self.metrics['blocks'], { 'outcome': 'failed' }), 1)
+    self.assertEqual(self.hook.get_counter(self.metrics['retries'], { 'reason': 'OSError' }), 2)
+    self.assertEqual(self.hook.get_counter(self.metrics['bytes']), 200)
+    self.assertEqual(self.hook.get_observations(self.metrics['merge_seconds']), [0.5])
+    self.assertEqual(self.telemetry.to_dict()['blocks'][1]['retry_reasons'], ['OSError: a', 'TimeoutError: b'])
+
+
+  def test_peak_tmp_bytes(self):
+    for nbytes in [100, 50, -100, 30, -80]:
+      self.telemetry.add_tmp_bytes(nbytes)
+    self.telemetry.finish()
+    self.assertEqual(self.telemetry.peak_tmp_bytes, 150)
+    self.assertEqual(self.telemetry.tmp_bytes, 0)
+    self.assertEqual(self.hook.get_observations(self.metrics['peak_tmp_bytes']), [150])
+
+
+if __name__ == '__main__':
+  unittest.main()
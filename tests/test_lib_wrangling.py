@@ -0,0 +1,248 @@
+# Standard
+import unittest
+import tempfile
+import warnings
+import threading
+from pathlib import Path
+
+# Third party
+import cftime
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.utils.log import LogStream
+from siaextractlib.utils.locks import NETCDF_LOCK
+from siaextractlib.processing import wrangling
+
+# Custom for testing
+from lib.local_opendap import make_dataset
+
+warnings.filterwarnings("ignore")
+
+
+class TestSliceDice(unittest.TestCase):
+  def setUp(self) -> None:
+    self.dataset = make_dataset()
+    self.index = wrangling.CoordinateIndex(self.dataset)
+
+
+  def test_slices_are_inclusive(self):
+    subset = wrangling.slice_dice(
+      self.dataset,
+      { 'time': slice('2020-01-05', '2020-01-10'), 'lat': slice(18, 27) },
+      'sst',
+      squeeze=False,
+      index=self.index)
+    expected = self.dataset['sst'].sel(time=slice('2020-01-05', '2020-01-10'), lat=slice(18, 27))
+    xr.testing.assert_identical(subset, expected)
+
+
+  def test_nearest_values_are_unique(self):
+    lats = self.dataset['lat'].values
+    subset = wrangling.slice_dice(
+      self.dataset,
+      { 'lat': [lats[3] + 0.01, lats[3] - 0.01, lats[10]], 'time': '2020-01-07T10:00' },
+      ['sst'],
+      squeeze=False,
+      index=self.index)
+    np.testing.assert_array_equal(subset['lat'].values, lats[[3, 10]])
+    np.testing.assert_array_equal(subset['time'].values, [np.datetime64('2020-01-07')])
+
+
+  def test_descending_coordinate(self):
+    # Latitudes from north to south are subset from south to north.
+    dataset = self.dataset.isel(lat=slice(None, None, -1))
+    subset = wrangling.slice_dice(dataset, { 'lat': slice(27, 18), 'lon': [-90.0] }, squeeze=True)
+    expected = self.dataset.sel(lat=slice(18, 27)).sel(lon=[-90.0], method='nearest').squeeze()
+    xr.testing.assert_identical(subset, expected)
+    lats = self.dataset['lat'].values
+    for constraint, positions in [([lats[10], lats[3]], [3, 10]), ([lats[4], lats[3], lats[5]], [3, 4, 5]), (slice(lats[5], lats[0], 2), [1, 3, 5])]:
+      subset = wrangling.slice_dice(dataset, { 'lat': constraint }, squeeze=False)
+      np.testing.assert_array_equal(subset['lat'].values, lats[positions])
+      np.testing.assert_array_equal(subset['sst'].values, self.dataset['sst'].values[:, positions])
+
+
+  def test_index_is_reused(self):
+    first = wrangling.slice_dice(self.dataset, { 'time': slice('2020-01-01', '2020-01-02') }, index=self.index)
+    second = wrangling.slice_dice(self.dataset, { 'time': slice('2020-01-03', '2020-01-04') }, index=self.index)
+    self.assertEqual(first.sizes['time'], 2)
+    self.assertEqual(second['time'].values[0], np.datetime64('2020-01-03'))
+
+
+class TestSizeEstimator(unittest.TestCase):
+  def setUp(self) -> None:
+    self.dataset = make_dataset(var_names=['sst', 'sss'])
+    self.estimator = wrangling.SizeEstimator(self.dataset)
+
+
+  def actual_size(self, constraints: dict, var = None) -> int:
+    return wrangling.slice_dice(self.dataset, constraints, var, squeeze=False).nbytes
+
+
+  def test_matches_subset_size(self):
+    constraint_sets = [
+      {},
+      { 'time': slice('2020-01-05', '2020-01-10'), 'lat': slice(18, 27) },
+      { 'time': ['2020-01-07', '2020-01-07T02:00'], 'lon': [-90.0, -89.0] },
+      { 'lat': slice(100, 200) }
+    ]
+    for constraints in constraint_sets:
+      for var in [None, 'sst', ['sst', 'sss']]:
+        self.assertEqual(self.estimator.estimate(constraints, var), self.actual_size(constraints, var))
+
+
+  def test_memo_is_bounded(self):
+    estimator = wrangling.SizeEstimator(self.dataset, max_memo=4)
+    constraint_sets = [ { 'lon': slice(-95, -90 + i) } for i in range(10) ]
+    for constraints in constraint_sets:
+      estimator.estimate(constraints, 'sst')
+    self.assertEqual(len(estimator), 4)
+    # The most recent results are kept.
+    estimator.estimate(constraint_sets[-1], 'sst')
+    self.assertEqual(len(estimator), 4)
+    self.assertEqual(estimator.estimate(constraint_sets[0], 'sst'), self.actual_size(constraint_sets[0], 'sst'))
+
+
+  def test_vectorised_estimation(self):
+    dataset = self.dataset.isel(lat=slice(None, None, -1))
+    estimator = wrangling.SizeEstimator(dataset)
+    constraint_sets = [
+      { 'lat': slice(27, 18), 'lon': slice(-95, -90 + i), 'time': slice('2020-01-05', '2020-01-10') }
+      for i in range(5)
+    ]
+    constraint_sets.append({ 'lat': slice(None, 20), 'lon': [-90.0] })
+    sizes = estimator.estimate_many(constraint_sets, ['sst'])
+    expected = [ wrangling.slice_dice(dataset, c, ['sst'], squeeze=False).nbytes for c in constraint_sets ]
+    np.testing.assert_array_equal(sizes, expected)
+
+
+class TestDecodeTimes(unittest.TestCase):
+  def test_matches_cftime(self):
+    values = np.arange(0, 10000, dtype='float64') / 7
+    units = 'hours since 1950-01-01 00:00:00'
+    decoded = wrangling.decode_times(values, units)
+    self.assertEqual(decoded.dtype, np.dtype('datetime64[ns]'))
+    expected = np.array(cftime.num2pydate(values, units), dtype='datetime64[ns]')
+    # cftime rounds to microseconds.
+    self.assertLessEqual(np.abs(decoded - expected).max(), np.timedelta64(1, 'us'))
+
+
+  def test_units_are_parsed(self):
+    np.testing.assert_array_equal(
+      wrangling.decode_times(np.array([0, 1]), 'Weeks since 2000-01-01T00:00:00Z'),
+      np.array(['2000-01-01', '2000-01-08'], dtype='datetime64[ns]'))
+    np.testing.assert_array_equal(
+      wrangling.decode_times(np.array([1, 2], dtype='int32'), 'msec since 2020-02-29 12:00 UTC'),
+      np.array(['2020-02-29T12:00:00.001', '2020-02-29T12:00:00.002'], dtype='datetime64[ns]'))
+    self.assertIsNone(wrangling.parse_time_units('months since 2000-01-01'))
+    self.assertIsNone(wrangling.parse_time_units('days'))
+    np.testing.assert_array_equal(
+      wrangling.decode_times(np.array([0.5]), 'seconds since 1970-1-1 0:0:1.5'),
+      np.array(['1970-01-01T00:00:02'], dtype='datetime64[ns]'))
+
+
+  def test_short_years_use_cftime(self):
+    # Not 2001-10-01, as dateutil would guess.
+    self.assertIsNone(wrangling.parse_time_units('days since 10-1-1'))
+    decoded = wrangling.decode_times(np.array([0, 1]), 'days since 10-1-1', calendar='proleptic_gregorian')
+    self.assertEqual([ (d.year, d.month, d.day) for d in decoded ], [(10, 1, 1), (10, 1, 2)])
+    self.assertIsNone(wrangling.parse_time_units('days since 2000-01-01 00:00:00 +01:00'))
+
+
+  def test_missing_values_are_nat(self):
+    decoded = wrangling.decode_times(np.array([0, np.nan, 1.5]), 'days since 2000-01-01')
+    self.assertTrue(np.isnat(decoded[1]))
+    self.assertEqual(decoded[2], np.datetime64('2000-01-02T12:00'))
+
+
+  def test_other_calendars_and_dates_use_cftime(self):
+    decoded = wrangling.decode_times(np.array([0, 30]), 'days since 2000-01-01', calendar='360_day')
+    self.assertEqual(decoded[1], cftime.Datetime360Day(2000, 2, 1))
+    decoded = wrangling.decode_times(np.array([0, 1]), 'days since 1500-01-01')
+    self.assertEqual(decoded[1], cftime.DatetimeGregorian(1500, 1, 2))
+    decoded = wrangling.decode_times(np.array([365 * 100]), 'days since 2200-01-01')
+    self.assertEqual(decoded[0].year, 2299)
+
+
+  def test_open_dataset_decodes_units_xarray_can_not(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = Path(tmp_dir, 'weeks.nc')
+      xr.Dataset(
+        { 'sst': ('time', np.arange(3.0)) },
+        coords={ 'time': ('time', np.arange(3.0), { 'units': 'weeks since 2000-01-01', 'calendar': 'standard' }) }
+      ).to_netcdf(path)
+      with wrangling.open_dataset(path, log_stream=LogStream()) as dataset:
+        np.testing.assert_array_equal(dataset['time'].values, np.array(['2000-01-01', '2000-01-08', '2000-01-15'], dtype='datetime64[ns]'))
+
+
+class TestOpenMfdataset(unittest.TestCase):
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.data_dir = Path(self.tmp_dir.name)
+    self.log_stream = LogStream()
+    n_lats, n_lons = 4, 5
+    # Units xarray can not decode.
+    self.dataset = xr.Dataset(
+      {
+        'sst': (('time', 'lat', 'lon'), np.random.default_rng(0).random((40, n_lats, n_lons))),
+        'depth': (('lat', 'lon'), np.ones((n_lats, n_lons)))
+      },
+      coords={
+        'time': ('time', np.arange(40.0), { 'units': 'weeks since 2000-01-01', 'calendar': 'standard' }),
+        'lat': np.arange(n_lats, dtype='float64'),
+        'lon': np.arange(n_lons, dtype='float64')
+      })
+
+
+  def tearDown(self) -> None:
+    self.tmp_dir.cleanup()
+
+
+  def write_blocks(self, blocks: list[dict]) -> list[Path]:
+    paths = []
+    for i, slices in enumerate(blocks):
+      path = Path(self.data_dir, f'block_{i:03d}.nc')
+      self.dataset.isel(slices).to_netcdf(path)
+      paths.append(path)
+    return paths
+
+
+  def test_blocks_are_concatenated_along_time(self):
+    paths = self.write_blocks([ { 'time': slice(i, i + 4) } for i in range(0, 40, 4) ])
+    dataset = wrangling.open_mfdataset(paths, log_stream=self.log_stream, combine='by_coords')
+    self.assertIn('Datasets successfully concatenated along time.', self.log_stream.read())
+    self.assertIsNotNone(dataset['sst'].chunks)
+    self.assertEqual(dataset['depth'].dims, ('lat', 'lon'))
+    np.testing.assert_array_equal(dataset['sst'].values, self.dataset['sst'].values)
+    np.testing.assert_array_equal(dataset['time'].values, np.datetime64('2000-01-01') + np.arange(40) * np.timedelta64(7, 'D'))
+    dataset.close()
+
+
+  def test_blocks_tiled_in_several_dimensions(self):
+    paths = self.write_blocks([ { 'time': slice(t, t + 20), 'lat': slice(l, l + 2) } for t in [0, 20] for l in [0, 2] ])
+    dataset = wrangling.open_mfdataset(paths, log_stream=self.log_stream, combine='by_coords')
+    np.testing.assert_array_equal(dataset['sst'].values, self.dataset['sst'].values)
+    dataset.close()
+
+
+  def test_blocks_are_read_in_parallel_holding_the_netcdf_lock(self):
+    paths = self.write_blocks([ { 'time': slice(i, i + 4) } for i in range(0, 40, 4) ])
+    dataset = wrangling.open_mfdataset(paths, log_stream=self.log_stream, combine='by_coords')
+    computed = []
+    def compute():
+      computed.append(dataset['sst'].compute(scheduler='threads', num_workers=8))
+    with NETCDF_LOCK:
+      thread = threading.Thread(target=compute)
+      thread.start()
+      thread.join(0.3)
+      # No block is read while another thread holds the lock.
+      self.assertTrue(thread.is_alive())
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    np.testing.assert_array_equal(computed[0].values, self.dataset['sst'].values)
+    dataset.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
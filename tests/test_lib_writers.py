@@ -0,0 +1,108 @@
+# Standard
+import unittest
+import tempfile
+import importlib.util
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party
+import numpy as np
+import xarray as xr
+
+# Own
+from siaextractlib.processing.writers import OutputEncoding, NetcdfBlockWriter, ZarrBlockWriter
+from siaextractlib.processing.planning import plan_blocks
+
+# Custom for testing
+from lib.local_opendap import make_dataset
+
+
+class TestOutputEncoding(unittest.TestCase):
+  def setUp(self) -> None:
+    self.dims = ('time', 'lat', 'lon')
+    self.sizes = { 'time': 40, 'lat': 20, 'lon': 30 }
+
+
+  def test_chunking_presets(self):
+    self.assertEqual(OutputEncoding(chunking='map').get_chunk_sizes(self.dims, self.sizes, 'time'), (1, 20, 30))
+    self.assertEqual(OutputEncoding(chunking='timeseries', tile_size=8).get_chunk_sizes(self.dims, self.sizes, 'time'), (40, 8, 8))
+    self.assertEqual(OutputEncoding(chunking={ 'time': 10, 'lat': 50 }).get_chunk_sizes(self.dims, self.sizes, 'time'), (10, 20, 30))
+    self.assertIsNone(OutputEncoding().get_chunk_sizes(self.dims, self.sizes, 'time'))
+    with self.assertRaises(ValueError):
+      OutputEncoding(chunking='rows')
+
+
+  def test_encoding_of_a_dataset(self):
+    dataset = make_dataset(n_times=5)
+    encoding = OutputEncoding(zlib=True, complevel=6, chunking='map', dtypes={ 'sst': 'float64', 'lat': 'float32' }).get_encoding(dataset, time_dim='time')
+    self.assertEqual(encoding['sst'], {
+      'zlib': True,
+      'complevel': 6,
+      'shuffle': True,
+      'chunksizes': (1, 20, 30),
+      'dtype': 'float64'
+    })
+    self.assertEqual(encoding['lat'], { 'dtype': 'float32' })
+    self.assertNotIn('time', encoding)
+
+
+class TestNetcdfBlockWriter(unittest.TestCase):
+  def test_blocks_are_appended_after_the_offsets(self):
+    dataset = make_dataset(n_times=12)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = Path(tmp_dir, 'out.nc')
+      first = dataset.isel(time=slice(0, 8))
+      writer = NetcdfBlockWriter(path, template=first, unlimited_dims=['time'], time_dim='time')
+      writer.create()
+      for block in plan_blocks(first, 4 * 20 * 30 * 4 + 1000):
+        writer.write(block, first.isel(block.slices))
+      writer.close()
+      rest = dataset.isel(time=slice(8, None))
+      writer = NetcdfBlockWriter(path, template=rest, unlimited_dims=['time'], time_dim='time', offsets={ 'time': 8 })
+      writer.open()
+      for block in plan_blocks(rest, 2 * 20 * 30 * 4 + 1000):
+        writer.write(block, rest.isel(block.slices))
+      writer.close()
+      with xr.open_dataset(path) as written:
+        np.testing.assert_array_equal(written['time'].values, dataset['time'].values)
+        np.testing.assert_array_equal(written['sst'].values, dataset['sst'].values)
+
+
+class TestZarrBlockWriter(unittest.TestCase):
+  def test_chunks_are_not_shared_by_blocks(self):
+    dataset = make_dataset(n_times=31)
+    blocks = plan_blocks(dataset, 6 * 20 * 30 * 4 + 1000)
+    writer = ZarrBlockWriter('out.zarr', template=dataset, blocks=blocks)
+    self.assertEqual(writer.get_chunk_sizes(), { 'time': 6, 'lat': 20, 'lon': 30 })
+    self.assertEqual(writer.get_shared_chunks(writer.get_chunk_sizes()), set())
+    writer = ZarrBlockWriter('out.zarr', template=dataset, blocks=blocks, output_encoding=OutputEncoding(chunking='map'))
+    self.assertEqual(writer.get_chunk_sizes(), { 'time': 1, 'lat': 20, 'lon': 30 })
+    writer = ZarrBlockWriter('out.zarr', template=dataset, blocks=blocks, output_encoding=OutputEncoding(chunking='timeseries', tile_size=10))
+    self.assertEqual(writer.get_chunk_sizes(), { 'time': 6, 'lat': 10, 'lon': 10 })
+
+
+  @unittest.skipIf(importlib.util.find_spec('zarr') is None, 'zarr is not installed.')
+  def test_blocks_aligned_from_an_offset(self):
+    dataset = make_dataset(n_times=31)
+    # Blocks aligned with remote chunks of a subset that starts at index 2:
+    # the first one is shorter.
+    blocks = plan_blocks(dataset, 6 * 20 * 30 * 4 + 1000, chunks={ 'time': 6 }, offsets={ 'time': 2 })
+    self.assertEqual([ b.slices['time'].start for b in blocks ], [0, 4, 10, 16, 22, 28])
+    writer = ZarrBlockWriter('out.zarr', template=dataset, blocks=blocks)
+    chunks = writer.get_chunk_sizes()
+    self.assertEqual(chunks, { 'time': 6, 'lat': 20, 'lon': 30 })
+    self.assertEqual(writer.get_shared_chunks(chunks), set([ ('time', i) for i in range(5) ]))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = Path(tmp_dir, 'out.zarr')
+      writer = ZarrBlockWriter(path, template=dataset, blocks=blocks)
+      writer.create()
+      with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+        list(executor.map(lambda b: writer.write(b, dataset.isel(b.slices)), blocks))
+      writer.close()
+      with xr.open_zarr(path) as written:
+        self.assertEqual(written['sst'].encoding['chunks'], (6, 20, 30))
+        np.testing.assert_array_equal(written['sst'].values, dataset['sst'].values)
+
+
+if __name__ == '__main__':
+  unittest.main()